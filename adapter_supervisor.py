@@ -0,0 +1,421 @@
+import sys
+import time
+import json
+import queue
+import asyncio
+import threading
+import multiprocessing
+import concurrent.futures
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from usb_pico_interface import UserOutput, TransferStatus, OutboundQueue, ReconnectingSendRecv, transfer_policies, async_transfer_func, list_usb_devices, open_usb_device, get_reconnect_function
+from eeprom_cache import EepromImageCache
+from dns_cache import DnsCache
+from relay_pool import RelayConnectionPool
+from happy_eyeballs import HappyEyeballs
+
+# Runs one bridge for each connected adapter, from a single host process.
+# In THREAD mode all the bridges share one asyncio event loop (each one only
+# has a worker thread for its blocking USB calls).
+# In PROCESS mode each bridge gets its own process, so they spread over the cores.
+# Commands can be sent to one adapter or to all of them, and the metrics of
+# all the adapters are gathered in one place. Both are also available
+# over HTTP, through SupervisorHTTPServer.
+
+# User output of one adapter, with its name in front of each line
+class AdapterOutput(UserOutput):
+    def __init__(self, name):
+        self.name = name
+
+    def set_out(self, string, tag, end='\n'):
+        print("[" + self.name + "] " + str(string), end=end)
+
+# User input class which gets its commands from a queue.
+# Works with both queue.Queue and multiprocessing.Queue.
+class QueueInput:
+    def __init__(self, commands_queue):
+        self.commands_queue = commands_queue
+
+    def get_input(self):
+        out = []
+        while True:
+            try:
+                out += [self.commands_queue.get_nowait()]
+            except queue.Empty:
+                break
+        return out
+
+# The name of an adapter: its serial number, unless another adapter has the same one
+def get_adapter_name(device_id, device_ids):
+    if device_id.serial_number is not None:
+        same_serial = [elem for elem in device_ids if elem.serial_number == device_id.serial_number]
+        if len(same_serial) == 1:
+            return device_id.serial_number
+    return str(device_id)
+
+# The bus address of a device changes when it's plugged back in, so it's found by its serial number
+def reopen_adapter(device_id, settings, user_output):
+    if device_id.serial_number is not None:
+        device_ids = settings["usb_lister"](settings["VID"], settings["PID"], [device_id.serial_number])
+        # Older firmwares report the same serial on all the adapters.
+        # If the serial is not unique, it can't tell which one this is: keep the old location.
+        if len(device_ids) == 1:
+            device_id = device_ids[0]
+    return settings["usb_opener"](device_id, settings["VID"], settings["PID"], settings["max_usb_timeout_r"], settings["max_usb_timeout_w"], user_output)
+
+# Runs the bridge of a single adapter on the current event loop.
+# Sends a snapshot of its metrics to metrics_function every metrics_interval seconds.
+# dns_cache, relay_pool and happy_eyeballs can be shared by the bridges running on the same event loop.
+async def run_adapter(name, device_id, settings, commands_queue, transfer_state, metrics_function, dns_cache=None, relay_pool=None, happy_eyeballs=None):
+    loop = asyncio.get_running_loop()
+    user_output = AdapterOutput(name)
+    usb_handler = None
+    start_time = time.monotonic()
+    out_queue = OutboundQueue(user_output, alert_depth=settings["queue_alert_depth"])
+
+    async def send_metrics():
+        while True:
+            metrics = {"uptime": time.monotonic() - start_time, "queue": out_queue.get_stats()}
+            if dns_cache is not None:
+                metrics["dns_cache"] = dns_cache.get_stats()
+            if relay_pool is not None:
+                metrics["relay_pool"] = relay_pool.get_stats()
+            if happy_eyeballs is not None:
+                metrics["happy_eyeballs"] = happy_eyeballs.get_stats()
+            metrics_function(name, metrics)
+            await asyncio.sleep(settings["metrics_interval"])
+
+    metrics_task = None
+    try:
+        usb_handler = await loop.run_in_executor(None, settings["usb_opener"], device_id, settings["VID"], settings["PID"], settings["max_usb_timeout_r"], settings["max_usb_timeout_w"], user_output)
+        if usb_handler is None:
+            return
+        user_output.set_out("USB connection established!", user_output.USB_TAG)
+        eeprom_cache = None
+        # The name is the serial number only if no other adapter has the same one
+        if (settings["eeprom_cache_dir"] is not None) and (name == device_id.serial_number):
+            eeprom_cache = EepromImageCache(settings["eeprom_cache_dir"], serial_number=device_id.serial_number)
+        if settings["reconnect"]:
+            usb_handler = ReconnectingSendRecv(usb_handler, lambda: reopen_adapter(device_id, settings, user_output), transfer_state, user_output, max_attempts=settings["reconnect_attempts"], on_reconnect=get_reconnect_function(eeprom_cache))
+        metrics_task = asyncio.ensure_future(send_metrics())
+        await async_transfer_func(usb_handler, QueueInput(commands_queue), transfer_state, user_output, transfer_policy=transfer_policies[settings["transfer_policy"]](), out_queue=out_queue, eeprom_cache=eeprom_cache, dns_cache=dns_cache, relay_pool=relay_pool, happy_eyeballs=happy_eyeballs, max_connections=settings["max_connections"])
+    except:
+        user_output.set_out("Unexpected exception: " + str(sys.exc_info()[0]), user_output.EXCEPTION_TAG)
+    finally:
+        if metrics_task is not None:
+            metrics_task.cancel()
+        if usb_handler is not None:
+            try:
+                usb_handler.kill_function()
+            except:
+                pass
+
+# hosts is a list of (host, port) tuples to race IPv4 and IPv6 for, or None
+def create_happy_eyeballs(hosts):
+    if hosts is None:
+        return None
+    happy_eyeballs = HappyEyeballs()
+    for host, port in hosts:
+        happy_eyeballs.add_host(host, port)
+    return happy_eyeballs
+
+# servers is a list of (address, port) tuples of DNS servers, or None
+def create_dns_cache(servers):
+    if servers is None:
+        return None
+    return DnsCache(servers)
+
+# Entry point of the processes in PROCESS mode
+def run_adapter_process(name, device_id, settings, commands_queue, metrics_queue):
+    def put_metrics(name, metrics):
+        metrics_queue.put((name, metrics))
+    dns_cache = create_dns_cache(settings["dns_servers"])
+    relay_pool = None
+    if settings["relay_pool"]:
+        relay_pool = RelayConnectionPool()
+    asyncio.run(run_adapter(name, device_id, settings, commands_queue, TransferStatus(), put_metrics, dns_cache=dns_cache, relay_pool=relay_pool, happy_eyeballs=create_happy_eyeballs(settings["happy_eyeballs_hosts"])))
+    if relay_pool is not None:
+        relay_pool.close()
+
+# State of a bridge, as seen by the supervisor
+class AdapterEntry:
+    def __init__(self, name, device_id, commands_queue):
+        self.name = name
+        self.device_id = device_id
+        self.commands_queue = commands_queue
+        self.transfer_state = None
+        self.task = None
+        self.process = None
+        self.started = time.time()
+        self.metrics = dict()
+
+    def is_running(self):
+        if self.task is not None:
+            return not self.task.done()
+        if self.process is not None:
+            return self.process.is_alive()
+        return False
+
+# Supervisor of the bridges. Devices are looked for every rescan_interval seconds,
+# a bridge is started for the new ones, and the bridges of removed devices are dropped.
+# usb_lister and usb_opener have the same arguments as list_usb_devices and open_usb_device.
+# In PROCESS mode, usb_lister and usb_opener must be module-level functions, so they can go to the new processes.
+# With reconnect, a bridge whose device is lost looks for it again (by serial number) up to
+# reconnect_attempts times, keeping its sockets open, before it ends.
+# dns_servers lists the (address, port) tuples of the adapters' DNS servers. If it's set,
+# repeated DNS queries to them are answered by the host (see DnsCache).
+# With relay_pool, connections to the relay server are kept ready (see RelayConnectionPool).
+# happy_eyeballs_hosts lists the (host, port) tuples whose connects race IPv4 and IPv6 (see HappyEyeballs).
+# max_connections sizes the socket table of each bridge (None for the adapter's default).
+class AdapterSupervisor:
+    MODE_THREAD = "THREAD"
+    MODE_PROCESS = "PROCESS"
+    ALL_ADAPTERS = "ALL"
+
+    def __init__(self, VID=0xcafe, PID=0x4011, mode=MODE_THREAD, serial_numbers=None, max_usb_timeout_r=0.1, max_usb_timeout_w=5, transfer_policy="ADAPTIVE", rescan_interval=2.0, metrics_interval=1.0, queue_alert_depth=None, eeprom_cache_dir=EepromImageCache.DEFAULT_DIRECTORY, usb_lister=list_usb_devices, usb_opener=open_usb_device, reconnect=True, reconnect_attempts=10, dns_servers=None, relay_pool=False, happy_eyeballs_hosts=None, max_connections=None):
+        self.mode = mode
+        self.serial_numbers = serial_numbers
+        self.rescan_interval = rescan_interval
+        self.usb_lister = usb_lister
+        self.settings = {
+            "VID": VID,
+            "PID": PID,
+            "max_usb_timeout_r": max_usb_timeout_r,
+            "max_usb_timeout_w": max_usb_timeout_w,
+            "transfer_policy": transfer_policy,
+            "metrics_interval": metrics_interval,
+            "queue_alert_depth": queue_alert_depth,
+            "eeprom_cache_dir": eeprom_cache_dir,
+            "usb_lister": usb_lister,
+            "usb_opener": usb_opener,
+            "reconnect": reconnect,
+            "reconnect_attempts": reconnect_attempts,
+            "dns_servers": dns_servers,
+            "relay_pool": relay_pool,
+            "happy_eyeballs_hosts": happy_eyeballs_hosts,
+            "max_connections": max_connections
+        }
+        # In THREAD mode, all the adapters share the same DNS cache and relay pool
+        self.dns_cache = None
+        self.relay_pool = None
+        if self.mode == AdapterSupervisor.MODE_THREAD:
+            self.dns_cache = create_dns_cache(dns_servers)
+        if relay_pool and (self.mode == AdapterSupervisor.MODE_THREAD):
+            self.relay_pool = RelayConnectionPool()
+        self.happy_eyeballs = None
+        if self.mode == AdapterSupervisor.MODE_THREAD:
+            self.happy_eyeballs = create_happy_eyeballs(happy_eyeballs_hosts)
+        self.adapters = dict()
+        self.adapters_lock = threading.Lock()
+        self.metrics_queue = None
+        if self.mode == AdapterSupervisor.MODE_PROCESS:
+            self.metrics_queue = multiprocessing.Queue()
+        self.ending = False
+        self.wake_event = None
+        self.loop = None
+
+    def store_metrics(self, name, metrics):
+        with self.adapters_lock:
+            if name in self.adapters.keys():
+                self.adapters[name].metrics = metrics
+
+    def start_adapter(self, name, device_id):
+        if self.mode == AdapterSupervisor.MODE_PROCESS:
+            entry = AdapterEntry(name, device_id, multiprocessing.Queue())
+            entry.process = multiprocessing.Process(target=run_adapter_process, args=(name, device_id, self.settings, entry.commands_queue, self.metrics_queue), daemon=True)
+            entry.process.start()
+        else:
+            entry = AdapterEntry(name, device_id, queue.Queue())
+            entry.transfer_state = TransferStatus()
+            entry.task = asyncio.ensure_future(run_adapter(name, device_id, self.settings, entry.commands_queue, entry.transfer_state, self.store_metrics, dns_cache=self.dns_cache, relay_pool=self.relay_pool, happy_eyeballs=self.happy_eyeballs))
+        with self.adapters_lock:
+            self.adapters[name] = entry
+
+    # Starts the bridges of new devices, and forgets the ones which ended
+    async def rescan(self):
+        loop = asyncio.get_running_loop()
+        with self.adapters_lock:
+            for name in list(self.adapters.keys()):
+                if not self.adapters[name].is_running():
+                    print("[" + name + "] Adapter disconnected")
+                    del self.adapters[name]
+        device_ids = await loop.run_in_executor(None, self.usb_lister, self.settings["VID"], self.settings["PID"], self.serial_numbers)
+        for device_id in device_ids:
+            name = get_adapter_name(device_id, device_ids)
+            with self.adapters_lock:
+                found = name in self.adapters.keys()
+            if not found:
+                print("[" + name + "] Adapter found")
+                self.start_adapter(name, device_id)
+
+    def drain_metrics(self):
+        if self.metrics_queue is None:
+            return
+        while True:
+            try:
+                name, metrics = self.metrics_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.store_metrics(name, metrics)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wake_event = asyncio.Event()
+        try:
+            while not self.ending:
+                await self.rescan()
+                self.drain_metrics()
+                try:
+                    await asyncio.wait_for(self.wake_event.wait(), self.rescan_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.wake_event.clear()
+        finally:
+            await self.stop_adapters()
+
+    async def stop_adapters(self):
+        self.send_command(AdapterSupervisor.ALL_ADAPTERS, "QUIT")
+        with self.adapters_lock:
+            entries = list(self.adapters.values())
+        for entry in entries:
+            if entry.transfer_state is not None:
+                entry.transfer_state.end = True
+        tasks = [entry.task for entry in entries if entry.task is not None]
+        if len(tasks) > 0:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for entry in entries:
+            if entry.process is not None:
+                entry.process.join(2)
+                if entry.process.is_alive():
+                    entry.process.terminate()
+        if self.relay_pool is not None:
+            self.relay_pool.close()
+
+    # Can be called from any thread
+    def stop(self):
+        self.ending = True
+        if (self.loop is not None) and (self.wake_event is not None):
+            self.loop.call_soon_threadsafe(self.wake_event.set)
+
+    # Sends a command (same syntax as the keyboard's) to the adapter called target, or to all of them.
+    # Returns the names of the adapters it was sent to. Can be called from any thread.
+    def send_command(self, target, command):
+        sent_to = []
+        with self.adapters_lock:
+            for name in self.adapters.keys():
+                if (target == AdapterSupervisor.ALL_ADAPTERS) or (target == name):
+                    self.adapters[name].commands_queue.put(command)
+                    sent_to += [name]
+        return sent_to
+
+    # Can be called from any thread
+    def get_metrics(self):
+        self.drain_metrics()
+        out = dict()
+        with self.adapters_lock:
+            for name in self.adapters.keys():
+                entry = self.adapters[name]
+                out[name] = {
+                    "device": str(entry.device_id),
+                    "serial_number": entry.device_id.serial_number,
+                    "mode": self.mode,
+                    "running": entry.is_running(),
+                    "started": entry.started
+                }
+                out[name].update(entry.metrics)
+        return out
+
+# HTTP endpoints of a supervisor, on localhost only by default.
+# GET /metrics returns the metrics of all the adapters as JSON.
+# POST /command with {"adapter": name or "ALL", "command": "GET STATUS"} sends a command.
+class SupervisorHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, supervisor, port, host="127.0.0.1"):
+        self.supervisor = supervisor
+        super().__init__((host, port), SupervisorRequestHandler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class SupervisorRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_json(404, {"error": "not found"})
+            return
+        self.send_json(200, self.server.supervisor.get_metrics())
+
+    def do_POST(self):
+        if self.path != "/command":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            sent_to = self.server.supervisor.send_command(request.get("adapter", AdapterSupervisor.ALL_ADAPTERS), str(request["command"]))
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {"error": "expected {\"adapter\": name, \"command\": command}"})
+            return
+        self.send_json(200, {"sent_to": sent_to})
+
+    def log_message(self, format, *args):
+        pass
+
+# Keyboard control: "<adapter name or ALL> <command>", "LIST" or "QUIT"
+def supervisor_console(supervisor):
+    for line in sys.stdin:
+        tokens = line.strip().split(None, 1)
+        if len(tokens) == 0:
+            continue
+        if tokens[0].upper() == "QUIT":
+            break
+        if tokens[0].upper() == "LIST":
+            print(json.dumps(supervisor.get_metrics(), indent=1))
+            continue
+        if len(tokens) < 2:
+            print("Usage: <adapter name or ALL> <command>, LIST or QUIT")
+            continue
+        target = tokens[0]
+        if target.upper() == AdapterSupervisor.ALL_ADAPTERS:
+            target = AdapterSupervisor.ALL_ADAPTERS
+        if len(supervisor.send_command(target, tokens[1])) == 0:
+            print("No adapter called " + target)
+    supervisor.stop()
+
+# Run as: python adapter_supervisor.py [THREAD/PROCESS] [http_port] [serial_number...]
+if __name__ == "__main__":
+    mode = AdapterSupervisor.MODE_THREAD
+    port = None
+    serial_numbers = None
+    if len(sys.argv) > 1:
+        mode = sys.argv[1].upper().strip()
+    if mode not in [AdapterSupervisor.MODE_THREAD, AdapterSupervisor.MODE_PROCESS]:
+        sys.exit("Unknown mode: " + mode + " (available: THREAD, PROCESS)")
+    if (len(sys.argv) > 2) and (int(sys.argv[2]) > 0):
+        port = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        serial_numbers = sys.argv[3:]
+
+    supervisor = AdapterSupervisor(mode=mode, serial_numbers=serial_numbers)
+    server = None
+    if port is not None:
+        server = SupervisorHTTPServer(supervisor, port)
+        server.start()
+    threading.Thread(target=supervisor_console, args=(supervisor,), daemon=True).start()
+    try:
+        asyncio.run(supervisor.run())
+    except KeyboardInterrupt:
+        pass
+    if server is not None:
+        server.stop()
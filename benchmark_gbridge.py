@@ -0,0 +1,248 @@
+import sys
+import timeit
+import time
+import socket
+import threading
+import tracemalloc
+from gbridge import GBridge, GBridgeCommand, GBridgeSocket
+from usb_pico_interface import SocketThread, UserOutput
+
+# Benchmarks for the host-side GBridge code. No Pico is needed:
+# synthetic USB packets go through SocketThread.process_data, and the
+# sockets talk to peers on the loopback interface.
+# Run as: python benchmark_gbridge.py [checksum] [data] [stream] [recv] [debug_log]
+
+# Per-byte implementation GBridge.calc_checksum used before, as a reference
+def reference_checksum(data):
+    checksum = 0
+    for i in range(len(data)):
+        checksum += data[i]
+        checksum &= 0xFFFF
+    return checksum
+
+def time_call(func, data, min_time=0.2):
+    timer = timeit.Timer(lambda: func(data))
+    num_runs, total_time = timer.autorange()
+    while total_time < min_time:
+        num_runs *= 2
+        total_time = timer.timeit(num_runs)
+    return total_time / num_runs
+
+def benchmark_checksum(output=print):
+    output("Checksum (per call):")
+    for size in [0x40, 0x80, 0xFFFF]:
+        data = memoryview(bytes((i * 7) & 0xFF for i in range(size)))
+        if reference_checksum(data) != GBridge.calc_checksum(data):
+            raise ValueError("Checksum mismatch for size " + str(size))
+        old_time = time_call(reference_checksum, data)
+        new_time = time_call(GBridge.calc_checksum, data)
+        output("  " + str(size) + " bytes: per-byte loop " + format_time(old_time) + ", calc_checksum " + format_time(new_time) + " (" + ("%.1f" % (old_time / new_time)) + "x)")
+
+def format_time(value):
+    if value < 0.001:
+        return ("%.2f" % (value * 1000000)) + " us"
+    return ("%.2f" % (value * 1000)) + " ms"
+
+# Drops everything the bridge would print
+class NullOutput(UserOutput):
+    def set_out(self, string, tag, end='\n'):
+        pass
+
+TRANSFER_PAYLOAD_SIZE = 0x40 - 1
+DEBUG_TRANSFER_FLAG = 0x80
+
+def make_frame(cmd, payload):
+    size_length = GBridge.cmd_lens[cmd]
+    out_data = bytearray([cmd])
+    out_data += len(payload).to_bytes(size_length, byteorder='big')
+    out_data += payload
+    out_data += GBridge.calc_checksum(payload).to_bytes(2, byteorder='big')
+    return out_data
+
+# Splits data into USB packets, the way the Pico sends them
+def make_packets(data, is_debug=False):
+    packets = []
+    for i in range(0, len(data), TRANSFER_PAYLOAD_SIZE):
+        chunk = data[i:i + TRANSFER_PAYLOAD_SIZE]
+        header = len(chunk)
+        if is_debug:
+            header |= DEBUG_TRANSFER_FLAG
+        packets += [bytes([header]) + chunk]
+    return packets
+
+def loopback_addr(port):
+    return bytes([GBridgeSocket.MOBILE_ADDRTYPE_IPV4, (port >> 8) & 0xFF, port & 0xFF, 127, 0, 0, 1])
+
+def data_cmd(command, payload):
+    return make_frame(GBridge.GBRIDGE_CMD_DATA, bytes([command]) + payload)
+
+# Reads everything it gets, so the bridge never blocks on sending
+def drain_socket(sock, stop):
+    sock.settimeout(0.1)
+    while not stop.is_set():
+        try:
+            if len(sock.recv(0x10000)) == 0:
+                return
+        except socket.timeout:
+            pass
+        except OSError:
+            return
+
+# Keeps the bridge's receive side full
+def flood_socket(sock, stop):
+    chunk = bytes(0x1000)
+    sock.settimeout(0.1)
+    while not stop.is_set():
+        try:
+            sock.send(chunk)
+        except socket.timeout:
+            pass
+        except OSError:
+            return
+
+class LoopbackPeers:
+    def __init__(self):
+        self.stop = threading.Event()
+        self.threads = []
+        self.tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_server.bind(("127.0.0.1", 0))
+        self.tcp_server.listen(1)
+        self.tcp_port = self.tcp_server.getsockname()[1]
+        self.udp_peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_peer.bind(("127.0.0.1", 0))
+        self.udp_port = self.udp_peer.getsockname()[1]
+        self.tcp_peer = None
+        self.start_thread(drain_socket, self.udp_peer)
+
+    def start_thread(self, target, sock):
+        thread = threading.Thread(target=target, args=(sock, self.stop), daemon=True)
+        thread.start()
+        self.threads += [thread]
+
+    def accept_tcp(self, flood):
+        self.tcp_peer, _ = self.tcp_server.accept()
+        if flood:
+            self.start_thread(flood_socket, self.tcp_peer)
+        else:
+            self.start_thread(drain_socket, self.tcp_peer)
+
+    def close(self):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+        for sock in [self.tcp_peer, self.tcp_server, self.udp_peer]:
+            if sock is not None:
+                sock.close()
+
+# Opens connection 0 (TCP, connected to the peer) and connection 1 (UDP)
+def prepare_bridge(peers, flood_tcp):
+    bridge = SocketThread(NullOutput(), start_thread=False)
+    bridge.debug_print = False
+    run_frame(bridge, data_cmd(GBridgeCommand.GBRIDGE_PROT_MA_CMD_OPEN, bytes([0, GBridgeSocket.MOBILE_SOCKTYPE_TCP, GBridgeSocket.MOBILE_ADDRTYPE_IPV4, 0, 0])))
+    run_frame(bridge, data_cmd(GBridgeCommand.GBRIDGE_PROT_MA_CMD_OPEN, bytes([1, GBridgeSocket.MOBILE_SOCKTYPE_UDP, GBridgeSocket.MOBILE_ADDRTYPE_IPV4, 0, 0])))
+    connect_frame = data_cmd(GBridgeCommand.GBRIDGE_PROT_MA_CMD_CONNECT, bytes([0]) + loopback_addr(peers.tcp_port))
+    run_frame(bridge, connect_frame)
+    peers.accept_tcp(flood_tcp)
+    while bridge.bridge_sockets.connect_state(bridge.bridge_sockets.slots[0]) == 0:
+        run_frame(bridge, connect_frame)
+    return bridge
+
+def run_frame(bridge, frame, is_debug=False):
+    out_data = bytearray()
+    for packet in make_packets(frame, is_debug):
+        out_data += bridge.process_data(packet, {}, {})
+    return out_data
+
+# Returns the frames of one iteration of the workload, and their payload size
+def data_workload(peers):
+    send_header = data_cmd(GBridgeCommand.GBRIDGE_PROT_MA_CMD_SEND, bytes([1]) + loopback_addr(peers.udp_port))
+    payload = bytes(range(0x10))
+    return [(send_header, False), (make_frame(GBridge.GBRIDGE_CMD_STREAM, payload), False)], len(payload)
+
+def stream_workload(peers):
+    send_header = data_cmd(GBridgeCommand.GBRIDGE_PROT_MA_CMD_SEND, bytes([0, GBridgeSocket.MOBILE_ADDRTYPE_NONE]))
+    payload = bytes(i & 0xFF for i in range(0x400))
+    return [(send_header, False), (make_frame(GBridge.GBRIDGE_CMD_STREAM, payload), False)], len(payload)
+
+def recv_workload(peers):
+    recv_size = 0x80
+    return [(data_cmd(GBridgeCommand.GBRIDGE_PROT_MA_CMD_RECV, bytes([0, 0, recv_size, 1])), False)], recv_size
+
+def debug_log_workload(peers):
+    payload = b"Mobile Adapter debug line, sent while the Game Boy is talking\n\0"
+    return [(make_frame(GBridge.GBRIDGE_CMD_DEBUG_LINE, payload), True)], len(payload)
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = int(fraction * (len(ordered) - 1))
+    return ordered[index]
+
+def run_workload(name, workload, flood_tcp=False, duration=1.0, output=print):
+    peers = LoopbackPeers()
+    try:
+        bridge = prepare_bridge(peers, flood_tcp)
+        frames, payload_size = workload(peers)
+        latencies = []
+        num_frames = 0
+        num_bytes = 0
+        start_time = time.perf_counter()
+        while (time.perf_counter() - start_time) < duration:
+            for frame, is_debug in frames:
+                frame_start = time.perf_counter()
+                run_frame(bridge, frame, is_debug)
+                latencies += [time.perf_counter() - frame_start]
+                num_frames += 1
+            num_bytes += payload_size
+        total_time = time.perf_counter() - start_time
+
+        # Allocations are measured separately, tracemalloc slows everything down
+        tracemalloc.start()
+        num_traced = 100
+        peak_total = 0
+        blocks_before = sys.getallocatedblocks()
+        for i in range(num_traced):
+            for frame, is_debug in frames:
+                tracemalloc.reset_peak()
+                base_size, _ = tracemalloc.get_traced_memory()
+                run_frame(bridge, frame, is_debug)
+                _, peak_size = tracemalloc.get_traced_memory()
+                peak_total += peak_size - base_size
+        blocks_after = sys.getallocatedblocks()
+        tracemalloc.stop()
+        traced_frames = num_traced * len(frames)
+
+        output(name + ":")
+        output("  " + ("%.0f" % (num_frames / total_time)) + " frames/s, " + ("%.1f" % (num_bytes / total_time / 1024)) + " KiB/s of payload")
+        output("  latency per frame: p50 " + format_time(percentile(latencies, 0.5)) + ", p99 " + format_time(percentile(latencies, 0.99)))
+        output("  allocated per frame: " + ("%.0f" % (peak_total / traced_frames)) + " bytes at peak, " + ("%.2f" % ((blocks_after - blocks_before) / traced_frames)) + " blocks kept")
+    finally:
+        peers.close()
+
+def benchmark_data(output=print):
+    run_workload("DATA (UDP SEND, 16 bytes)", data_workload, output=output)
+
+def benchmark_stream(output=print):
+    run_workload("STREAM (TCP SEND, 1 KiB)", stream_workload, output=output)
+
+def benchmark_recv(output=print):
+    run_workload("RECV (TCP, 128 bytes)", recv_workload, flood_tcp=True, output=output)
+
+def benchmark_debug_log(output=print):
+    run_workload("DEBUG LOG (lines from the Pico)", debug_log_workload, output=output)
+
+benchmarks = {
+    "checksum": benchmark_checksum,
+    "data": benchmark_data,
+    "stream": benchmark_stream,
+    "recv": benchmark_recv,
+    "debug_log": benchmark_debug_log
+}
+
+if __name__ == "__main__":
+    selected = sys.argv[1:]
+    if len(selected) == 0:
+        selected = list(benchmarks.keys())
+    for name in selected:
+        if name not in benchmarks.keys():
+            sys.exit("Unknown benchmark: " + name + " (available: " + ", ".join(benchmarks.keys()) + ")")
+        benchmarks[name]()
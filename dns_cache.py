@@ -0,0 +1,170 @@
+import time
+import struct
+import ipaddress
+from collections import OrderedDict
+
+# Host-side cache of the DNS answers the adapter gets.
+# GBridgeSocket hands it the UDP datagrams the Game Boy sends to one of servers,
+# the (address, port) tuples of the DNS servers the adapter is configured with (DNS_1 and DNS_2):
+# if the question was answered before, and the answer's TTL is not over yet,
+# the answer is given back right away, without going to the DNS server.
+# Otherwise the query goes out as usual, and the server's answer is stored.
+# Answers are only stored if they match a query which was sent to that same server.
+# At most max_entries answers are kept, the least recently used ones are dropped first.
+class DnsCache:
+    HEADER_SIZE = 12
+    FLAG_RESPONSE = 0x8000
+    FLAG_TRUNCATED = 0x0200
+    OPCODE_MASK = 0x7800
+    RCODE_MASK = 0x000F
+    RCODE_NOERROR = 0
+    RCODE_NXDOMAIN = 3
+    TYPE_OPT = 41
+    MAX_PENDING = 64
+
+    def __init__(self, servers, max_entries=256, min_ttl=0, max_ttl=3600, negative_ttl=30):
+        self.servers = set(DnsCache.normalize_address(server) for server in servers)
+        self.max_entries = max_entries
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        # question -> (answer, ttl offsets, original ttls, time stored, time it expires)
+        self.entries = OrderedDict()
+        # (id, question) -> server host and port
+        self.pending = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # IPv6 addresses can be written in more than one way
+    def normalize_address(address):
+        return (ipaddress.ip_address(address[0]).compressed, address[1])
+
+    def is_dns_address(self, address):
+        if (address is None) or (len(address) < 2):
+            return False
+        try:
+            return DnsCache.normalize_address(address) in self.servers
+        except ValueError:
+            return False
+
+    # Skips a (possibly compressed) name, returns the offset after it
+    def skip_name(data, offset):
+        while True:
+            if offset >= len(data):
+                raise ValueError("name out of bounds")
+            length = data[offset]
+            if (length & 0xC0) == 0xC0:
+                return offset + 2
+            if length == 0:
+                return offset + 1
+            offset += 1 + length
+
+    # Returns the question of a message (name, type and class) and the offset after it.
+    # Names are case insensitive, so their labels are lowercased. Type and class are left as they are.
+    # Only messages with exactly one question are handled.
+    def read_question(data):
+        if len(data) < DnsCache.HEADER_SIZE:
+            raise ValueError("message too short")
+        if struct.unpack_from(">H", data, 4)[0] != 1:
+            raise ValueError("not a single question")
+        end = DnsCache.skip_name(data, DnsCache.HEADER_SIZE) + 4
+        if end > len(data):
+            raise ValueError("question out of bounds")
+        question = bytearray(data[DnsCache.HEADER_SIZE:end])
+        offset = 0
+        while (question[offset] != 0) and ((question[offset] & 0xC0) != 0xC0):
+            length = question[offset]
+            question[offset + 1:offset + 1 + length] = question[offset + 1:offset + 1 + length].lower()
+            offset += 1 + length
+        return bytes(question), end
+
+    # Returns the offsets of the TTLs of all the records of an answer, and their values
+    def read_ttls(data, offset):
+        num_records = sum(struct.unpack_from(">HHH", data, 6))
+        offsets = []
+        ttls = []
+        for i in range(num_records):
+            offset = DnsCache.skip_name(data, offset)
+            if offset + 10 > len(data):
+                raise ValueError("record out of bounds")
+            record_type, _, ttl, data_len = struct.unpack_from(">HHIH", data, offset)
+            # OPT's TTL field holds flags, not a TTL
+            if record_type != DnsCache.TYPE_OPT:
+                offsets += [offset + 4]
+                ttls += [ttl]
+            offset += 10 + data_len
+        if offset > len(data):
+            raise ValueError("record out of bounds")
+        return offsets, ttls
+
+    # Called for each datagram the Game Boy sends to a DNS server.
+    # Returns the answer to give back, or None if the query must go to the server.
+    def query(self, data, address):
+        try:
+            question, _ = DnsCache.read_question(data)
+            flags = struct.unpack_from(">H", data, 2)[0]
+        except (ValueError, struct.error):
+            return None
+        if (flags & (DnsCache.FLAG_RESPONSE | DnsCache.OPCODE_MASK)) != 0:
+            return None
+        query_id = bytes(data[:2])
+        answer = self.get(question, query_id)
+        if answer is not None:
+            self.hits += 1
+            return answer
+        self.misses += 1
+        self.pending[(query_id, question)] = tuple(address[:2])
+        while len(self.pending) > DnsCache.MAX_PENDING:
+            self.pending.popitem(last=False)
+        return None
+
+    def get(self, question, query_id):
+        entry = self.entries.get(question)
+        if entry is None:
+            return None
+        answer, offsets, ttls, stored, expires = entry
+        now = time.monotonic()
+        if now >= expires:
+            del self.entries[question]
+            return None
+        self.entries.move_to_end(question)
+        elapsed = int(now - stored)
+        answer = bytearray(answer)
+        answer[:2] = query_id
+        for i in range(len(offsets)):
+            struct.pack_into(">I", answer, offsets[i], max(ttls[i] - elapsed, 0))
+        return bytes(answer)
+
+    # Called for each datagram which comes from a DNS server
+    def store_response(self, data, address):
+        try:
+            question, offset = DnsCache.read_question(data)
+            flags = struct.unpack_from(">H", data, 2)[0]
+            offsets, ttls = DnsCache.read_ttls(data, offset)
+        except (ValueError, struct.error):
+            return
+        key = (bytes(data[:2]), question)
+        if self.pending.get(key) != tuple(address[:2]):
+            return
+        del self.pending[key]
+        if (flags & DnsCache.FLAG_RESPONSE) == 0 or (flags & DnsCache.FLAG_TRUNCATED) != 0:
+            return
+        rcode = flags & DnsCache.RCODE_MASK
+        answers = struct.unpack_from(">H", data, 6)[0]
+        if (rcode == DnsCache.RCODE_NOERROR) and (answers > 0):
+            ttl = min(ttls[:answers])
+        elif (rcode == DnsCache.RCODE_NXDOMAIN) or (rcode == DnsCache.RCODE_NOERROR):
+            ttl = self.negative_ttl
+        else:
+            return
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        if ttl <= 0:
+            return
+        now = time.monotonic()
+        self.entries[question] = (bytes(data), offsets, ttls, now, now + ttl)
+        self.entries.move_to_end(question)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
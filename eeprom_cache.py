@@ -0,0 +1,95 @@
+import os
+import re
+import hashlib
+from gbridge import GBridgeDebugCommands, VersionData
+
+# Host-side cache of the last known EEPROM image of an adapter.
+# Adapters are identified by their USB serial number (the Pico's unique chip ID),
+# plus the name and versions they report with CMD_DEBUG_INFO_IMPL.
+# Without a serial number, adapters with the same firmware can't be told apart,
+# so nothing is cached.
+# A cached image is only trusted once it was confirmed in this session: read back from
+# the adapter, or fully uploaded to it. The adapter may change its EEPROM on its own
+# while it runs, or lose unsaved changes when it reboots, so forget_confirmed is called then.
+# Images are kept in memory, and in directory (if not None), one file per adapter.
+# They are compared in blocks of the size used by prepare_offsetted_data,
+# so a changed block maps to exactly one UPDATE_EEPROM chunk.
+class EepromImageCache:
+    BLOCK_SIZE = GBridgeDebugCommands.MAXIMUM_LENGTH - 3
+    DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".pico_gb_mobile_adapter", "eeprom_cache")
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, serial_number=None):
+        self.directory = directory
+        self.serial_number = serial_number
+        self.images = dict()
+        self.confirmed = set()
+
+    # data is the payload of a CMD_DEBUG_INFO_IMPL reply, without the info type byte.
+    # Returns None if the adapter has no serial number.
+    def key_from_info(self, data):
+        if self.serial_number is None:
+            return None
+        version_mobile = VersionData(data[:VersionData.VERSION_LENGTH])
+        version_implementation = VersionData(data[VersionData.VERSION_LENGTH:2 * VersionData.VERSION_LENGTH])
+        name = bytes(data[2 * VersionData.VERSION_LENGTH:]).split(b'\0', 1)[0].decode('ascii', errors='replace')
+        return self.serial_number + "_" + name + "_" + str(version_mobile) + "_" + str(version_implementation)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, re.sub(r"[^A-Za-z0-9._-]", "_", key) + ".bin")
+
+    def load(self, key):
+        if key is None:
+            return None
+        if key in self.images.keys():
+            return self.images[key]
+        if self.directory is None:
+            return None
+        try:
+            with open(self.get_path(key), mode='rb') as file_read:
+                self.images[key] = file_read.read()
+        except OSError:
+            return None
+        return self.images[key]
+
+    def is_confirmed(self, key):
+        return key in self.confirmed
+
+    def forget_confirmed(self):
+        self.confirmed.clear()
+
+    # confirmed tells whether image is known to be what the adapter has right now
+    def store(self, key, image, confirmed=False):
+        if confirmed:
+            self.confirmed.add(key)
+        else:
+            self.confirmed.discard(key)
+        image = bytes(image)
+        if self.images.get(key) == image:
+            return
+        self.images[key] = image
+        if self.directory is None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.get_path(key), mode='wb') as file_write:
+                file_write.write(image)
+        except OSError:
+            pass
+
+    def block_hashes(image):
+        hashes = []
+        for i in range(0, len(image), EepromImageCache.BLOCK_SIZE):
+            hashes += [hashlib.blake2b(image[i:i + EepromImageCache.BLOCK_SIZE], digest_size=16).digest()]
+        return hashes
+
+    # Returns the indexes of the blocks of new_image which are not the same in old_image
+    def changed_blocks(old_image, new_image):
+        new_hashes = EepromImageCache.block_hashes(new_image)
+        if old_image is None:
+            return list(range(len(new_hashes)))
+        old_hashes = EepromImageCache.block_hashes(old_image)
+        changed = []
+        for i in range(len(new_hashes)):
+            if (i >= len(old_hashes)) or (old_hashes[i] != new_hashes[i]):
+                changed += [i]
+        return changed
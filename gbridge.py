@@ -1,7 +1,10 @@
-from time import sleep
 from mobile_adapter_data import MobileAdapterDeviceData
 import socket
+import os
+import select
+import selectors
 import errno
+from collections import deque
 
 class GBridgeCommand:
     GBRIDGE_PROT_MA_CMD_OPEN = 0
@@ -106,13 +109,13 @@ class GBridgeCommand:
 
     def result_to_send(self):
         if self.command in GBridgeCommand.AllowedAnswers:
-            return [self.command] + self.answer
-        return []
+            return bytes([self.command]) + bytes(self.answer)
+        return b""
     
     def get_if_pending(self):
         if self.pending is not None:
             return self.pending
-        return []
+        return b""
     
     def do_print(self, user_output):
         if self.upper_cmd == GBridge.GBRIDGE_CMD_DEBUG_LINE:
@@ -142,7 +145,7 @@ class GBridgeCommand:
                     user_output.set_out(GBridgeCommand.prepare_hex_list_str(self.data[1:]), user_output.UNHANDLED_INFO_DIRECT_TAG)
             if self.data[0] == GBridgeDebugCommands.CMD_DEBUG_INFO_NUM_STATUS:
                 # Will need to handle it once libmobile has the function
-                user_output.set_out(self.data[1:], user_output.NUMBER_REQUEST_STATE_TAG)
+                user_output.set_out(list(self.data[1:]), user_output.NUMBER_REQUEST_STATE_TAG)
             if self.data[0] == GBridgeDebugCommands.CMD_DEBUG_INFO_IMPL:
                 version_mobile = VersionData(self.data[1:1+VersionData.VERSION_LENGTH])
                 version_implementation = VersionData(self.data[1+VersionData.VERSION_LENGTH:1+(2*VersionData.VERSION_LENGTH)])
@@ -360,6 +363,8 @@ class GBridge:
     GBRIDGE_CMD_STREAM_PC = 0x4C
     GBRIDGE_CMD_STREAM_PC_FAIL = 0x4D
     GBRIDGE_CMD_REPLY_F = 0x80
+
+    CHECKSUM_SIZE = 2
     
     no_reply_upper_cmds = {
         GBRIDGE_CMD_DEBUG_LINE,
@@ -383,21 +388,31 @@ class GBridge:
         GBRIDGE_CMD_DEBUG_ACK: 1
     }
 
+    # States of the frame parser
+    PARSE_CMD = 0
+    PARSE_LENGTH = 1
+    PARSE_DATA = 2
+    PARSE_CHECKSUM = 3
+
     def __init__(self):
         self.reset_cmd()
     
+    # Feeds data to the parser. Returns a GBridgeCommand once a frame is complete,
+    # None if more data is needed. total_len - old_len of the returned command
+    # is how much of data it used, the rest belongs to the next frames.
     def init_cmd(self, data):
-        old_len = len(self.curr_data)
-        self.curr_data += data
-        result = self.consume_cmd()
-        if result is not None:
-            result = GBridgeCommand(self.final_data, self.checksum_okay, self.curr_cmd, self.total_len, old_len)
+        old_len = self.total_len
+        self.consume_cmd(data)
+        result = None
+        if self.done:
+            result = GBridgeCommand(memoryview(self.final_data), self.checksum_okay, self.curr_cmd, self.total_len, old_len)
             self.reset_cmd()
         return result
 
+    # Returns the framed command as a bytearray
     def prepare_cmd(data, is_stream):
         if len(data) == 0:
-            return []
+            return bytearray()
 
         cmd = GBridge.GBRIDGE_CMD_DATA_PC
         size_length = 1
@@ -405,51 +420,85 @@ class GBridge:
             cmd = GBridge.GBRIDGE_CMD_STREAM_PC
             size_length = 2
 
-        start = [cmd] + list(len(data).to_bytes(size_length, byteorder='big'))
-        checksum = GBridge.calc_checksum(data)
-
-        return start + data + list(checksum.to_bytes(2, byteorder='big'))
+        out_data = bytearray([cmd])
+        out_data += len(data).to_bytes(size_length, byteorder='big')
+        out_data += data
+        out_data += GBridge.calc_checksum(data).to_bytes(2, byteorder='big')
+        return out_data
            
-    def consume_cmd(self):
-        self.total_len = 0
-        if(len(self.curr_data) > 0):
-            self.curr_cmd = self.curr_data[0]
-        else:
-            return None
-        self.total_len += 1
-        len_length = 0
-        if(self.curr_cmd in GBridge.cmd_lens.keys()):
-            len_length = GBridge.cmd_lens[self.curr_cmd]
-        if(len_length > 0) and (len(self.curr_data) > len_length):
-            self.curr_len = int.from_bytes(self.curr_data[1 : 1 + len_length], byteorder='big')
+    # Resumable parser: each byte is only read once, even when a frame
+    # is split over multiple USB packets, and the checksum is kept updated.
+    def consume_cmd(self, data):
+        pos = 0
+        data_len = len(data)
+        while (pos < data_len) and (not self.done):
+            if self.state == GBridge.PARSE_CMD:
+                self.curr_cmd = data[pos]
+                pos += 1
+                if self.curr_cmd not in GBridge.cmd_lens.keys():
+                    self.done = True
+                else:
+                    self.len_length = GBridge.cmd_lens[self.curr_cmd]
+                    if self.len_length > 0:
+                        self.state = GBridge.PARSE_LENGTH
+                    else:
+                        self.start_data()
+            elif self.state == GBridge.PARSE_LENGTH:
+                taken = min(self.len_length - len(self.len_data), data_len - pos)
+                self.len_data += data[pos:pos + taken]
+                pos += taken
+                if len(self.len_data) == self.len_length:
+                    self.curr_len = int.from_bytes(self.len_data, byteorder='big')
+                    self.start_data()
+            elif self.state == GBridge.PARSE_DATA:
+                taken = min(self.curr_len - self.curr_index, data_len - pos)
+                chunk = data[pos:pos + taken]
+                self.final_data[self.curr_index:self.curr_index + taken] = chunk
+                self.curr_checksum = GBridge.update_checksum(self.curr_checksum, chunk)
+                self.curr_index += taken
+                pos += taken
+                if self.curr_index == self.curr_len:
+                    self.state = GBridge.PARSE_CHECKSUM
+            else:
+                taken = min(GBridge.CHECKSUM_SIZE - len(self.checksum_data), data_len - pos)
+                self.checksum_data += data[pos:pos + taken]
+                pos += taken
+                if len(self.checksum_data) == GBridge.CHECKSUM_SIZE:
+                    self.checksum = int.from_bytes(self.checksum_data, byteorder='big')
+                    self.checksum_okay = self.curr_checksum == self.checksum
+                    self.done = True
+        self.total_len += pos
+
+    def start_data(self):
         if self.curr_cmd in GBridge.fixed_lens.keys():
             self.curr_len = GBridge.fixed_lens[self.curr_cmd]
-        self.total_len += len_length + self.curr_len
-        if(len(self.curr_data) > self.curr_len + len_length):
-            self.final_data = self.curr_data[len_length + 1: self.curr_len + len_length + 1]
-            if(self.curr_cmd not in GBridge.cmd_lens.keys()):
-                return True
-        self.total_len += 2
-        if(len(self.curr_data) > self.curr_len + len_length + 2):
-            self.checksum = int.from_bytes(self.curr_data[self.curr_len + len_length + 1 : self.curr_len + len_length + 1 + 2], byteorder='big')
-            self.checksum_okay = GBridge.calc_checksum(self.final_data) == self.checksum
-            return True
-        return None
+        self.final_data = bytearray(self.curr_len)
+        self.curr_index = 0
+        self.state = GBridge.PARSE_DATA
+        if self.curr_len == 0:
+            self.state = GBridge.PARSE_CHECKSUM
     
+    # 16 bits sum of the bytes. sum() runs over the whole buffer in C,
+    # and the result only needs to be truncated once.
     def calc_checksum(data):
-        checksum = 0
-        for i in range(len(data)):
-            checksum += data[i]
-            checksum &= 0xFFFF
-        return checksum
+        return sum(data) & 0xFFFF
+
+    # Adds data to a partial checksum, for when a buffer comes in pieces
+    def update_checksum(checksum, data):
+        return (checksum + sum(data)) & 0xFFFF
     
     def reset_cmd(self):
+        self.state = GBridge.PARSE_CMD
+        self.done = False
         self.total_len = 0
         self.curr_cmd = None
         self.curr_index = 0
         self.curr_len = 0
-        self.final_data = []
-        self.curr_data = []
+        self.len_length = 0
+        self.len_data = bytearray()
+        self.final_data = bytearray()
+        self.checksum_data = bytearray()
+        self.curr_checksum = 0
         self.checksum = 0
         self.checksum_okay = None
 
@@ -578,6 +627,18 @@ class GBridgeDebugCommands:
         UPDATE_P2P_PORT_CMD: 1027
     }
     
+    # Which info reply each command gets
+    info_replies = {
+        SEND_EEPROM_CMD: CMD_DEBUG_INFO_CFG,
+        GET_NUMBER_STATUS_CMD: CMD_DEBUG_INFO_NUM_STATUS,
+        SEND_IMPL_INFO_CMD: CMD_DEBUG_INFO_IMPL,
+        STATUS_CMD: CMD_DEBUG_INFO_STATUS,
+        SEND_NUMBER_OWN_CMD: CMD_DEBUG_INFO_NUMBER,
+        SEND_NUMBER_OTHER_CMD: CMD_DEBUG_INFO_NUMBER_PEER,
+        SEND_RELAY_TOKEN_CMD: CMD_DEBUG_INFO_RELAY_TOKEN,
+        SEND_GBRIDGE_CFG_CMD: CMD_DEBUG_INFO_GBRIDGE_CFG
+    }
+    
     wants_ack = {
         UPDATE_EEPROM_CMD,
         UPDATE_RELAY_CMD,
@@ -594,14 +655,136 @@ class GBridgeDebugCommands:
         ASK_NUMBER_CMD
     }
 
+# Receive buffer of a connection, filled by read-ahead.
+# TCP data goes into a fixed size ring, UDP datagrams are kept whole.
+# Once high_water bytes are buffered, no more data is read from the socket,
+# so a fast peer can't make it grow without limits.
+class GBridgeRecvBuffer:
+    def __init__(self, is_stream, high_water):
+        self.is_stream = is_stream
+        self.high_water = high_water
+        self.size = 0
+        self.start = 0
+        self.ring = None
+        self.datagrams = None
+        if is_stream:
+            self.ring = bytearray(high_water)
+        else:
+            self.datagrams = deque()
+
+    def __len__(self):
+        return self.size
+
+    def is_full(self):
+        return self.size >= self.high_water
+
+    # Reads from the socket, straight into the free space of the buffer.
+    # Returns the number of bytes read, 0 on EOF (TCP only).
+    def fill_from(self, sock, scratch):
+        if self.is_stream:
+            end = (self.start + self.size) % self.high_water
+            limit = self.high_water
+            if end < self.start:
+                limit = self.start
+            num_bytes = sock.recv_into(memoryview(self.ring)[end:limit])
+            self.size += num_bytes
+            return num_bytes
+        num_bytes, source = sock.recvfrom_into(scratch)
+        self.add_datagram(memoryview(scratch)[:num_bytes], source)
+        # Empty datagrams were still read
+        return num_bytes + 1
+
+    # Adds a datagram which did not come from the socket.
+    # Empty datagrams are dropped: the adapter can't be told about them,
+    # a RECV of 0 bytes means nothing came in.
+    def add_datagram(self, datagram, source):
+        if len(datagram) == 0:
+            return
+        self.datagrams.append((bytes(datagram), source))
+        self.size += len(datagram)
+
+    def copy_out(self, size):
+        if size > self.size:
+            size = self.size
+        end = self.start + size
+        if end <= self.high_water:
+            return bytes(self.ring[self.start:end])
+        return bytes(self.ring[self.start:]) + bytes(self.ring[:end - self.high_water])
+
+    # Returns how many bytes are waiting, and their source, without removing them.
+    # For UDP, only the first datagram is considered.
+    def peek(self):
+        if self.is_stream:
+            return self.size, None
+        datagram, source = self.datagrams[0]
+        return len(datagram), source
+
+    # Returns up to size bytes and their source, and removes them.
+    # For UDP, only the first datagram is considered, and whatever is left of it is dropped.
+    def read(self, size):
+        if self.is_stream:
+            data = self.copy_out(size)
+            self.start = (self.start + len(data)) % self.high_water
+            self.size -= len(data)
+            if self.size == 0:
+                self.start = 0
+            return data, None
+        datagram, source = self.datagrams.popleft()
+        self.size -= len(datagram)
+        return datagram[:size], source
+
+    def has_data(self):
+        if self.is_stream:
+            return self.size > 0
+        return len(self.datagrams) > 0
+
+# State of one of the Game Boy's connections.
+# peer is the address it's connected to, pending_connect the one it's connecting to.
+class GBridgeSocketSlot:
+    __slots__ = ("conn", "sock", "sock_type", "addrtype", "bindport", "listening", "peer", "pending_connect", "connect_race", "failed_connect", "recv_buffer", "recv_closed", "recv_error", "sent_bytes", "received_bytes")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.reset()
+
+    def reset(self):
+        self.sock = None
+        self.sock_type = None
+        self.addrtype = None
+        self.bindport = None
+        self.listening = False
+        self.peer = None
+        self.pending_connect = None
+        self.connect_race = None
+        self.failed_connect = False
+        self.recv_buffer = None
+        self.recv_closed = False
+        self.recv_error = None
+        self.sent_bytes = 0
+        self.received_bytes = 0
+
 class GBridgeSocket:
     MOBILE_SOCKTYPE_TCP = 0
     MOBILE_SOCKTYPE_UDP = 1
     MOBILE_ADDRTYPE_NONE = 0
     MOBILE_ADDRTYPE_IPV4 = 1
     MOBILE_ADDRTYPE_IPV6 = 2
+    # Default size of the socket table, the number of connections the adapter uses
     MOBILE_MAX_CONNECTIONS = 2
     
+    # Errors which mean a non-blocking connect is still going on
+    connect_in_progress_errors = set([errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK])
+    if hasattr(errno, 'WSAEINVAL'):
+        connect_in_progress_errors.add(errno.WSAEINVAL)
+    if hasattr(errno, 'WSAEWOULDBLOCK'):
+        connect_in_progress_errors.add(errno.WSAEWOULDBLOCK)
+    
+    MAX_DATAGRAM_SIZE = 0x10000
+    RECV_HIGH_WATER = 0x10000
+    # How many times a socket is read in one go, at most
+    TCP_READS_BATCH = 16
+    UDP_READS_BATCH = 64
+    
     AUTO_STR = "DEFAULT"
     NULL_STR = "NULL"
     
@@ -699,20 +882,41 @@ class GBridgeSocket:
                 return [type_conn, (port >> 8) & 0xFF, port & 0xFF] + list(address)
         return None
 
-    def __init__(self, user_output):
+    def __init__(self, user_output, recv_high_water=None, max_connections=None):
+        if recv_high_water is None:
+            recv_high_water = GBridgeSocket.RECV_HIGH_WATER
+        if max_connections is None:
+            max_connections = GBridgeSocket.MOBILE_MAX_CONNECTIONS
+        self.recv_high_water = recv_high_water
         self.debug_prints = False
         self.user_output = user_output
         self.conn_data_last = None
         self.print_exception = True
-        self.connect_socket = []
-        self.socket = []
-        self.socket_type = []
-        self.socket_addrtype = []
-        for i in range(GBridgeSocket.MOBILE_MAX_CONNECTIONS):
-            self.socket += [None]
-            self.connect_socket += [None]
-            self.socket_type += [None]
-            self.socket_addrtype += [None]
+        # Optional listener, gets socket_opened/socket_closed calls,
+        # so an event loop can watch the sockets
+        self.socket_events = None
+        # Optional DnsCache, answers the repeated DNS queries
+        self.dns_cache = None
+        # Optional RelayConnectionPool, gives already connected sockets to the relay's CONNECTs
+        self.relay_pool = None
+        # Optional HappyEyeballs, races the CONNECTs to dual-stack hosts over both families
+        self.happy_eyeballs = None
+        # One slot per connection id the Game Boy can use
+        self.slots = [GBridgeSocketSlot(i) for i in range(max_connections)]
+        # Data read ahead of the RECV commands goes in the slots' buffers
+        self.selector = selectors.DefaultSelector()
+        self.recv_scratch = bytearray(GBridgeSocket.MAX_DATAGRAM_SIZE)
+
+    # Returns the slot of the connection data starts with, if it's open
+    def get_open_slot(self, data, min_len):
+        if len(data) < min_len:
+            return None
+        if data[0] >= len(self.slots):
+            return None
+        slot = self.slots[data[0]]
+        if slot.sock is None:
+            return None
+        return slot
     
     def open(self, data):
         if self.debug_prints:
@@ -725,10 +929,11 @@ class GBridgeSocket:
         addrtype = data[2]
         bindport = (data[3] << 8) | (data[4])
         
-        if conn >= GBridgeSocket.MOBILE_MAX_CONNECTIONS:
+        if conn >= len(self.slots):
             return False
         
-        if self.socket[conn] is not None:
+        slot = self.slots[conn]
+        if slot.sock is not None:
             return False
 
         try:
@@ -761,98 +966,269 @@ class GBridgeSocket:
                 self.user_output.set_out(e, self.user_output.EXCEPTION_TAG)
             return False
 
-        self.socket[conn] = sock;
-        self.socket_type[conn] = sock_type
-        self.socket_addrtype[conn] = sock_addrtype
+        slot.sock = sock;
+        slot.sock_type = sock_type
+        slot.addrtype = sock_addrtype
+        slot.bindport = bindport
+        self.register_recv(slot)
+        if self.socket_events is not None:
+            self.socket_events.socket_opened(conn, sock)
         return True;
+
+    # Advances the pending connects, reads ahead and keeps the relay pool filled.
+    # It changes the slots and their buffers, so it must run on the thread
+    # which handles the commands.
+    def service(self):
+        if self.relay_pool is not None:
+            self.relay_pool.maintain()
+        self.update_pending_connects()
+        self.poll_ready()
+
+    # Returns whether the host has socket work it can move forward on its own:
+    # connects still going on, or new data which can go in a buffer.
+    # Data which is already buffered, EOFs and incoming connections wait for the Game Boy.
+    # It only looks at the slots and the selector, so any thread can call it.
+    def has_pending(self):
+        for slot in self.slots:
+            if slot.pending_connect is not None:
+                return True
+        try:
+            events = self.selector.select(0)
+        except (OSError, ValueError):
+            return False
+        for key, _ in events:
+            slot = key.data
+            if (slot.sock is not None) and self.can_read_ahead(slot) and (not slot.recv_buffer.is_full()):
+                return True
+        return False
+
+    def register_recv(self, slot):
+        slot.recv_buffer = GBridgeRecvBuffer(slot.sock_type == socket.SOCK_STREAM, self.recv_high_water)
+        slot.recv_closed = False
+        slot.recv_error = None
+        self.selector.register(slot.sock, selectors.EVENT_READ, slot)
+
+    def unregister_recv(self, slot):
+        try:
+            self.selector.unregister(slot.sock)
+        except (KeyError, ValueError):
+            pass
+        slot.recv_buffer = None
+        slot.recv_closed = False
+        slot.recv_error = None
+
+    # Whether the socket can be read into its buffer.
+    # Listening sockets and TCP sockets which are not connected can't.
+    def can_read_ahead(self, slot):
+        if slot.listening or slot.recv_closed or (slot.recv_error is not None):
+            return False
+        if slot.sock_type == socket.SOCK_STREAM:
+            return slot.peer is not None
+        return True
+
+    # Reads what is available on a socket into its buffer, without blocking.
+    # Stops once the buffer reaches its high-water mark.
+    # UDP sockets are drained until they'd block, so a burst of datagrams
+    # is queued (each one with its source) by a single call.
+    def read_ahead(self, slot, max_reads=None):
+        sock = slot.sock
+        buffer = slot.recv_buffer
+        if max_reads is None:
+            max_reads = GBridgeSocket.TCP_READS_BATCH
+            if not buffer.is_stream:
+                max_reads = GBridgeSocket.UDP_READS_BATCH
+        for i in range(max_reads):
+            if buffer.is_full():
+                return
+            try:
+                num_bytes = buffer.fill_from(sock, self.recv_scratch)
+                if num_bytes == 0:
+                    slot.recv_closed = True
+                    return
+                # Empty datagrams are not buffered
+                if (self.dns_cache is not None) and (not buffer.is_stream) and (num_bytes > 1):
+                    datagram, source = buffer.datagrams[-1]
+                    if self.dns_cache.is_dns_address(source):
+                        self.dns_cache.store_response(datagram, source)
+            except (BlockingIOError, InterruptedError):
+                return
+            except Exception as e:
+                slot.recv_error = e
+                return
+
+    # Fills the buffers of all the sockets which are ready
+    def poll_ready(self, timeout=0):
+        try:
+            events = self.selector.select(timeout)
+        except (OSError, ValueError):
+            return
+        for key, _ in events:
+            slot = key.data
+            if (slot.sock is not None) and self.can_read_ahead(slot):
+                self.read_ahead(slot)
     
     def close(self, data):
         if self.debug_prints:
             self.user_output.set_out("CLOSE", self.user_output.SOCKET_DEBUG_TAG)
-        if(len(data) < 1):
+        slot = self.get_open_slot(data, 1)
+        if slot is None:
             return False
 
-        conn = data[0]
-        
-        if conn >= GBridgeSocket.MOBILE_MAX_CONNECTIONS:
-            return False
-        
-        if self.socket[conn] is None:
-            return False
-
-        #self.socket[conn].shutdown(socket.SHUT_RDWR)
-        self.socket[conn].close()
-
-        self.socket[conn] = None;
-        self.socket_type[conn] = None
-        self.socket_addrtype[conn] = None
+        self.unregister_recv(slot)
+        if self.socket_events is not None:
+            self.socket_events.socket_closed(slot.conn, slot.sock)
+        #slot.sock.shutdown(socket.SHUT_RDWR)
+        slot.sock.close()
+        if slot.connect_race is not None:
+            slot.connect_race.close()
+        slot.reset()
         return True;
     
     def connect(self, data):
         if self.debug_prints:
             self.user_output.set_out("CONNECT", self.user_output.SOCKET_DEBUG_TAG)
-        if(len(data) < 2):
-            return -1
-
-        conn = data[0]
-        
-        if conn >= GBridgeSocket.MOBILE_MAX_CONNECTIONS:
-            return -1
-        
-        if self.socket[conn] is None:
+        slot = self.get_open_slot(data, 2)
+        if slot is None:
             return -1
         
         conn_data = GBridgeSocket.read_addr(data[1:])
         if conn_data is None:
             return -1
         
-        done = False
-        while not done:
-            try:
-                self.socket[conn].connect(conn_data)
-                self.connect_socket[conn] = conn_data
-                done = True
-            except Exception as e:
-                processed = False
-                if isinstance(e, socket.error):
-                    if e.errno == errno.EINPROGRESS:
-                        sleep(0.05)
-                        processed = True
-                    if e.errno == errno.EALREADY:
-                        sleep(0.05)
-                        processed = True
-                    if e.errno == errno.EWOULDBLOCK:
-                        sleep(0.05)
-                        processed = True
-                    if e.errno == errno.EISCONN:
-                        self.connect_socket[conn] = conn_data
-                        done = True
-                        processed = True
-                    if hasattr(errno, 'WSAEINVAL') and (e.errno == errno.WSAEINVAL):
-                        sleep(0.05)
-                        processed = True
-                if not processed:
-                    if self.print_exception:
-                        self.user_output.set_out(e, self.user_output.EXCEPTION_TAG)
-                    return -1
-        return 1
+        # Still completing in the background, just report its state
+        if slot.pending_connect is not None:
+            self.update_pending_connects()
+            return self.connect_state(slot)
+        # Settled by service() after the last CONNECT: report how it went, once
+        if slot.failed_connect or (slot.peer is not None):
+            return self.connect_state(slot)
+
+        if self.use_pooled_socket(slot, conn_data):
+            return 1
+
+        try:
+            result = slot.sock.connect_ex(conn_data)
+        except Exception as e:
+            if self.print_exception:
+                self.user_output.set_out(e, self.user_output.EXCEPTION_TAG)
+            return -1
+
+        if (result == 0) or (result == errno.EISCONN):
+            slot.peer = conn_data
+            return 1
+        in_progress = result in GBridgeSocket.connect_in_progress_errors
+        # Even if this address can't be reached right away, the host's other ones may be
+        if (self.happy_eyeballs is not None) and self.can_swap_socket(slot):
+            slot.connect_race = self.happy_eyeballs.start(slot.sock, conn_data, failed=not in_progress)
+        if in_progress or (slot.connect_race is not None):
+            slot.pending_connect = conn_data
+            if in_progress and (self.socket_events is not None):
+                self.socket_events.socket_connecting(slot.conn, slot.sock)
+            return 0
+        if self.print_exception:
+            self.user_output.set_out(os.strerror(result), self.user_output.EXCEPTION_TAG)
+        return -1
+
+    # Whether the socket of slot can be swapped with one connected elsewhere.
+    # Only done for TCP sockets which did not ask for a specific local port.
+    def can_swap_socket(self, slot):
+        return (slot.sock_type == socket.SOCK_STREAM) and (slot.bindport == 0) and (slot.peer is None)
+
+    # Puts sock, which is connected, in place of the socket of slot
+    def swap_socket(self, slot, sock, conn_data):
+        self.unregister_recv(slot)
+        if self.socket_events is not None:
+            self.socket_events.socket_closed(slot.conn, slot.sock)
+        slot.sock.close()
+        slot.sock = sock
+        slot.peer = conn_data
+        self.register_recv(slot)
+        if self.socket_events is not None:
+            self.socket_events.socket_opened(slot.conn, sock)
+
+    # Swaps the socket of slot with an already connected one from the relay pool, if there is one
+    def use_pooled_socket(self, slot, conn_data):
+        if (self.relay_pool is None) or (not self.can_swap_socket(slot)):
+            return False
+        if (slot.addrtype == socket.AF_INET6) != (len(conn_data) > 2):
+            return False
+        sock = self.relay_pool.take(conn_data)
+        if sock is None:
+            return False
+        self.swap_socket(slot, sock, conn_data)
+        return True
+
+    # 1 if connected, 0 if still in progress, -1 if it failed.
+    # The state is updated by update_pending_connects.
+    def connect_state(self, slot):
+        if slot.pending_connect is not None:
+            return 0
+        if slot.failed_connect:
+            slot.failed_connect = False
+            return -1
+        if slot.peer is not None:
+            return 1
+        return -1
+
+    # Checks, without waiting, whether the pending TCP handshakes are done
+    def update_pending_connects(self):
+        self.update_connect_races()
+        pending_slots = [slot for slot in self.slots if (slot.sock is not None) and (slot.pending_connect is not None) and (slot.connect_race is None)]
+        if len(pending_slots) == 0:
+            return
+        pending_sockets = [slot.sock for slot in pending_slots]
+        try:
+            _, writable, failed = select.select([], pending_sockets, pending_sockets, 0)
+        except Exception:
+            return
+        for slot in pending_slots:
+            sock = slot.sock
+            if (sock not in writable) and (sock not in failed):
+                continue
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error == 0:
+                slot.peer = slot.pending_connect
+            else:
+                slot.failed_connect = True
+                if self.print_exception:
+                    self.user_output.set_out(os.strerror(error), self.user_output.EXCEPTION_TAG)
+            slot.pending_connect = None
+            if self.socket_events is not None:
+                self.socket_events.socket_connected(slot.conn, sock)
+    
+    # Advances the dual-stack connects, see HappyEyeballs
+    def update_connect_races(self):
+        for slot in self.slots:
+            race = slot.connect_race
+            if (slot.sock is None) or (race is None):
+                continue
+            result = race.poll()
+            if result is None:
+                continue
+            original = slot.sock
+            if result is False:
+                slot.failed_connect = True
+                if self.print_exception:
+                    self.user_output.set_out("Could not connect to any of the host's addresses", self.user_output.EXCEPTION_TAG)
+            elif result is original:
+                slot.peer = slot.pending_connect
+            else:
+                self.swap_socket(slot, result, slot.pending_connect)
+            slot.pending_connect = None
+            slot.connect_race = None
+            if (self.socket_events is not None) and (slot.sock is original):
+                self.socket_events.socket_connected(slot.conn, original)
     
     def listen(self, data):
         if self.debug_prints:
             self.user_output.set_out("LISTEN", self.user_output.SOCKET_DEBUG_TAG)
-        if(len(data) < 1):
-            return False
-
-        conn = data[0]
-        
-        if conn >= GBridgeSocket.MOBILE_MAX_CONNECTIONS:
-            return False
-        
-        if self.socket[conn] is None:
+        slot = self.get_open_slot(data, 1)
+        if slot is None:
             return False
         
         try:
-            self.socket[conn].listen(1)
+            slot.sock.listen(1)
+            slot.listening = True
         except Exception as e:
             if self.print_exception:
                 self.user_output.set_out(e, self.user_output.EXCEPTION_TAG)
@@ -862,23 +1238,24 @@ class GBridgeSocket:
     def accept(self, data):
         if self.debug_prints:
             self.user_output.set_out("ACCEPT", self.user_output.SOCKET_DEBUG_TAG)
-        if(len(data) < 1):
-            return False
-
-        conn = data[0]
-        
-        if conn >= GBridgeSocket.MOBILE_MAX_CONNECTIONS:
-            return False
-        
-        if self.socket[conn] is None:
+        slot = self.get_open_slot(data, 1)
+        if slot is None:
             return False
         
         try:
-            new_sock = self.socket[conn].accept()
+            new_sock, new_addr = slot.sock.accept()
             new_sock.setblocking(False)
-            #self.socket[conn].shutdown(socket.SHUT_RDWR)
-            self.socket[conn].close()
-            self.socket[conn] = new_sock
+            self.unregister_recv(slot)
+            if self.socket_events is not None:
+                self.socket_events.socket_closed(slot.conn, slot.sock)
+            #slot.sock.shutdown(socket.SHUT_RDWR)
+            slot.sock.close()
+            slot.sock = new_sock
+            slot.listening = False
+            slot.peer = new_addr
+            self.register_recv(slot)
+            if self.socket_events is not None:
+                self.socket_events.socket_opened(slot.conn, new_sock)
         except Exception as e:
             if self.print_exception:
                 self.user_output.set_out(e, self.user_output.EXCEPTION_TAG)
@@ -888,73 +1265,75 @@ class GBridgeSocket:
     def send(self, data, stream):
         if self.debug_prints:
             self.user_output.set_out("SEND", self.user_output.SOCKET_DEBUG_TAG)
-        if(len(data) < 2):
-            return -1
-        
-        conn = data[0]
-        
-        if conn >= GBridgeSocket.MOBILE_MAX_CONNECTIONS:
-            return -1
-        
-        if self.socket[conn] is None:
+        slot = self.get_open_slot(data, 2)
+        if slot is None:
             return -1
         
         conn_data = GBridgeSocket.read_addr(data[1:])
         #if conn_data is None:
-        #    conn_data = self.connect_socket[conn]
+        #    conn_data = slot.peer
+        
+        if (self.dns_cache is not None) and (slot.sock_type == socket.SOCK_DGRAM):
+            destination = conn_data
+            if destination is None:
+                destination = slot.peer
+            if self.dns_cache.is_dns_address(destination):
+                answer = self.dns_cache.query(stream, destination)
+                if answer is not None:
+                    slot.recv_buffer.add_datagram(answer, destination)
+                    slot.sent_bytes += len(stream)
+                    return len(stream)
         
         try:
             if conn_data is None:
-                sent = self.socket[conn].send(bytes(stream), 0)
+                sent = slot.sock.send(stream, 0)
             else:
-                sent = self.socket[conn].sendto(bytes(stream), 0, conn_data)
+                sent = slot.sock.sendto(stream, 0, conn_data)
         except Exception as e:
             if self.print_exception:
                 self.user_output.set_out(e, self.user_output.EXCEPTION_TAG)
             return -1
+        slot.sent_bytes += sent
         return int(sent)
     
     def run_recv(self, data):
-        if(len(data) < 4):
+        slot = self.get_open_slot(data, 4)
+        if slot is None:
             return 0
 
         size = (data[1] << 8) | data[2]
         
-        conn = data[0]
-        
         is_valid = data[3] == 1
-        
-        if conn >= GBridgeSocket.MOBILE_MAX_CONNECTIONS:
-            return 0
-        
-        if self.socket[conn] is None:
-            return 0
 
-        try:
-            if is_valid:
-                result = self.socket[conn].recvfrom(size)
-            else:
-                result = self.socket[conn].recvfrom(1, socket.MSG_PEEK)
-            data_recv = list(result[0])
-            source_recv = result[1]
-            # Make sure at least one byte is in the buffer
-            if(len(data_recv) == 0):
-                if self.socket_type[conn] == socket.SOCK_STREAM:
-                    return -2
-        except Exception as e:
-            processed = False
-            if isinstance(e, socket.error):
-                if e.errno == errno.EWOULDBLOCK:
-                    return 0
-                    processed = True
-            if not processed:
+        # Nothing buffered, read the socket directly, without waiting.
+        # That's a single syscall when nothing came in, instead of a select and then the read.
+        buffer = slot.recv_buffer
+        if (not buffer.has_data()) and self.can_read_ahead(slot):
+            self.read_ahead(slot)
+
+        if not buffer.has_data():
+            if slot.recv_error is not None:
                 if self.print_exception:
-                    self.user_output.set_out(e, self.user_output.EXCEPTION_TAG)
+                    self.user_output.set_out(slot.recv_error, self.user_output.EXCEPTION_TAG)
+                slot.recv_error = None
                 return -1
+            # Make sure at least one byte is in the buffer
+            if slot.recv_closed:
+                return -2
+            return 0
+
+        # Peeks report how much is waiting, whatever size they ask for.
+        # Empty datagrams are never buffered, so that's at least 1.
+        if is_valid:
+            data_recv, source_recv = buffer.read(size)
+            slot.received_bytes += len(data_recv)
+            length = len(data_recv)
+        else:
+            data_recv = b""
+            length, source_recv = buffer.peek()
+            length = min(length, 0xFFFF)
 
-        if not is_valid:
-            return [[], [(len(data_recv) >> 8) & 0xFF, len(data_recv) & 0xFF] + GBridgeSocket.write_addr(source_recv)]
-        return [data_recv, [(len(data_recv) >> 8) & 0xFF, len(data_recv) & 0xFF] + GBridgeSocket.write_addr(source_recv)]
+        return [data_recv, [(length >> 8) & 0xFF, length & 0xFF] + GBridgeSocket.write_addr(source_recv)]
     
     def recv(self, data):
         if self.debug_prints:
@@ -964,7 +1343,6 @@ class GBridgeSocket:
             data = result[0]
             rest = result[1]
         except TypeError:
-            data = []
+            data = b""
             rest = [(result >> 8) & 0xFF, result & 0xFF] + GBridgeSocket.write_addr([])
         return [data, rest]
-
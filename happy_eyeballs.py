@@ -0,0 +1,161 @@
+import time
+import select
+import socket
+from gbridge import GBridgeSocket
+
+# Dual-stack TCP connects (Happy Eyeballs, RFC 8305).
+# The Game Boy connects to one address, in one family. If that address belongs to
+# a host the bridge knows in both families, the other addresses of the host are
+# tried too, alternating families, one every attempt_delay seconds (or right away
+# when the last attempt failed). The first connection which succeeds is kept.
+# Hosts are added with add_host (resolved with getaddrinfo every resolve_interval
+# seconds, when needed) or add_addresses (already resolved).
+class HappyEyeballs:
+    ATTEMPT_DELAY = 0.25
+
+    def __init__(self, attempt_delay=ATTEMPT_DELAY, resolve_interval=300.0):
+        self.attempt_delay = attempt_delay
+        self.resolve_interval = resolve_interval
+        self.hosts = []
+        self.last_resolve = None
+        # (address, port) -> all the addresses of the same host
+        self.alternates = dict()
+        self.static_alternates = dict()
+        self.races = 0
+        self.wins_by_alternate = 0
+
+    def add_host(self, host, port):
+        self.hosts += [(host, port)]
+        self.last_resolve = None
+
+    # addresses is a list of (address, port) tuples, in both families
+    def add_addresses(self, addresses):
+        addresses = [tuple(elem[:2]) for elem in addresses]
+        for address in addresses:
+            self.static_alternates[address] = addresses
+        self.alternates.update(self.static_alternates)
+
+    def resolve(self):
+        alternates = dict(self.static_alternates)
+        for host, port in self.hosts:
+            try:
+                infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            except OSError:
+                continue
+            addresses = []
+            for info in infos:
+                address = tuple(info[4][:2])
+                if address not in addresses:
+                    addresses += [address]
+            for address in addresses:
+                alternates[address] = addresses
+        self.alternates = alternates
+        self.last_resolve = time.monotonic()
+
+    # Returns the addresses to try after address, alternating families, or None
+    # if there is nothing in the other family
+    def get_candidates(self, address):
+        if (len(self.hosts) > 0) and ((self.last_resolve is None) or ((time.monotonic() - self.last_resolve) > self.resolve_interval)):
+            self.resolve()
+        address = tuple(address[:2])
+        addresses = self.alternates.get(address)
+        if addresses is None:
+            return None
+        same_family = [elem for elem in addresses if (":" in elem[0]) == (":" in address[0]) and elem != address]
+        other_family = [elem for elem in addresses if (":" in elem[0]) != (":" in address[0])]
+        if len(other_family) == 0:
+            return None
+        candidates = []
+        for i in range(max(len(same_family), len(other_family))):
+            if i < len(other_family):
+                candidates += [other_family[i]]
+            if i < len(same_family):
+                candidates += [same_family[i]]
+        return candidates
+
+    def get_stats(self):
+        return {"races": self.races, "wins_by_alternate": self.wins_by_alternate}
+
+    # sock already started connecting to address (or failed to, if failed is set).
+    # Returns a DualStackConnect racing the other addresses of its host, or None.
+    def start(self, sock, address, failed=False):
+        candidates = self.get_candidates(address)
+        if candidates is None:
+            return None
+        self.races += 1
+        return DualStackConnect(self, sock, candidates, failed)
+
+# A race between the original socket of a CONNECT and the ones to the other addresses
+class DualStackConnect:
+    def __init__(self, happy_eyeballs, sock, candidates, failed):
+        self.happy_eyeballs = happy_eyeballs
+        self.original = None
+        if not failed:
+            self.original = sock
+        self.candidates = candidates
+        self.attempts = []
+        self.next_start = time.monotonic() + happy_eyeballs.attempt_delay
+        if failed:
+            self.next_start = 0
+
+    def start_next(self, now):
+        while len(self.candidates) > 0:
+            address = self.candidates.pop(0)
+            family = socket.AF_INET
+            if ":" in address[0]:
+                family = socket.AF_INET6
+                address = (address[0], address[1], 0, 0)
+            try:
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                result = sock.connect_ex(address)
+            except OSError:
+                continue
+            if (result == 0) or (result in GBridgeSocket.connect_in_progress_errors):
+                self.attempts += [sock]
+                self.next_start = now + self.happy_eyeballs.attempt_delay
+                return
+            sock.close()
+
+    # Returns the socket which connected, False if all of them failed,
+    # or None if the race is still going on
+    def poll(self):
+        now = time.monotonic()
+        sockets = list(self.attempts)
+        if self.original is not None:
+            sockets = [self.original] + sockets
+        if len(sockets) > 0:
+            try:
+                _, writable, failed = select.select([], sockets, sockets, 0)
+            except (OSError, ValueError):
+                writable = []
+                failed = []
+            for sock in sockets:
+                if (sock not in writable) and (sock not in failed):
+                    continue
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    if sock is not self.original:
+                        self.attempts.remove(sock)
+                        self.happy_eyeballs.wins_by_alternate += 1
+                    self.close()
+                    return sock
+                if sock is self.original:
+                    self.original = None
+                else:
+                    self.attempts.remove(sock)
+                    sock.close()
+                # Don't wait to try the next one
+                self.next_start = now
+        if (len(self.candidates) > 0) and (now >= self.next_start):
+            self.start_next(now)
+        if (self.original is None) and (len(self.attempts) == 0) and (len(self.candidates) == 0):
+            return False
+        return None
+
+    # Closes the attempts which did not win. The original socket belongs to GBridgeSocket.
+    def close(self):
+        for sock in self.attempts:
+            sock.close()
+        self.attempts = []
+        self.candidates = []
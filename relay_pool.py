@@ -0,0 +1,173 @@
+import time
+import select
+import socket
+import threading
+from gbridge import GBridgeSocket
+
+# Keeps a few TCP connections to the relay server ready, so the Game Boy's CONNECT
+# to the relay can get one right away, instead of waiting for a new handshake.
+# The relay is relay_address (a (host, port) tuple), or the address of the first
+# TCP CONNECT to port (31227 by default) if that's None.
+# Up to size connections are kept. They're checked on each maintain() call:
+# the ones the server closed, and the ones idle for more than max_idle seconds,
+# are dropped and replaced. If the relay can't be reached, new attempts are spaced out,
+# up to max_retry_delay seconds apart.
+# The pool is only refilled while the relay is in use: once no CONNECT to it was
+# seen for max_idle seconds, no new connections are opened until the next one.
+class RelayConnectionPool:
+    RELAY_PORT = 31227
+    CONNECT_TIMEOUT = 5.0
+
+    def __init__(self, relay_address=None, port=RELAY_PORT, size=2, max_idle=30.0, check_interval=1.0, max_retry_delay=60.0):
+        self.relay_address = relay_address
+        self.port = port
+        self.size = size
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self.max_retry_delay = max_retry_delay
+        self.retry_delay = 0
+        self.next_attempt = 0
+        self.lock = threading.Lock()
+        # Connected sockets, with the time they connected
+        self.ready = []
+        # Sockets still connecting, with the time they started
+        self.connecting = []
+        self.last_check = 0
+        self.last_used = None
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def is_relay_address(self, address):
+        if self.relay_address is not None:
+            return tuple(address[:2]) == tuple(self.relay_address[:2])
+        return address[1] == self.port
+
+    # Returns a connected socket to address, or None if none is ready.
+    # Also starts keeping connections to address ready, if it's the relay.
+    def take(self, address):
+        if not self.is_relay_address(address):
+            return None
+        with self.lock:
+            if self.relay_address is None:
+                self.relay_address = tuple(address)
+            self.last_used = time.monotonic()
+            self.check_ready()
+            # Refill the pool on the next maintain() call
+            self.last_check = 0
+            if len(self.ready) > 0:
+                sock, connected = self.ready.pop(0)
+                self.hits += 1
+                return sock
+            self.misses += 1
+        self.maintain()
+        return None
+
+    def new_socket(self):
+        family = socket.AF_INET
+        if len(self.relay_address) > 2:
+            family = socket.AF_INET6
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        result = sock.connect_ex(self.relay_address)
+        if (result != 0) and (result not in GBridgeSocket.connect_in_progress_errors):
+            sock.close()
+            return None
+        return sock
+
+    # Moves the connections which are done to ready, and drops the failed ones
+    def update_connecting(self):
+        if len(self.connecting) == 0:
+            return
+        sockets = [elem[0] for elem in self.connecting]
+        try:
+            _, writable, failed = select.select([], sockets, sockets, 0)
+        except (OSError, ValueError):
+            return
+        now = time.monotonic()
+        still_connecting = []
+        for sock, started in self.connecting:
+            if (sock in writable) or (sock in failed):
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    self.ready += [(sock, now)]
+                    self.retry_delay = 0
+                else:
+                    sock.close()
+                    self.connect_failed(now)
+            elif now - started > RelayConnectionPool.CONNECT_TIMEOUT:
+                sock.close()
+                self.connect_failed(now)
+            else:
+                still_connecting += [(sock, started)]
+        self.connecting = still_connecting
+
+    def connect_failed(self, now):
+        self.retry_delay = min(max(self.retry_delay * 2, self.check_interval), self.max_retry_delay)
+        self.next_attempt = now + self.retry_delay
+
+    # Drops the connections which were closed by the server, or were idle for too long.
+    # Data sent by the server is left where it is, for the Game Boy to read.
+    def check_ready(self):
+        if len(self.ready) == 0:
+            return
+        now = time.monotonic()
+        try:
+            readable, _, failed = select.select([elem[0] for elem in self.ready], [], [elem[0] for elem in self.ready], 0)
+        except (OSError, ValueError):
+            readable = []
+            failed = []
+        still_ready = []
+        for sock, connected in self.ready:
+            alive = (now - connected) <= self.max_idle
+            if alive and (sock in failed):
+                alive = False
+            if alive and (sock in readable):
+                try:
+                    alive = len(sock.recv(1, socket.MSG_PEEK)) > 0
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError:
+                    alive = False
+            if alive:
+                still_ready += [(sock, connected)]
+            else:
+                self.evicted += 1
+                sock.close()
+        self.ready = still_ready
+
+    # Checks the connections, and opens new ones to fill the pool.
+    # Cheap when called often: the work is only done every check_interval seconds.
+    def maintain(self):
+        with self.lock:
+            if self.relay_address is None:
+                return
+            now = time.monotonic()
+            if (now - self.last_check) < self.check_interval:
+                return
+            self.last_check = now
+            self.update_connecting()
+            self.check_ready()
+            if now < self.next_attempt:
+                return
+            if (self.last_used is None) or ((now - self.last_used) > self.max_idle):
+                return
+            for i in range(self.size - len(self.ready) - len(self.connecting)):
+                try:
+                    sock = self.new_socket()
+                except OSError:
+                    sock = None
+                if sock is None:
+                    self.connect_failed(now)
+                    break
+                self.connecting += [(sock, now)]
+
+    def close(self):
+        with self.lock:
+            for sock, _ in self.ready + self.connecting:
+                sock.close()
+            self.ready = []
+            self.connecting = []
+
+    def get_stats(self):
+        return {"ready": len(self.ready), "connecting": len(self.connecting), "hits": self.hits, "misses": self.misses, "evicted": self.evicted}
@@ -25,6 +25,7 @@
 
 #include "tusb.h"
 #include "usb_descriptors.h"
+#include "pico/unique_id.h"
 
 /* A combination of interfaces must have a unique product id, since PC will save device driver after the first plug.
  * Same VID/PID with different interface e.g MSC (first), then CDC (later) will possibly cause system error on PC.
@@ -195,13 +196,17 @@ char const* string_desc_arr [] =
   (const char[]) { 0x09, 0x04 }, // 0: is supported language is English (0x0409)
   "stacksmashing",                     // 1: Manufacturer
   "Mobile GB Adapter",              // 2: Product
-  "1",                      // 3: Serials, should use chip ID
+  "1",                      // 3: Serials, replaced by the chip ID
   "TinyUSB CDC",                 // 4: CDC Interface
   "TinyUSB WebUSB"               // 5: Vendor Interface
 };
 
 static uint16_t _desc_str[32];
 
+#define SERIAL_STRING_INDEX 3
+// Chip ID, so multiple adapters on the same host can be told apart
+static char serial_str[(2 * PICO_UNIQUE_BOARD_ID_SIZE_BYTES) + 1];
+
 // Invoked when received GET STRING DESCRIPTOR request
 // Application return pointer to descriptor, whose contents must exist long enough for transfer to complete
 uint16_t const* tud_descriptor_string_cb(uint8_t index, uint16_t langid)
@@ -222,6 +227,11 @@ uint16_t const* tud_descriptor_string_cb(uint8_t index, uint16_t langid)
     if ( !(index < sizeof(string_desc_arr)/sizeof(string_desc_arr[0])) ) return NULL;
 
     const char* str = string_desc_arr[index];
+    if ( index == SERIAL_STRING_INDEX )
+    {
+      if ( !serial_str[0] ) pico_get_unique_board_id_string(serial_str, sizeof(serial_str));
+      str = serial_str;
+    }
 
     // Cap at max char
     chr_count = strlen(str);
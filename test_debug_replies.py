@@ -0,0 +1,91 @@
+import unittest
+from gbridge import GBridge, GBridgeDebugCommands
+from usb_pico_interface import UserOutput, SocketThread, OutboundQueue, DebugBatch
+
+DEBUG_TRANSFER_FLAG = 0x80
+
+# Keeps what would be printed
+class RecordingOutput(UserOutput):
+    def __init__(self):
+        self.lines = []
+
+    def set_out(self, string, tag, end='\n'):
+        self.lines += [(tag, string)]
+
+def make_frame(cmd, len_length, payload, checksum_error=0):
+    frame = bytes([cmd])
+    if len_length > 0:
+        frame += len(payload).to_bytes(len_length, byteorder='big')
+    frame += bytes(payload)
+    return frame + ((GBridge.calc_checksum(payload) + checksum_error) & 0xFFFF).to_bytes(2, byteorder='big')
+
+def make_info(info_type, payload, checksum_error=0):
+    return make_frame(GBridge.GBRIDGE_CMD_DEBUG_INFO, 2, [info_type] + payload, checksum_error)
+
+def make_ack(command_id):
+    return make_frame(GBridge.GBRIDGE_CMD_DEBUG_ACK, 0, [command_id])
+
+# A packet of the Pico, as it comes from the USB link
+def make_debug_packet(data):
+    return bytes([DEBUG_TRANSFER_FLAG | len(data)]) + data
+
+class GBridgeParserTest(unittest.TestCase):
+    def test_frame_split_anywhere(self):
+        frame = make_frame(GBridge.GBRIDGE_CMD_DATA, 1, [0x9F, 1, 2, 3, 4])
+        for split in range(1, len(frame)):
+            parser = GBridge()
+            self.assertIsNone(parser.init_cmd(memoryview(frame)[:split]))
+            command = parser.init_cmd(memoryview(frame)[split:])
+            self.assertIsNotNone(command)
+            self.assertTrue(command.success_checksum)
+            self.assertEqual(bytes(command.data), bytes([1, 2, 3, 4]))
+            self.assertEqual(command.total_len - command.old_len, len(frame) - split)
+
+    def test_checksum_mismatch_is_answered_and_parsing_goes_on(self):
+        data = make_frame(GBridge.GBRIDGE_CMD_DATA, 1, [0x9F, 1], checksum_error=1) + make_frame(GBridge.GBRIDGE_CMD_DATA, 1, [0x9F, 2])
+        parser = GBridge()
+        command = parser.init_cmd(data)
+        self.assertFalse(command.success_checksum)
+        self.assertEqual(command.response_cmd, GBridge.GBRIDGE_CMD_DATA_FAIL | GBridge.GBRIDGE_CMD_REPLY_F)
+        command = parser.init_cmd(memoryview(data)[command.total_len - command.old_len:])
+        self.assertTrue(command.success_checksum)
+        self.assertEqual(bytes(command.data), bytes([2]))
+
+class DebugRepliesTest(unittest.TestCase):
+    def setUp(self):
+        self.user_output = RecordingOutput()
+        self.socket_thread = SocketThread(self.user_output, start_thread=False)
+
+    def start_batch(self, commands):
+        batch = DebugBatch(commands)
+        batch.prepare(OutboundQueue(self.user_output))
+        self.socket_thread.debug_batches += [batch]
+        return batch
+
+    def feed(self, data):
+        self.socket_thread.process_data(make_debug_packet(data), dict(), dict())
+
+    def test_reply_split_across_packets(self):
+        batch = self.start_batch([(GBridgeDebugCommands.STATUS_CMD, None)])
+        frame = make_info(GBridgeDebugCommands.CMD_DEBUG_INFO_STATUS, [3, 1])
+        self.feed(frame[:4])
+        self.assertFalse(batch.is_done())
+        self.feed(frame[4:])
+        self.assertEqual(batch.wait(0), [bytes([3, 1])])
+        self.assertEqual(self.socket_thread.debug_batches, [])
+
+    def test_replies_share_a_packet(self):
+        batch = self.start_batch([(GBridgeDebugCommands.STOP_CMD, None), (GBridgeDebugCommands.STATUS_CMD, None), (GBridgeDebugCommands.SEND_NUMBER_OWN_CMD, None)])
+        self.feed(make_ack(GBridgeDebugCommands.STOP_CMD) + make_info(GBridgeDebugCommands.CMD_DEBUG_INFO_STATUS, [0, 1]) + make_info(GBridgeDebugCommands.CMD_DEBUG_INFO_NUMBER, list(b"0901\0")))
+        self.assertEqual(batch.wait(0), [True, bytes([0, 1]), b"0901\0"])
+
+    def test_reply_with_bad_checksum_is_not_taken(self):
+        batch = self.start_batch([(GBridgeDebugCommands.STATUS_CMD, None)])
+        self.feed(make_info(GBridgeDebugCommands.CMD_DEBUG_INFO_STATUS, [3, 1], checksum_error=1))
+        self.assertFalse(batch.is_done())
+        self.assertIn((self.user_output.PACKET_ERROR_TAG, "CHECKSUM ERROR!"), self.user_output.lines)
+        self.feed(make_info(GBridgeDebugCommands.CMD_DEBUG_INFO_STATUS, [3, 1]))
+        self.assertEqual(batch.wait(0), [bytes([3, 1])])
+
+if __name__ == "__main__":
+    unittest.main()
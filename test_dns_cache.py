@@ -0,0 +1,104 @@
+import time
+import struct
+import socket
+import threading
+import unittest
+from gbridge import GBridgeSocket
+from dns_cache import DnsCache
+from usb_pico_interface import UserOutput
+
+# Answers every A query with a single record, whose TTL is ttl
+class FakeResolver:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.served = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.address = self.sock.getsockname()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                query, address = self.sock.recvfrom(0x200)
+            except OSError:
+                return
+            self.served += 1
+            question_end = DnsCache.skip_name(query, DnsCache.HEADER_SIZE) + 4
+            answer = query[:2] + struct.pack(">HHHHH", 0x8180, 1, 1, 0, 0) + query[DnsCache.HEADER_SIZE:question_end]
+            answer += b"\xc0\x0c" + query[question_end - 4:question_end] + struct.pack(">IH", self.ttl, 4) + bytes([10, 0, 0, self.served & 0xFF])
+            self.sock.sendto(answer, address)
+
+    def close(self):
+        self.sock.close()
+
+def make_query(name, query_id, record_type=1):
+    encoded_name = b"".join(bytes([len(label)]) + label for label in name.split(b".")) + b"\0"
+    return struct.pack(">HHHHHH", query_id, 0x0100, 1, 0, 0, 0) + encoded_name + struct.pack(">HH", record_type, 1)
+
+class DnsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.resolver = FakeResolver(1)
+        self.bridge_sockets = GBridgeSocket(UserOutput())
+        self.bridge_sockets.dns_cache = DnsCache([self.resolver.address], max_entries=2)
+        self.assertTrue(self.bridge_sockets.open([0, GBridgeSocket.MOBILE_SOCKTYPE_UDP, GBridgeSocket.MOBILE_ADDRTYPE_IPV4, 0, 0]))
+
+    def tearDown(self):
+        self.bridge_sockets.close([0])
+        self.resolver.close()
+
+    def ask(self, resolver, name, query_id, record_type=1):
+        port = resolver.address[1]
+        address = [GBridgeSocket.MOBILE_ADDRTYPE_IPV4, port >> 8, port & 0xFF, 127, 0, 0, 1]
+        self.assertGreater(self.bridge_sockets.send([0] + address, make_query(name, query_id, record_type)), 0)
+        for i in range(100):
+            answer = self.bridge_sockets.recv([0, 2, 0, 1])[0]
+            if len(answer) > 0:
+                self.assertEqual(struct.unpack_from(">H", answer, 0)[0], query_id)
+                return answer
+            time.sleep(0.01)
+        self.fail("no answer")
+
+    def test_repeated_query_is_answered_from_cache(self):
+        first = self.ask(self.resolver, b"example.com", 1)
+        second = self.ask(self.resolver, b"EXAMPLE.com", 2)
+        self.assertEqual(self.resolver.served, 1)
+        self.assertEqual(first[2:], second[2:])
+
+    def test_answer_expires_with_ttl(self):
+        self.ask(self.resolver, b"example.com", 1)
+        time.sleep(1.1)
+        self.ask(self.resolver, b"example.com", 2)
+        self.assertEqual(self.resolver.served, 2)
+
+    def test_least_recently_used_is_evicted(self):
+        self.ask(self.resolver, b"a.com", 1)
+        self.ask(self.resolver, b"b.com", 2)
+        self.ask(self.resolver, b"a.com", 3)
+        self.ask(self.resolver, b"c.com", 4)
+        self.assertEqual(self.resolver.served, 3)
+        self.ask(self.resolver, b"a.com", 5)
+        self.assertEqual(self.resolver.served, 3)
+        self.ask(self.resolver, b"b.com", 6)
+        self.assertEqual(self.resolver.served, 4)
+
+    # Only the name is case insensitive: type 65 (HTTPS) is not type 97
+    def test_type_is_not_lowercased(self):
+        self.ask(self.resolver, b"example.com", 1, record_type=65)
+        self.ask(self.resolver, b"example.com", 2, record_type=97)
+        self.assertEqual(self.resolver.served, 2)
+
+    def test_other_servers_are_not_cached(self):
+        other = FakeResolver(60)
+        try:
+            self.ask(other, b"example.com", 1)
+            self.ask(other, b"example.com", 2)
+            self.assertEqual(other.served, 2)
+            self.assertEqual(self.bridge_sockets.dns_cache.get_stats()["entries"], 0)
+        finally:
+            other.close()
+
+if __name__ == "__main__":
+    unittest.main()
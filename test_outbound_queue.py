@@ -0,0 +1,59 @@
+import time
+import unittest
+from usb_pico_interface import UserOutput, OutboundQueue
+
+DEBUG_FLAGS = 0xC0
+
+# Whether each packet popped from out_queue is a debug one, until it's empty
+def pop_kinds(out_queue):
+    kinds = []
+    while len(out_queue) > 0:
+        out_buf, num_elems = out_queue.pop_packet()
+        kinds += [(out_buf[0] & DEBUG_FLAGS) == DEBUG_FLAGS]
+    return kinds
+
+class OutboundQueueTest(unittest.TestCase):
+    def fill(self, out_queue, data_packets, debug_packets):
+        out_queue.add_data(bytes(OutboundQueue.MAX_PACKET_DATA * data_packets))
+        out_queue.add_debug([[1, 2, 3]] * debug_packets)
+
+    def test_packets_are_shared_by_weight(self):
+        out_queue = OutboundQueue(UserOutput(), debug_latency_target=None)
+        self.fill(out_queue, 8, 2)
+        self.assertEqual(pop_kinds(out_queue), ([False] * 4 + [True]) * 2)
+        self.assertEqual(out_queue.get_stats()["debug_late_packets"], 0)
+
+    def test_idle_channel_does_not_bank_turns(self):
+        out_queue = OutboundQueue(UserOutput(), debug_latency_target=None)
+        out_queue.add_data(bytes(OutboundQueue.MAX_PACKET_DATA * 6))
+        self.assertEqual(pop_kinds(out_queue), [False] * 6)
+        self.fill(out_queue, 4, 1)
+        self.assertEqual(pop_kinds(out_queue), [False] * 4 + [True])
+
+    def test_late_debug_packet_goes_next(self):
+        out_queue = OutboundQueue(UserOutput(), debug_latency_target=0.01)
+        self.fill(out_queue, 4, 1)
+        time.sleep(0.02)
+        self.assertEqual(pop_kinds(out_queue), [True] + [False] * 4)
+        stats = out_queue.get_stats()
+        self.assertEqual(stats["debug_late_packets"], 1)
+        self.assertGreaterEqual(stats["max_debug_wait"], 0.01)
+
+    def test_zero_weights_give_data_priority(self):
+        out_queue = OutboundQueue(UserOutput(), data_weight=0, debug_weight=0, debug_latency_target=None)
+        self.fill(out_queue, 3, 2)
+        self.assertEqual(pop_kinds(out_queue), [False] * 3 + [True] * 2)
+
+    def test_data_is_cut_into_packets(self):
+        out_queue = OutboundQueue(UserOutput())
+        out_queue.add_data(bytes(range(40)))
+        out_queue.add_data(bytes(range(40, 80)))
+        out_buf, num_elems = out_queue.pop_packet()
+        self.assertEqual(num_elems, OutboundQueue.MAX_PACKET_DATA)
+        self.assertEqual(out_buf, bytes([OutboundQueue.MAX_PACKET_DATA]) + bytes(range(OutboundQueue.MAX_PACKET_DATA)))
+        out_buf, num_elems = out_queue.pop_packet()
+        self.assertEqual(out_buf, bytes([80 - OutboundQueue.MAX_PACKET_DATA]) + bytes(range(OutboundQueue.MAX_PACKET_DATA, 80)))
+        self.assertEqual(len(out_queue), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import time
+import socket
+import unittest
+from gbridge import GBridgeSocket
+from relay_pool import RelayConnectionPool
+from usb_pico_interface import UserOutput
+
+class RelayPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(8)
+        self.port = self.server.getsockname()[1]
+        self.pool = RelayConnectionPool(port=self.port, check_interval=0)
+        self.bridge_sockets = GBridgeSocket(UserOutput())
+        self.bridge_sockets.relay_pool = self.pool
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+
+    def connect(self):
+        address = [GBridgeSocket.MOBILE_ADDRTYPE_IPV4, self.port >> 8, self.port & 0xFF, 127, 0, 0, 1]
+        self.assertTrue(self.bridge_sockets.open([0, GBridgeSocket.MOBILE_SOCKTYPE_TCP, GBridgeSocket.MOBILE_ADDRTYPE_IPV4, 0, 0]))
+        result = self.bridge_sockets.connect([0] + address)
+        for i in range(100):
+            if result != 0:
+                break
+            time.sleep(0.01)
+            self.bridge_sockets.service()
+            result = self.bridge_sockets.connect([0] + address)
+        return result
+
+    def wait_ready(self):
+        for i in range(100):
+            self.pool.maintain()
+            if self.pool.get_stats()["ready"] > 0:
+                return
+            time.sleep(0.01)
+        self.fail("the pool never connected")
+
+    # The pool must work on its own, without HappyEyeballs
+    def test_pooled_socket_without_happy_eyeballs(self):
+        self.assertIsNone(self.bridge_sockets.happy_eyeballs)
+        self.assertEqual(self.connect(), 1)
+        self.assertEqual(self.pool.get_stats()["misses"], 1)
+        self.bridge_sockets.close([0])
+
+        self.wait_ready()
+        self.assertEqual(self.connect(), 1)
+        self.assertEqual(self.pool.get_stats()["hits"], 1)
+        self.bridge_sockets.close([0])
+
+    # Once the relay is not used anymore, the pool must not keep connecting to it
+    def test_no_refill_once_idle(self):
+        self.pool.max_idle = 0.2
+        self.assertEqual(self.connect(), 1)
+        self.bridge_sockets.close([0])
+        self.wait_ready()
+        time.sleep(0.3)
+        for i in range(10):
+            self.pool.maintain()
+            time.sleep(0.01)
+        stats = self.pool.get_stats()
+        self.assertEqual(stats["ready"] + stats["connecting"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
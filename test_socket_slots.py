@@ -0,0 +1,111 @@
+import time
+import socket
+import unittest
+from gbridge import GBridgeSocket, GBridgeRecvBuffer
+from usb_pico_interface import UserOutput
+
+def make_address(address):
+    port = address[1]
+    return [GBridgeSocket.MOBILE_ADDRTYPE_IPV4, port >> 8, port & 0xFF] + [int(value) for value in address[0].split(".")]
+
+class RecvBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def make_udp_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        self.sockets += [sock]
+        return sock
+
+    def test_stream_ring_wraps_around(self):
+        reader, writer = socket.socketpair()
+        self.sockets += [reader, writer]
+        buffer = GBridgeRecvBuffer(True, 8)
+        writer.sendall(b"abcdef")
+        self.assertEqual(buffer.fill_from(reader, None), 6)
+        self.assertEqual(buffer.read(4), (b"abcd", None))
+        writer.sendall(b"ghijkl")
+        # Up to the end of the ring, then from its start
+        self.assertEqual(buffer.fill_from(reader, None), 2)
+        self.assertEqual(buffer.fill_from(reader, None), 4)
+        self.assertTrue(buffer.is_full())
+        self.assertEqual(buffer.peek(), (8, None))
+        self.assertEqual(buffer.read(3), (b"efg", None))
+        self.assertEqual(buffer.read(0x100), (b"hijkl", None))
+        self.assertFalse(buffer.has_data())
+
+    def test_datagrams_keep_boundaries_and_sources(self):
+        receiver = self.make_udp_socket()
+        first = self.make_udp_socket()
+        second = self.make_udp_socket()
+        first.sendto(b"first", receiver.getsockname())
+        second.sendto(b"", receiver.getsockname())
+        second.sendto(b"second", receiver.getsockname())
+        time.sleep(0.05)
+        buffer = GBridgeRecvBuffer(False, 0x100)
+        scratch = bytearray(GBridgeSocket.MAX_DATAGRAM_SIZE)
+        for i in range(3):
+            buffer.fill_from(receiver, scratch)
+        # The empty datagram is dropped
+        self.assertEqual(len(buffer), 11)
+        self.assertEqual(buffer.peek(), (5, first.getsockname()))
+        # What doesn't fit in the read is dropped with its datagram
+        self.assertEqual(buffer.read(2), (b"fi", first.getsockname()))
+        self.assertEqual(buffer.peek(), (6, second.getsockname()))
+        self.assertEqual(buffer.read(0x100), (b"second", second.getsockname()))
+        self.assertFalse(buffer.has_data())
+        self.assertEqual(len(buffer), 0)
+
+class SocketSlotsTest(unittest.TestCase):
+    def setUp(self):
+        self.bridge_sockets = GBridgeSocket(UserOutput(), max_connections=4)
+        self.bridge_sockets.print_exception = False
+        self.peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.peer.bind(("127.0.0.1", 0))
+
+    def tearDown(self):
+        for conn in range(len(self.bridge_sockets.slots)):
+            if self.bridge_sockets.slots[conn].sock is not None:
+                self.bridge_sockets.close([conn])
+        self.peer.close()
+
+    def open_udp(self, conn):
+        return self.bridge_sockets.open([conn, GBridgeSocket.MOBILE_SOCKTYPE_UDP, GBridgeSocket.MOBILE_ADDRTYPE_IPV4, 0, 0])
+
+    def test_default_table_has_the_adapters_size(self):
+        bridge_sockets = GBridgeSocket(UserOutput())
+        self.assertEqual(len(bridge_sockets.slots), GBridgeSocket.MOBILE_MAX_CONNECTIONS)
+        self.assertFalse(bridge_sockets.open([GBridgeSocket.MOBILE_MAX_CONNECTIONS, GBridgeSocket.MOBILE_SOCKTYPE_UDP, GBridgeSocket.MOBILE_ADDRTYPE_IPV4, 0, 0]))
+
+    def test_connections_past_the_table_are_refused(self):
+        for conn in range(4):
+            self.assertTrue(self.open_udp(conn))
+        self.assertFalse(self.open_udp(4))
+        self.assertFalse(self.open_udp(3))
+        self.assertEqual(self.bridge_sockets.send([4] + make_address(self.peer.getsockname()), b"data"), -1)
+        self.assertIsNone(self.bridge_sockets.get_open_slot([4, 0, 1, 1], 4))
+
+    def test_last_slot_sends_and_receives(self):
+        self.assertTrue(self.open_udp(3))
+        self.assertEqual(self.bridge_sockets.send([3] + make_address(self.peer.getsockname()), b"ping"), 4)
+        data, source = self.peer.recvfrom(0x100)
+        self.assertEqual(data, b"ping")
+        self.peer.sendto(b"pong", source)
+        for i in range(100):
+            answer, rest = self.bridge_sockets.recv([3, 0, 0x10, 1])
+            if len(answer) > 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(bytes(answer), b"pong")
+        self.assertEqual(rest, [0, 4] + make_address(self.peer.getsockname()))
+        self.assertEqual(self.bridge_sockets.slots[3].received_bytes, 4)
+        self.bridge_sockets.close([3])
+        self.assertIsNone(self.bridge_sockets.slots[3].sock)
+
+if __name__ == "__main__":
+    unittest.main()
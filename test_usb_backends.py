@@ -0,0 +1,129 @@
+import sys
+import time
+import types
+import unittest
+from unittest import mock
+import usb_pico_interface
+from usb_pico_interface import UserOutput, LibUSB1AsyncSendRecv, ReconnectingSendRecv
+
+# Just what LibUSB1AsyncSendRecv and ReconnectingSendRecv use of python-libusb1
+def make_fake_usb1():
+    usb1 = types.ModuleType("usb1")
+    usb1.USBError = type("USBError", (Exception,), {})
+    for name in ["USBErrorNoDevice", "USBErrorPipe", "USBErrorOverflow", "USBErrorIO", "USBErrorInterrupted", "USBErrorTimeout"]:
+        setattr(usb1, name, type(name, (usb1.USBError,), {}))
+    for value, name in enumerate(["TRANSFER_COMPLETED", "TRANSFER_ERROR", "TRANSFER_TIMED_OUT", "TRANSFER_CANCELLED", "TRANSFER_STALL", "TRANSFER_NO_DEVICE", "TRANSFER_OVERFLOW"]):
+        setattr(usb1, name, value)
+    return usb1
+
+class FakeTransfer:
+    def __init__(self):
+        self.status = None
+        self.buffer = b""
+        self.submits = 0
+        self.callback = None
+
+    def setBulk(self, endpoint, size, callback=None):
+        self.callback = callback
+
+    def submit(self):
+        self.submits += 1
+
+    def isSubmitted(self):
+        return False
+
+    def cancel(self):
+        pass
+
+    def getStatus(self):
+        return self.status
+
+    def getBuffer(self):
+        return self.buffer
+
+    def getActualLength(self):
+        return len(self.buffer)
+
+    # What the event thread does once the Pico answers
+    def complete(self, status, buffer=b""):
+        self.status = status
+        self.buffer = buffer
+        self.callback(self)
+
+class FakeHandle:
+    def __init__(self):
+        self.transfers = []
+
+    def getTransfer(self):
+        self.transfers += [FakeTransfer()]
+        return self.transfers[-1]
+
+class FakeContext:
+    def handleEventsTimeout(self, timeout):
+        time.sleep(timeout)
+
+class LibUSB1AsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.usb1 = make_fake_usb1()
+        self.modules = mock.patch.dict(sys.modules, {"usb1": self.usb1})
+        self.modules.start()
+        self.handle = FakeHandle()
+        self.usb_handler = LibUSB1AsyncSendRecv(FakeContext(), self.handle, 2, 0x02, 0x82, False, 0.05, 1, num_transfers=3)
+
+    def tearDown(self):
+        self.usb_handler.running = False
+        self.usb_handler.event_thread.join()
+        self.modules.stop()
+
+    def test_transfers_are_queued(self):
+        self.assertEqual(len(self.handle.transfers), 3)
+        self.assertTrue(all(transfer.submits == 1 for transfer in self.handle.transfers))
+
+    def test_replies_keep_their_order(self):
+        self.handle.transfers[0].complete(self.usb1.TRANSFER_COMPLETED, b"\x01\x02")
+        self.handle.transfers[1].complete(self.usb1.TRANSFER_TIMED_OUT)
+        self.handle.transfers[2].complete(self.usb1.TRANSFER_COMPLETED, b"\x03")
+        self.assertEqual(self.usb_handler.receiveByte_raw(0x40), b"\x01\x02")
+        self.assertEqual(self.usb_handler.receiveByte_raw(0x40), b"\x03")
+        self.assertEqual(self.usb_handler.receiveByte_raw(0x40), b"")
+        self.assertTrue(all(transfer.submits == 2 for transfer in self.handle.transfers))
+
+    def test_failed_transfer_is_raised_after_the_replies(self):
+        self.handle.transfers[0].complete(self.usb1.TRANSFER_COMPLETED, b"\x01")
+        self.handle.transfers[1].complete(self.usb1.TRANSFER_NO_DEVICE)
+        self.assertEqual(self.usb_handler.receiveByte_raw(0x40), b"\x01")
+        for i in range(2):
+            with self.assertRaises(self.usb1.USBErrorNoDevice) as context:
+                self.usb_handler.receiveByte_raw(0x40)
+            self.assertTrue(ReconnectingSendRecv.is_device_lost(context.exception))
+        self.assertEqual(self.handle.transfers[1].submits, 1)
+
+class BackendSelectionTest(unittest.TestCase):
+    def setUp(self):
+        usb = types.ModuleType("usb")
+        usb.core = types.ModuleType("usb.core")
+        usb.util = types.ModuleType("usb.util")
+        self.modules = mock.patch.dict(sys.modules, {"usb1": make_fake_usb1(), "usb": usb, "usb.core": usb.core, "usb.util": usb.util})
+        self.modules.start()
+        self.libusb_method = mock.patch.object(usb_pico_interface, "libusb_method", return_value=None).start()
+        self.libusb1_method = mock.patch.object(usb_pico_interface, "libusb1_method", return_value=None).start()
+        self.serial_method = mock.patch.object(usb_pico_interface, "serial_method", return_value=None).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        self.modules.stop()
+
+    def test_pyusb_is_the_default(self):
+        usb_pico_interface.find_usb_handler(0xcafe, 0x4011, 0.1, 5, UserOutput())
+        self.libusb_method.assert_called_once()
+        self.libusb1_method.assert_not_called()
+
+    def test_libusb1_can_be_chosen(self):
+        usb_pico_interface.get_usb_method("LIBUSB1", 8)(0xcafe, 0x4011, 0.1, 5, UserOutput())
+        self.libusb_method.assert_not_called()
+        self.serial_method.assert_not_called()
+        self.libusb1_method.assert_called_once()
+        self.assertEqual(self.libusb1_method.call_args.kwargs["num_transfers"], 8)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,9 +5,15 @@ import time
 from time import sleep
 from gbridge import GBridge, GBridgeSocket, GBridgeDebugCommands, GBridgeTimeResolution
 from mobile_adapter_data import MobileAdapterDeviceData
+from eeprom_cache import EepromImageCache
 import os
+import errno
 
 import threading
+import queue
+import asyncio
+import concurrent.futures
+from collections import deque
 
 # Default transfer status class.
 # If wait is set, the transfers are temporarily stopped.
@@ -17,6 +23,83 @@ class TransferStatus:
         self.wait = False
         self.end = False
 
+# Scheduling policies for the transfer loop.
+# wait is called once per USB exchange, with is_busy set if either side
+# still has pending work. Pick one depending on latency/CPU needs.
+# get_wait_time only computes the time, for loops which wait on their own.
+
+# Polls back-to-back, always. Lowest latency, uses a full core.
+class BusyTransferPolicy:
+    def __init__(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def get_wait_time(self, is_busy):
+        return 0
+
+    def wait(self, is_busy):
+        pass
+
+# Sleeps for a fixed amount of time after each exchange (old behaviour).
+class FixedTransferPolicy:
+    def __init__(self, sleep_time=0.01):
+        self.sleep_time = sleep_time
+
+    def reset(self):
+        pass
+
+    def get_wait_time(self, is_busy):
+        return self.sleep_time
+
+    def wait(self, is_busy):
+        wait_time = self.get_wait_time(is_busy)
+        if wait_time > 0:
+            sleep(wait_time)
+
+# Polls back-to-back while there is work to do.
+# Once the link goes idle, the sleep time grows from min_sleep
+# up to max_sleep, and it goes back to 0 as soon as work shows up.
+class AdaptiveTransferPolicy:
+    def __init__(self, min_sleep=0.0005, max_sleep=0.01, growth=2.0, idle_exchanges=2):
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.growth = growth
+        self.idle_exchanges = idle_exchanges
+        self.reset()
+
+    def reset(self):
+        self.curr_sleep = 0
+        self.idle_count = 0
+
+    def get_wait_time(self, is_busy):
+        if is_busy:
+            self.reset()
+            return 0
+        self.idle_count += 1
+        # Small grace period, replies often need an exchange or two
+        if self.idle_count <= self.idle_exchanges:
+            return 0
+        if self.curr_sleep == 0:
+            self.curr_sleep = self.min_sleep
+        else:
+            self.curr_sleep *= self.growth
+        if self.curr_sleep > self.max_sleep:
+            self.curr_sleep = self.max_sleep
+        return self.curr_sleep
+
+    def wait(self, is_busy):
+        wait_time = self.get_wait_time(is_busy)
+        if wait_time > 0:
+            sleep(wait_time)
+
+transfer_policies = {
+    "BUSY": BusyTransferPolicy,
+    "ADAPTIVE": AdaptiveTransferPolicy,
+    "FIXED": FixedTransferPolicy
+}
+
 # Default user output class.
 # set_out is called, to "print" the data to the user.
 # A program can intercept this, though.
@@ -78,117 +161,463 @@ class KeyboardThread(threading.Thread):
         return out
 
 class SocketThread(threading.Thread):
-
-    def __init__(self, user_output):
+    TRANSFER_FLAGS_MASK = 0xC0
+    DEBUG_TRANSFER_FLAG = 0x80
+
+    # queue_size bounds how many USB packets can be waiting to be parsed
+    # (and how many answers can be waiting to be sent) at the same time.
+    # If start_thread is not set, process_data must be called directly.
+    # max_connections is the size of the socket table (None for the adapter's default).
+    def __init__(self, user_output, queue_size=2, start_thread=True, max_connections=None):
         super(SocketThread, self).__init__()
         self.daemon = True
-        self.start_processing = False
-        self.done_processing = False
         self.bridge = GBridge()
         self.bridge_debug = GBridge()
-        self.bridge_sockets = GBridgeSocket(user_output)
-        self.lock_in = threading.Lock()
-        self.lock_out = threading.Lock()
-        self.lock_in.acquire()
-        self.lock_out.acquire()
-        self.end_run = False
+        self.bridge_sockets = GBridgeSocket(user_output, max_connections=max_connections)
+        self.queue_size = queue_size
+        self.in_queue = queue.Queue(queue_size)
+        self.out_queue = queue.Queue(queue_size)
+        self.in_flight = 0
+        self.print_data_in = False
+        self.debug_print = True
+        self.last_sent = [None, None]
         self.user_output = user_output
-        self.start()
+        # DebugBatch objects still waiting for replies
+        self.debug_batches = []
+        # If set, the EEPROM images which are read are kept in it
+        self.eeprom_cache = None
+        self.adapter_key = None
+        if start_thread:
+            self.start()
 
     def run(self):
-        TRANSFER_FLAGS_MASK = 0xC0
-        DEBUG_TRANSFER_FLAG = 0x80
-        print_data_in = False
-        debug_print = True
-        last_sent = [None, None]
-
         while True:
-            self.lock_in.acquire()
+            elem = self.in_queue.get()
 
-            if self.end_run:
+            if elem is None:
                 break
 
-            send_list = []
-            read_data = self.data
-            save_requests = self.save_requests
-            ack_requests = self.ack_requests
-            num_bytes = int.from_bytes(read_data[:1], byteorder='little')
-
-            curr_bridge = self.bridge
-            is_debug = (num_bytes & TRANSFER_FLAGS_MASK) == DEBUG_TRANSFER_FLAG
-            if is_debug:
-                curr_bridge = self.bridge_debug
-
-            num_bytes &= 0x3F
-            bytes = []
-            if (num_bytes > 0) and (num_bytes <= (len(read_data) - 1)):
-                for i in range(num_bytes):
-                    bytes += [int.from_bytes(read_data[(i + 1):(i + 2)], byteorder='little')]
-
-                curr_cmd = True
-                if print_data_in and (not is_debug):
-                    self.user_output.set_out("IN: " + str(bytes), self.user_output.INPUT_DEBUG_TAG)
-                while curr_cmd is not None:
-                    curr_cmd = curr_bridge.init_cmd(bytes)
-                    if(curr_cmd is not None):
-                        bytes = bytes[curr_cmd.total_len - curr_cmd.old_len:]
+            read_data, save_requests, ack_requests = elem
+            self.out_queue.put(self.process_data(read_data, save_requests, ack_requests))
+
+    # Parses a single USB packet and returns the data to send back.
+    # The sockets are serviced here too, so only this thread changes them.
+    def process_data(self, read_data, save_requests, ack_requests):
+        self.bridge_sockets.service()
+        send_list = []
+        num_bytes = int.from_bytes(read_data[:1], byteorder='little')
+
+        curr_bridge = self.bridge
+        is_debug = (num_bytes & SocketThread.TRANSFER_FLAGS_MASK) == SocketThread.DEBUG_TRANSFER_FLAG
+        if is_debug:
+            curr_bridge = self.bridge_debug
+
+        num_bytes &= 0x3F
+        if (num_bytes > 0) and (num_bytes <= (len(read_data) - 1)):
+            # Views on the USB packet, the bytes are only copied by the parser
+            data_in = memoryview(read_data)[1:num_bytes + 1]
+
+            curr_cmd = True
+            if self.print_data_in and (not is_debug):
+                self.user_output.set_out("IN: " + str(list(data_in)), self.user_output.INPUT_DEBUG_TAG)
+            while curr_cmd is not None:
+                curr_cmd = curr_bridge.init_cmd(data_in)
+                if(curr_cmd is not None):
+                    data_in = data_in[curr_cmd.total_len - curr_cmd.old_len:]
+                    batch = None
+                    if is_debug and (len(self.debug_batches) > 0):
+                        batch = self.deliver_debug_reply(curr_cmd)
+                    if (batch is None) or batch.print_replies:
                         curr_cmd.print_answer(save_requests, ack_requests, self.user_output)
-                        if debug_print:
-                            curr_cmd.do_print(self.user_output)
-                        curr_cmd.check_save(save_requests, self.user_output)
-                        if(curr_cmd.response_cmd is not None):
-                            if(curr_cmd.process(self.bridge_sockets)):
-                                curr_cmd.processed = True
-                            send_list += [curr_cmd]
-                        elif(curr_cmd.retry_data or curr_cmd.retry_stream):
-                            send_list += [curr_cmd]
-
-            self.out_data = []
-            curr_last_sent = None
-            last_sent_index = 0
-            if is_debug:
-                last_sent_index = 1
-
-            for i in range(len(send_list)):
-                if send_list[i].response_cmd is not None:
-                    self.out_data += [send_list[i].response_cmd]
-                    if send_list[i].processed:
-                        self.out_data += GBridge.prepare_cmd(send_list[i].result_to_send(), False)
-                        self.out_data += GBridge.prepare_cmd(send_list[i].get_if_pending(), True)
-                        curr_last_sent = send_list[i]
-                else:
-                    if send_list[i].retry_data:
-                        self.out_data += GBridge.prepare_cmd(last_sent[last_sent_index].result_to_send(), False)
-                    if send_list[i].retry_stream:
-                        self.out_data += GBridge.prepare_cmd(last_sent[last_sent_index].get_if_pending(), True)
-
-            if curr_last_sent is not None:
-                last_sent[last_sent_index] = curr_last_sent
-
-            self.lock_out.release()
+                    if is_debug and (self.eeprom_cache is not None):
+                        self.update_eeprom_cache(curr_cmd)
+                    if self.debug_print:
+                        curr_cmd.do_print(self.user_output)
+                    curr_cmd.check_save(save_requests, self.user_output)
+                    if(curr_cmd.response_cmd is not None):
+                        if(curr_cmd.process(self.bridge_sockets)):
+                            curr_cmd.processed = True
+                        send_list += [curr_cmd]
+                    elif(curr_cmd.retry_data or curr_cmd.retry_stream):
+                        send_list += [curr_cmd]
+
+        out_data = bytearray()
+        curr_last_sent = None
+        last_sent_index = 0
+        if is_debug:
+            last_sent_index = 1
+
+        for i in range(len(send_list)):
+            if send_list[i].response_cmd is not None:
+                out_data.append(send_list[i].response_cmd)
+                if send_list[i].processed:
+                    out_data += GBridge.prepare_cmd(send_list[i].result_to_send(), False)
+                    out_data += GBridge.prepare_cmd(send_list[i].get_if_pending(), True)
+                    curr_last_sent = send_list[i]
+            else:
+                if send_list[i].retry_data:
+                    out_data += GBridge.prepare_cmd(self.last_sent[last_sent_index].result_to_send(), False)
+                if send_list[i].retry_stream:
+                    out_data += GBridge.prepare_cmd(self.last_sent[last_sent_index].get_if_pending(), True)
+
+        if curr_last_sent is not None:
+            self.last_sent[last_sent_index] = curr_last_sent
+
+        return out_data
+
+    # Gives a debug reply to the oldest batch waiting for it.
+    # Returns the batch which took it, if any.
+    def deliver_debug_reply(self, curr_cmd):
+        for batch in list(self.debug_batches):
+            if batch.deliver(curr_cmd):
+                if batch.is_done():
+                    self.debug_batches.remove(batch)
+                return batch
+        return None
 
+    # Remembers which adapter this is, and the EEPROM images read from it.
+    # Once the adapter starts, it may change its EEPROM, so the cached image must be confirmed again.
+    def update_eeprom_cache(self, curr_cmd):
+        if (not curr_cmd.success_checksum) or (len(curr_cmd.data) <= 0):
+            return
+        if (curr_cmd.upper_cmd == GBridge.GBRIDGE_CMD_DEBUG_ACK) and (curr_cmd.data[0] == GBridgeDebugCommands.START_CMD):
+            self.eeprom_cache.forget_confirmed()
+        if curr_cmd.upper_cmd != GBridge.GBRIDGE_CMD_DEBUG_INFO:
+            return
+        if curr_cmd.data[0] == GBridgeDebugCommands.CMD_DEBUG_INFO_IMPL:
+            self.adapter_key = self.eeprom_cache.key_from_info(curr_cmd.data[1:])
+        if (curr_cmd.data[0] == GBridgeDebugCommands.CMD_DEBUG_INFO_CFG) and (self.adapter_key is not None):
+            self.eeprom_cache.store(self.adapter_key, curr_cmd.data[1:])
+
+    def has_pending_work(self):
+        return (self.in_flight > 0) or self.bridge_sockets.has_pending()
+
+    # Returns whether another packet can be queued without waiting
+    def can_queue(self):
+        return self.in_flight < self.queue_size
+
+    # Blocks only if queue_size packets are already waiting to be parsed
     def set_processing(self, data, save_requests, ack_requests):
-        self.data = data
-        self.save_requests = save_requests
-        self.ack_requests = ack_requests
-
-        self.lock_in.release()
+        self.in_queue.put((data, save_requests, ack_requests))
+        self.in_flight += 1
 
+    # Waits for the answer to the oldest packet which is still being parsed
     def get_processed(self):
-        self.lock_out.acquire()
-
-        return self.out_data
+        out_data = self.out_queue.get()
+        self.in_flight -= 1
+        return out_data
+
+    # Returns the list of answers which are ready, without waiting for the others
+    def get_processed_nowait(self):
+        out_datas = []
+        while self.in_flight > 0:
+            try:
+                out_datas += [self.out_queue.get_nowait()]
+            except queue.Empty:
+                break
+            self.in_flight -= 1
+        return out_datas
 
     def end_processing(self):
-        self.end_run = True
-
-        self.lock_in.release()
+        self.in_queue.put(None)
 
-def add_result_debug_commands(actual_cmd, data, debug_send_list, ack_requests):
+def add_result_debug_commands(actual_cmd, data, out_queue, ack_requests):
     result, ack_wanted = GBridgeDebugCommands.load_command(actual_cmd, data)
-    debug_send_list += result
+    out_queue.add_debug(result)
     ack_requests[actual_cmd] = ack_wanted
 
+# Lets the queued batches send more packets, if they need to
+def pump_debug_batches(debug_batches, out_queue):
+    for batch in list(debug_batches):
+        batch.pump(out_queue)
+
+# A group of debug commands, sent together, whose replies are returned together.
+# commands is a list of (command id, data) pairs, with data as for load_command.
+# The user input class can return it from get_input, next to the usual strings.
+# The firmware parses one debug command per USB packet, but the commands are
+# queued back-to-back and their replies share the Pico's packets.
+# wait returns one entry per command: the data of its info reply (without
+# the info type byte), True once all its acks arrived, or None if still missing.
+class DebugBatch:
+    STATUS_SWEEP = [
+        (GBridgeDebugCommands.STATUS_CMD, None),
+        (GBridgeDebugCommands.SEND_IMPL_INFO_CMD, None),
+        (GBridgeDebugCommands.SEND_NUMBER_OWN_CMD, None),
+        (GBridgeDebugCommands.SEND_RELAY_TOKEN_CMD, None),
+        (GBridgeDebugCommands.SEND_GBRIDGE_CFG_CMD, None)
+    ]
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.replies = [None] * len(commands)
+        self.acks_left = [0] * len(commands)
+        self.missing = 0
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.print_replies = True
+
+    # Queues all the packets of the batch
+    def prepare(self, out_queue):
+        with self.lock:
+            for i in range(len(self.commands)):
+                command_id, data = self.commands[i]
+                result, ack_wanted = GBridgeDebugCommands.load_command(command_id, data)
+                out_queue.add_debug(result)
+                if ack_wanted > 0:
+                    # The firmware acks every packet
+                    self.acks_left[i] = len(result)
+                if (command_id in GBridgeDebugCommands.info_replies) or (self.acks_left[i] > 0):
+                    self.missing += 1
+            if self.missing == 0:
+                self.done.set()
+
+    # Returns whether the reply was one this batch was waiting for
+    def deliver(self, curr_cmd):
+        if (not curr_cmd.success_checksum) or (len(curr_cmd.data) <= 0):
+            return False
+        with self.lock:
+            for i in range(len(self.commands)):
+                command_id = self.commands[i][0]
+                if curr_cmd.upper_cmd == GBridge.GBRIDGE_CMD_DEBUG_ACK:
+                    if (command_id != curr_cmd.data[0]) or (self.acks_left[i] <= 0):
+                        continue
+                    self.acks_left[i] -= 1
+                    if self.acks_left[i] == 0:
+                        self.replies[i] = True
+                        self.set_found()
+                    return True
+                if curr_cmd.upper_cmd == GBridge.GBRIDGE_CMD_DEBUG_INFO:
+                    if (self.replies[i] is not None) or (GBridgeDebugCommands.info_replies.get(command_id) != curr_cmd.data[0]):
+                        continue
+                    self.replies[i] = bytes(curr_cmd.data[1:])
+                    self.set_found()
+                    return True
+        return False
+
+    def set_found(self):
+        self.missing -= 1
+        if self.missing == 0:
+            self.done.set()
+
+    def pump(self, out_queue):
+        pass
+
+    def is_done(self):
+        return self.done.is_set()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        with self.lock:
+            return list(self.replies)
+
+# Streams an EEPROM image to the adapter, which must be stopped.
+# Up to window chunks are in flight at the same time, instead of one per exchange.
+# The firmware's acks only carry the command id, and it drops chunks which fail
+# the checksum without answering, so acks are matched to chunks in the order
+# they were sent. If acks are missing after ack_timeout seconds, the chunks
+# still in flight are sent again. The last chunk carries the done flag, which makes
+# the firmware load the new configuration, so it goes out once all the others are acked.
+# The upload succeeds once every chunk is acked.
+# If verify is set, the EEPROM is read back after that. Firmwares which can save
+# answer with their flash copy, which is only written CONFIG_LAST_EDIT_TIMEOUT (1 s)
+# after the last edit: a save is forced first, and the read-back waits verify_delay
+# seconds. The chunks which differ are sent again, followed by the last one.
+# If an EepromImageCache is given, the adapter is identified first, and only
+# the chunks which differ from its cached image are sent. If the cached image
+# was not confirmed in this session, the EEPROM is read back first (forcing a save
+# and waiting, like verify does), and that is what the new image is compared to.
+# It can be queued like a DebugBatch.
+class EepromUploader:
+    STATE_SENDING = 0
+    STATE_VERIFYING = 1
+    STATE_FINISHING = 2
+    STATE_DONE = 3
+    STATE_IDENTIFYING = 4
+    STATE_SAVING = 5
+
+    def __init__(self, data, user_output, window=8, ack_timeout=0.5, verify=False, max_rounds=5, cache=None, verify_delay=1.5):
+        self.data = bytes(data)
+        self.user_output = user_output
+        self.window = max(window, 1)
+        self.ack_timeout = ack_timeout
+        self.verify = verify
+        self.verify_delay = verify_delay
+        # When the read-back of the EEPROM can be asked
+        self.verify_at = None
+        self.max_rounds = max_rounds
+        self.chunk_size = GBridgeDebugCommands.MAXIMUM_LENGTH - 3
+        self.packets, ack_wanted = GBridgeDebugCommands.load_command(GBridgeDebugCommands.UPDATE_EEPROM_CMD, self.data)
+        self.last_chunk = len(self.packets) - 1
+        self.to_send = deque(range(self.last_chunk))
+        self.in_flight = deque()
+        self.last_ack_time = 0
+        self.state = EepromUploader.STATE_SENDING
+        self.needs_send = False
+        self.rounds = 0
+        self.chunks_sent = 0
+        self.chunks_resent = 0
+        self.start_time = None
+        self.success = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.print_replies = False
+        self.cache = cache
+        self.cache_key = None
+        # Set while reading back the EEPROM the chunks are compared to
+        self.confirming = False
+        if self.cache is not None:
+            self.to_send.clear()
+            self.state = EepromUploader.STATE_IDENTIFYING
+            self.needs_send = True
+
+    def prepare(self, out_queue):
+        self.start_time = time.monotonic()
+        self.pump(out_queue)
+
+    def pump(self, out_queue):
+        with self.lock:
+            if self.state == EepromUploader.STATE_SENDING:
+                if (len(self.in_flight) > 0) and ((time.monotonic() - self.last_ack_time) >= self.ack_timeout):
+                    self.retry(list(self.in_flight))
+                while (len(self.in_flight) < self.window) and (len(self.to_send) > 0):
+                    self.send_chunk(self.to_send.popleft(), out_queue)
+                if (self.state == EepromUploader.STATE_SENDING) and (len(self.in_flight) == 0) and (len(self.to_send) == 0):
+                    self.state = EepromUploader.STATE_FINISHING
+                    self.needs_send = True
+            elif self.verify_at is not None:
+                if time.monotonic() >= self.verify_at:
+                    self.verify_at = None
+                    self.needs_send = True
+            elif (self.state == EepromUploader.STATE_SAVING) and (not self.needs_send) and ((time.monotonic() - self.last_ack_time) >= self.ack_timeout):
+                # Firmwares which can't save don't ack it, and read back their RAM
+                self.start_verify(0)
+            elif (self.state != EepromUploader.STATE_DONE) and (not self.needs_send) and ((time.monotonic() - self.last_ack_time) >= self.ack_timeout):
+                self.retry([])
+            if self.needs_send:
+                self.needs_send = False
+                self.in_flight.clear()
+                if self.state == EepromUploader.STATE_IDENTIFYING:
+                    result, ack_wanted = GBridgeDebugCommands.load_command(GBridgeDebugCommands.SEND_IMPL_INFO_CMD, None)
+                    out_queue.add_debug(result)
+                    self.last_ack_time = time.monotonic()
+                elif self.state == EepromUploader.STATE_SAVING:
+                    result, ack_wanted = GBridgeDebugCommands.load_command(GBridgeDebugCommands.FORCE_SAVE_CMD, None)
+                    out_queue.add_debug(result)
+                    self.last_ack_time = time.monotonic()
+                elif self.state == EepromUploader.STATE_VERIFYING:
+                    result, ack_wanted = GBridgeDebugCommands.load_command(GBridgeDebugCommands.SEND_EEPROM_CMD, None)
+                    out_queue.add_debug(result)
+                    self.last_ack_time = time.monotonic()
+                elif self.state == EepromUploader.STATE_FINISHING:
+                    self.send_chunk(self.last_chunk, out_queue)
+
+    def send_chunk(self, index, out_queue):
+        if len(self.in_flight) == 0:
+            self.last_ack_time = time.monotonic()
+        out_queue.add_debug([self.packets[index]])
+        self.in_flight.append(index)
+        self.chunks_sent += 1
+
+    # Sends again what did not get an answer, up to max_rounds times
+    def retry(self, chunks):
+        self.rounds += 1
+        if self.rounds > self.max_rounds:
+            self.finish(False)
+            return
+        self.chunks_resent += len(chunks)
+        self.in_flight.clear()
+        if self.state == EepromUploader.STATE_SENDING:
+            self.to_send.extendleft(reversed(chunks))
+        else:
+            self.needs_send = True
+
+    def start_verify(self, delay):
+        self.state = EepromUploader.STATE_VERIFYING
+        self.verify_at = time.monotonic() + delay
+
+    def chunk_data(self, index):
+        return self.data[index * self.chunk_size:(index + 1) * self.chunk_size]
+
+    def deliver(self, curr_cmd):
+        if (not curr_cmd.success_checksum) or (len(curr_cmd.data) <= 0):
+            return False
+        with self.lock:
+            if curr_cmd.upper_cmd == GBridge.GBRIDGE_CMD_DEBUG_ACK:
+                if (curr_cmd.data[0] == GBridgeDebugCommands.FORCE_SAVE_CMD) and (self.state == EepromUploader.STATE_SAVING):
+                    self.start_verify(self.verify_delay)
+                    return True
+                if (curr_cmd.data[0] != GBridgeDebugCommands.UPDATE_EEPROM_CMD) or (len(self.in_flight) == 0):
+                    return False
+                self.in_flight.popleft()
+                self.last_ack_time = time.monotonic()
+                if self.state == EepromUploader.STATE_FINISHING:
+                    if self.verify:
+                        self.state = EepromUploader.STATE_SAVING
+                        self.needs_send = True
+                    else:
+                        self.finish(True)
+                return True
+            if (curr_cmd.upper_cmd == GBridge.GBRIDGE_CMD_DEBUG_INFO) and (self.state == EepromUploader.STATE_IDENTIFYING) and (curr_cmd.data[0] == GBridgeDebugCommands.CMD_DEBUG_INFO_IMPL):
+                self.cache_key = self.cache.key_from_info(curr_cmd.data[1:])
+                if (self.cache_key is not None) and (not self.cache.is_confirmed(self.cache_key)):
+                    self.confirming = True
+                    self.state = EepromUploader.STATE_SAVING
+                    self.needs_send = True
+                else:
+                    self.send_changed(self.cache.load(self.cache_key))
+                return True
+            if (curr_cmd.upper_cmd == GBridge.GBRIDGE_CMD_DEBUG_INFO) and (self.state == EepromUploader.STATE_VERIFYING) and (self.verify_at is None) and (curr_cmd.data[0] == GBridgeDebugCommands.CMD_DEBUG_INFO_CFG):
+                read_back = bytes(curr_cmd.data[1:])
+                if self.confirming:
+                    self.confirming = False
+                    self.cache.store(self.cache_key, read_back, confirmed=True)
+                    self.send_changed(read_back)
+                    return True
+                different = []
+                for i in range(self.last_chunk + 1):
+                    chunk = self.chunk_data(i)
+                    if read_back[i * self.chunk_size:(i * self.chunk_size) + len(chunk)] != chunk:
+                        different += [i]
+                if len(different) > 0:
+                    # The last chunk goes out again anyway, after the others
+                    self.state = EepromUploader.STATE_SENDING
+                    self.retry([i for i in different if i < self.last_chunk])
+                else:
+                    self.finish(True)
+                return True
+        return False
+
+    # Sends the chunks which differ from old_image (all of them if it's None).
+    # The last chunk is always sent, at the end.
+    def send_changed(self, old_image):
+        for i in EepromImageCache.changed_blocks(old_image, self.data):
+            if i < self.last_chunk:
+                self.to_send.append(i)
+        self.state = EepromUploader.STATE_SENDING
+
+    def finish(self, success):
+        self.state = EepromUploader.STATE_DONE
+        self.success = success
+        elapsed = time.monotonic() - self.start_time
+        if not success:
+            self.user_output.set_out("EEPROM upload failed! Is the adapter STOPPED?", self.user_output.EXCEPTION_TAG)
+        else:
+            speed = 0
+            if elapsed > 0:
+                speed = len(self.data) / elapsed / 1024
+            self.user_output.set_out("EEPROM loaded: " + str(len(self.data)) + " bytes in " + ("%.3f" % elapsed) + " s (" + ("%.1f" % speed) + " KiB/s), " + str(self.chunks_sent) + " of " + str(len(self.packets)) + " chunks sent, " + str(self.chunks_resent) + " sent again", self.user_output.SUCCESS_OPERATION_TAG)
+            if self.cache_key is not None:
+                self.cache.store(self.cache_key, self.data, confirmed=True)
+        self.done.set()
+
+    def is_done(self):
+        return self.done.is_set()
+
+    # Returns whether the upload succeeded
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.success
+
 class InputCommand:
     def __init__(self, to_send_cmd, description, valid_inputs=[], comm_cmd=None, specific_cmd=None, show_in_all=True):
         self.description = description
@@ -297,11 +726,18 @@ class FullInputCommands:
         loading_commands
     ]
     
-def interpret_input_keyboard(key_input, debug_send_list, save_requests, ack_requests, user_output):
+# debug_batches gets the DebugBatch objects which were queued.
+# If eeprom_cache is set, LOAD EEPROM only sends what changed from the cached image.
+def interpret_input_keyboard(key_input, out_queue, save_requests, ack_requests, user_output, debug_batches=None, eeprom_cache=None):
     
     close_all = False
 
     for elem in key_input.get_input():
+        if isinstance(elem, DebugBatch):
+            if debug_batches is not None:
+                debug_batches += [elem]
+            elem.prepare(out_queue)
+            continue
         tokens = elem.split()
         command = ""
         success = False
@@ -331,14 +767,14 @@ def interpret_input_keyboard(key_input, debug_send_list, save_requests, ack_requ
             command = tokens[0].upper().strip() + " " + tokens[1].upper().strip()
 
         if command in FullInputCommands.basic_commands.keys():
-            add_result_debug_commands(FullInputCommands.basic_commands[command].to_send_cmd, None, debug_send_list, ack_requests)
+            add_result_debug_commands(FullInputCommands.basic_commands[command].to_send_cmd, None, out_queue, ack_requests)
             success = True
 
         if len(tokens) > 2:
             if command in FullInputCommands.saving_commands.keys():
                 save_path = tokens[2].strip()
                 if FullInputCommands.saving_commands[command].to_send_cmd is not None:
-                    add_result_debug_commands(FullInputCommands.saving_commands[command].to_send_cmd, None, debug_send_list, ack_requests)
+                    add_result_debug_commands(FullInputCommands.saving_commands[command].to_send_cmd, None, out_queue, ack_requests)
                 if FullInputCommands.saving_commands[command].comm_cmd not in save_requests.keys():
                     save_requests[FullInputCommands.saving_commands[command].comm_cmd] = dict()
                 save_requests[FullInputCommands.saving_commands[command].comm_cmd][FullInputCommands.saving_commands[command].specific_cmd] = save_path
@@ -353,7 +789,12 @@ def interpret_input_keyboard(key_input, debug_send_list, save_requests, ack_requ
                 except:
                     user_output.set_out("Error while reading file!", user_output.EXCEPTION_TAG)
                 if data is not None:
-                    add_result_debug_commands(FullInputCommands.loading_commands[command].to_send_cmd, data, debug_send_list, ack_requests)
+                    if (FullInputCommands.loading_commands[command].to_send_cmd == GBridgeDebugCommands.UPDATE_EEPROM_CMD) and (debug_batches is not None) and (len(data) > 0):
+                        uploader = EepromUploader(data, user_output, cache=eeprom_cache)
+                        debug_batches += [uploader]
+                        uploader.prepare(out_queue)
+                    else:
+                        add_result_debug_commands(FullInputCommands.loading_commands[command].to_send_cmd, data, out_queue, ack_requests)
                     success = True
 
             if command in FullInputCommands.mobile_adapter_commands.keys():
@@ -374,27 +815,27 @@ def interpret_input_keyboard(key_input, debug_send_list, save_requests, ack_requ
                     if not metered:
                         value |= 0x80
                     user_output.set_out("WARNING: You may need to restart the Game Boy entirely for this change to work!", user_output.WARNING_TAG)
-                    add_result_debug_commands(FullInputCommands.mobile_adapter_commands[command].to_send_cmd, value, debug_send_list, ack_requests)
+                    add_result_debug_commands(FullInputCommands.mobile_adapter_commands[command].to_send_cmd, value, out_queue, ack_requests)
                     success = True
 
             if command in FullInputCommands.unsigned_commands.keys():
                 value = GBridgeSocket.parse_unsigned(FullInputCommands.unsigned_commands[command].to_send_cmd, tokens[2])
                 if value is not None:
-                    add_result_debug_commands(FullInputCommands.unsigned_commands[command].to_send_cmd, value, debug_send_list, ack_requests)
+                    add_result_debug_commands(FullInputCommands.unsigned_commands[command].to_send_cmd, value, out_queue, ack_requests)
                     success = True
 
             if command in FullInputCommands.address_commands.keys():
                 data = GBridgeSocket.parse_addr(FullInputCommands.address_commands[command].to_send_cmd, tokens[2:])
                 if data is not None:
-                    add_result_debug_commands(FullInputCommands.address_commands[command].to_send_cmd, data, debug_send_list, ack_requests)
+                    add_result_debug_commands(FullInputCommands.address_commands[command].to_send_cmd, data, out_queue, ack_requests)
                     success = True
 
             if command in FullInputCommands.on_off_commands.keys():
                 if(tokens[2].upper().strip() == FullInputCommands.ON_STRING):
-                    add_result_debug_commands(FullInputCommands.on_off_commands[command].to_send_cmd, 1, debug_send_list, ack_requests)
+                    add_result_debug_commands(FullInputCommands.on_off_commands[command].to_send_cmd, 1, out_queue, ack_requests)
                     success = True
                 if(tokens[2].upper().strip() == FullInputCommands.OFF_STRING):
-                    add_result_debug_commands(FullInputCommands.on_off_commands[command].to_send_cmd, 0, debug_send_list, ack_requests)
+                    add_result_debug_commands(FullInputCommands.on_off_commands[command].to_send_cmd, 0, out_queue, ack_requests)
                     success = True
 
             if command in FullInputCommands.byte_commands.keys():
@@ -406,7 +847,7 @@ def interpret_input_keyboard(key_input, debug_send_list, save_requests, ack_requ
                 except:
                     pass
                 if(value is not None):
-                    add_result_debug_commands(FullInputCommands.byte_commands[command].to_send_cmd, [2] + [value], debug_send_list, ack_requests)
+                    add_result_debug_commands(FullInputCommands.byte_commands[command].to_send_cmd, [2] + [value], out_queue, ack_requests)
                     success = True
 
             if command in FullInputCommands.time_commands.keys():
@@ -417,7 +858,7 @@ def interpret_input_keyboard(key_input, debug_send_list, save_requests, ack_requ
                 except:
                     pass
                 if len(data) > 0:
-                    add_result_debug_commands(FullInputCommands.time_commands[command].to_send_cmd, [1] + data, debug_send_list, ack_requests)
+                    add_result_debug_commands(FullInputCommands.time_commands[command].to_send_cmd, [1] + data, out_queue, ack_requests)
                     success = True
 
             if command in FullInputCommands.token_commands.keys():
@@ -427,10 +868,10 @@ def interpret_input_keyboard(key_input, debug_send_list, save_requests, ack_requ
                 except:
                     pass
                 if len(data) == FullInputCommands.RELAY_TOKEN_SIZE:
-                    add_result_debug_commands(FullInputCommands.token_commands[command].to_send_cmd, [1] + data, debug_send_list, ack_requests)
+                    add_result_debug_commands(FullInputCommands.token_commands[command].to_send_cmd, [1] + data, out_queue, ack_requests)
                     success = True
                 elif tokens[2].upper().strip() == GBridgeSocket.NULL_STR:
-                    add_result_debug_commands(FullInputCommands.token_commands[command].to_send_cmd, [0], debug_send_list, ack_requests)
+                    add_result_debug_commands(FullInputCommands.token_commands[command].to_send_cmd, [0], out_queue, ack_requests)
                     success = True
 
         if not success:
@@ -446,59 +887,473 @@ def prepare_out_func(analyzed_list, is_debug_cmd, user_output):
     DEBUG_CMD_TRANSFER_FLAG = 0xC0
     print_data_out = False
     limit = 0x40 - 1
-    num_elems = 0
-    out_buf = []
-
-    if len(analyzed_list) == 0:
-        out_buf += [num_elems]
-    else:
-        num_elems = len(analyzed_list)
-        if(num_elems > limit):
-            num_elems = limit
-        out_val_elems = num_elems
-        if is_debug_cmd:
-            out_val_elems |= DEBUG_CMD_TRANSFER_FLAG
-        out_buf += out_val_elems.to_bytes(1, byteorder='little')
-        for i in range(num_elems):
-            out_buf += analyzed_list[i].to_bytes(1, byteorder='little')
-        if print_data_out:
-            user_output.set_out("OUT: " + str(out_buf[1:]), user_output.OUTPUT_DEBUG_TAG)
+    num_elems = len(analyzed_list)
+    if(num_elems > limit):
+        num_elems = limit
+
+    out_val_elems = num_elems
+    if is_debug_cmd and (num_elems > 0):
+        out_val_elems |= DEBUG_CMD_TRANSFER_FLAG
+    out_buf = bytearray([out_val_elems])
+    out_buf += bytes(analyzed_list[:num_elems])
+    if print_data_out and (num_elems > 0):
+        user_output.set_out("OUT: " + str(list(out_buf[1:])), user_output.OUTPUT_DEBUG_TAG)
     return out_buf, num_elems
 
+# Queue of what still has to go to the Pico.
+# Data is kept in the chunks it was added as, and cut into packets only when
+# they are sent, so popping a packet never copies the rest of the backlog.
+# Debug commands are already split into packets by GBridgeDebugCommands.
+# If alert_depth is set, a warning is printed when the queued data goes over it.
+# When both have something to send, packets are shared out by weight:
+# data_weight data packets for each debug_weight debug packets.
+# A debug packet which waited longer than debug_latency_target seconds goes out next.
+class OutboundQueue:
+    MAX_PACKET_DATA = 0x40 - 1
+
+    def __init__(self, user_output, alert_depth=None, data_weight=4, debug_weight=1, debug_latency_target=0.05):
+        self.user_output = user_output
+        self.alert_depth = alert_depth
+        self.alerted = False
+        self.data_weight = max(data_weight, 0)
+        self.debug_weight = max(debug_weight, 0)
+        self.debug_latency_target = debug_latency_target
+        self.data_credits = 0
+        self.debug_credits = 0
+        self.data_chunks = deque()
+        self.data_offset = 0
+        self.data_depth = 0
+        self.debug_packets = deque()
+        self.debug_times = deque()
+        self.max_data_depth = 0
+        self.max_debug_depth = 0
+        self.max_debug_wait = 0
+        self.data_packets_out = 0
+        self.data_bytes_out = 0
+        self.debug_packets_out = 0
+        self.debug_late_packets = 0
+
+    def __len__(self):
+        return self.data_depth + len(self.debug_packets)
+
+    def add_data(self, data):
+        if len(data) == 0:
+            return
+        self.data_chunks.append(data)
+        self.data_depth += len(data)
+        if self.data_depth > self.max_data_depth:
+            self.max_data_depth = self.data_depth
+        self.check_depth()
+
+    def add_debug(self, packets):
+        curr_time = time.monotonic()
+        for packet in packets:
+            self.debug_packets.append(packet)
+            self.debug_times.append(curr_time)
+        if len(self.debug_packets) > self.max_debug_depth:
+            self.max_debug_depth = len(self.debug_packets)
+
+    def has_data(self):
+        return self.data_depth > 0
+
+    def has_debug(self):
+        return len(self.debug_packets) > 0
+
+    def check_depth(self):
+        if self.alert_depth is None:
+            return
+        if (not self.alerted) and (self.data_depth > self.alert_depth):
+            self.alerted = True
+            self.user_output.set_out("Outbound queue over " + str(self.alert_depth) + " bytes: " + str(self.data_depth) + " bytes waiting", self.user_output.WARNING_TAG)
+        elif self.alerted and (self.data_depth <= (self.alert_depth // 2)):
+            self.alerted = False
+
+    # Takes up to limit bytes of data from the front of the queue
+    def pop_data(self, limit):
+        out_data = bytearray()
+        while (len(out_data) < limit) and (len(self.data_chunks) > 0):
+            chunk = self.data_chunks[0]
+            end = min(self.data_offset + limit - len(out_data), len(chunk))
+            out_data += chunk[self.data_offset:end]
+            if end == len(chunk):
+                self.data_chunks.popleft()
+                self.data_offset = 0
+            else:
+                self.data_offset = end
+        self.data_depth -= len(out_data)
+        self.check_depth()
+        return out_data
+
+    # Whether the next packet should be a debug one, when both have something to send
+    def debug_turn(self):
+        if (self.debug_latency_target is not None) and ((time.monotonic() - self.debug_times[0]) >= self.debug_latency_target):
+            self.debug_late_packets += 1
+            return True
+        if (self.data_credits <= 0) and (self.debug_credits <= 0):
+            self.data_credits = self.data_weight
+            self.debug_credits = self.debug_weight
+            if (self.data_credits <= 0) and (self.debug_credits <= 0):
+                return False
+        return self.data_credits <= 0
+
+    # Pops the next packet to send to the Pico
+    def pop_packet(self):
+        send_debug = len(self.debug_packets) > 0
+        contended = send_debug and (self.data_depth > 0)
+        if contended:
+            send_debug = self.debug_turn()
+        if send_debug:
+            wait_time = time.monotonic() - self.debug_times.popleft()
+            if wait_time > self.max_debug_wait:
+                self.max_debug_wait = wait_time
+            out_buf, num_elems = prepare_out_func(self.debug_packets.popleft(), True, self.user_output)
+            self.debug_packets_out += 1
+            if contended:
+                self.debug_credits -= 1
+        elif self.data_depth > 0:
+            out_buf, num_elems = prepare_out_func(self.pop_data(OutboundQueue.MAX_PACKET_DATA), False, self.user_output)
+            self.data_packets_out += 1
+            self.data_bytes_out += num_elems
+            if contended:
+                self.data_credits -= 1
+        else:
+            out_buf, num_elems = prepare_out_func([], True, self.user_output)
+        return out_buf, num_elems
+
+    def get_stats(self):
+        return {
+            "data_depth": self.data_depth,
+            "debug_depth": len(self.debug_packets),
+            "max_data_depth": self.max_data_depth,
+            "max_debug_depth": self.max_debug_depth,
+            "max_debug_wait": self.max_debug_wait,
+            "debug_late_packets": self.debug_late_packets,
+            "data_packets_out": self.data_packets_out,
+            "data_bytes_out": self.data_bytes_out,
+            "debug_packets_out": self.debug_packets_out
+        }
+
+# Whether the last exchange, the queues or the sockets still have work the host can move forward.
+# Socket data which is already buffered waits for the Game Boy, so it does not count.
+def is_link_busy(num_elems, read_data, out_queue, out_data_preparer):
+    TRANSFER_LENGTH_MASK = 0x3F
+    if (num_elems > 0) or (len(out_queue) > 0):
+        return True
+    if (len(read_data) > 0) and ((read_data[0] & TRANSFER_LENGTH_MASK) > 0):
+        return True
+    return out_data_preparer.has_pending_work()
+
+# Whether the Pico or the host have more queued than one packet could carry.
+# A full reply means the Pico most likely has more data waiting.
+def has_backlog(read_data, out_queue):
+    TRANSFER_LENGTH_MASK = 0x3F
+    if len(out_queue) > 0:
+        return True
+    return (len(read_data) > 0) and ((read_data[0] & TRANSFER_LENGTH_MASK) == TRANSFER_LENGTH_MASK)
+
 # Main function, gets the four basic USB connection send/recv functions, the way to get the user input class,
 # the transfer state's class and the user output class.
-def transfer_func(sender, receiver, list_sender, raw_receiver, pc_commands, transfer_state, user_output):
-    out_data_preparer = SocketThread(user_output)
+# The transfer policy decides how long to wait between USB exchanges.
+# If pipelined is set, the next USB exchange starts while the previous packet
+# is still being parsed, and its answer goes out as soon as it is ready.
+# While there is a backlog, up to burst_packets exchanges are done back-to-back
+# before waiting, so a backlog is drained in one go instead of one packet per wait.
+# A warning is printed if more than queue_alert_depth bytes wait to go to the Pico.
+# out_queue can be an OutboundQueue with different scheduling settings.
+# eeprom_cache is an EepromImageCache, to only send the changed parts of EEPROM images.
+# dns_cache is a DnsCache, to answer the Game Boy's repeated DNS queries from the host.
+# relay_pool is a RelayConnectionPool, to connect to the relay server without waiting for a handshake.
+# happy_eyeballs is a HappyEyeballs, to race IPv4 and IPv6 when connecting to the hosts it knows.
+# max_connections is the number of connection ids the Game Boy can use at the same time.
+def transfer_func(sender, receiver, list_sender, raw_receiver, pc_commands, transfer_state, user_output, transfer_policy=None, pipelined=False, burst_packets=8, queue_alert_depth=None, out_queue=None, eeprom_cache=None, dns_cache=None, relay_pool=None, happy_eyeballs=None, max_connections=None):
+    if transfer_policy is None:
+        transfer_policy = FixedTransferPolicy()
+    out_data_preparer = SocketThread(user_output, max_connections=max_connections)
+    out_data_preparer.eeprom_cache = eeprom_cache
+    out_data_preparer.bridge_sockets.dns_cache = dns_cache
+    out_data_preparer.bridge_sockets.relay_pool = relay_pool
+    out_data_preparer.bridge_sockets.happy_eyeballs = happy_eyeballs
     user_output.set_out("Type HELP to get a list of the available commands", user_output.INFO_TAG)
-    send_list = []
-    debug_send_list = []
+    if out_queue is None:
+        out_queue = OutboundQueue(user_output, alert_depth=queue_alert_depth)
     save_requests = dict()
     ack_requests = dict()
     while not transfer_state.end:
         while transfer_state.wait:
-            pass
-        asked_quit = interpret_input_keyboard(pc_commands, debug_send_list, save_requests, ack_requests, user_output)
+            sleep(0.01)
+        asked_quit = interpret_input_keyboard(pc_commands, out_queue, save_requests, ack_requests, user_output, debug_batches=out_data_preparer.debug_batches, eeprom_cache=out_data_preparer.eeprom_cache)
+        pump_debug_batches(out_data_preparer.debug_batches, out_queue)
 
         if asked_quit:
             transfer_state.end = True
 
-        if len(send_list) == 0:
-            if len(debug_send_list) > 0:
-                out_buf, num_elems = prepare_out_func(debug_send_list[0], True, user_output)
-                debug_send_list = debug_send_list[1:]
+        for i in range(burst_packets):
+            out_buf, num_elems = out_queue.pop_packet()
+            list_sender(out_buf, chunk_size = len(out_buf))
+
+            read_data = raw_receiver(0x40)
+            # Keeps the answers queue from filling up while the parser waits on it
+            if pipelined and (not out_data_preparer.can_queue()):
+                out_queue.add_data(out_data_preparer.get_processed())
+            out_data_preparer.set_processing(read_data, save_requests, ack_requests)
+            if pipelined:
+                for out_data in out_data_preparer.get_processed_nowait():
+                    out_queue.add_data(out_data)
             else:
-                out_buf, num_elems = prepare_out_func([], True, user_output)
-        else:
-            out_buf, num_elems = prepare_out_func(send_list, False, user_output)
-            send_list = send_list[num_elems:]
-        list_sender(out_buf, chunk_size = len(out_buf))
+                out_queue.add_data(out_data_preparer.get_processed())
 
-        out_data_preparer.set_processing(raw_receiver(0x40), save_requests, ack_requests)
-        send_list += out_data_preparer.get_processed()
-        sleep(0.01)
+            if not has_backlog(read_data, out_queue):
+                break
+
+        transfer_policy.wait(is_link_busy(num_elems, read_data, out_queue, out_data_preparer))
 
     out_data_preparer.end_processing()
 
+# Socket listener for the asyncio runtime.
+# Readers and writers are one-shot: they are armed only while the loop is idle,
+# so data which the Game Boy did not ask for yet can't make the loop spin.
+# Writers are only used to know when a pending connect completes.
+# Which sockets get a reader depends on the state of bridge_sockets' slots.
+class AsyncSocketEvents:
+    def __init__(self, loop, bridge_sockets):
+        self.loop = loop
+        self.bridge_sockets = bridge_sockets
+        self.event = asyncio.Event()
+        self.connecting = dict()
+        self.armed = set()
+        self.armed_writers = set()
+
+    # Readers are armed from the slots, when the loop goes idle
+    def socket_opened(self, conn, sock):
+        pass
+
+    def socket_closed(self, conn, sock):
+        self.disarm(sock)
+        self.disarm_writer(sock)
+        if self.connecting.get(conn) is sock:
+            del self.connecting[conn]
+
+    def socket_connecting(self, conn, sock):
+        self.connecting[conn] = sock
+
+    def socket_connected(self, conn, sock):
+        self.disarm_writer(sock)
+        if self.connecting.get(conn) is sock:
+            del self.connecting[conn]
+
+    def disarm(self, sock):
+        if sock in self.armed:
+            self.loop.remove_reader(sock)
+            self.armed.discard(sock)
+
+    def disarm_writer(self, sock):
+        if sock in self.armed_writers:
+            self.loop.remove_writer(sock)
+            self.armed_writers.discard(sock)
+
+    def on_ready(self, sock):
+        self.disarm(sock)
+        self.event.set()
+
+    def on_writable(self, sock):
+        self.disarm_writer(sock)
+        self.event.set()
+
+    # Only the sockets which can make progress are watched: the listening ones,
+    # and the ones whose new data can go in their buffer. A TCP socket which is
+    # not connected reports a hang up, and one at EOF (or with a full buffer)
+    # stays readable, so they would keep waking the loop up.
+    def wants_read(self, slot):
+        if slot.listening:
+            return True
+        return self.bridge_sockets.can_read_ahead(slot) and (not slot.recv_buffer.is_full())
+
+    def arm(self):
+        for slot in self.bridge_sockets.slots:
+            sock = slot.sock
+            if sock is None:
+                continue
+            if not self.wants_read(slot):
+                self.disarm(sock)
+            elif sock not in self.armed:
+                self.loop.add_reader(sock, self.on_ready, sock)
+                self.armed.add(sock)
+        for sock in self.connecting.values():
+            if sock not in self.armed_writers:
+                self.loop.add_writer(sock, self.on_writable, sock)
+                self.armed_writers.add(sock)
+
+    # Waits up to timeout seconds, or until a socket is ready
+    async def wait(self, timeout):
+        self.event.clear()
+        self.arm()
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def close(self):
+        for sock in list(self.armed):
+            self.disarm(sock)
+        for sock in list(self.armed_writers):
+            self.disarm_writer(sock)
+
+# Default user input class for the asyncio runtime.
+# Same interface as KeyboardThread, but stdin is read by the event loop.
+class AsyncKeyboardInput:
+    def __init__(self):
+        self.received = []
+        self.partial = b""
+
+    def get_input(self):
+        out = self.received
+        self.received = []
+        return out
+
+    def add_data(self, data):
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines[-1]
+        for line in lines[:-1]:
+            self.received += [line.decode(errors="replace").rstrip("\r")]
+
+    def read_ready(self):
+        data = os.read(sys.stdin.fileno(), 0x400)
+        if len(data) == 0:
+            asyncio.get_running_loop().remove_reader(sys.stdin.fileno())
+            return
+        self.add_data(data)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_reader(sys.stdin.fileno(), self.read_ready)
+            return
+        except (NotImplementedError, ValueError, OSError):
+            pass
+        # Windows' event loop can't watch stdin, wait on it from a thread instead
+        while True:
+            read_data = await loop.run_in_executor(None, sys.stdin.readline)
+            if read_data == "":
+                break
+            self.received += [read_data.rstrip("\n")]
+
+def usb_exchange(usb_handler, out_buf):
+    usb_handler.sendList(out_buf, chunk_size = len(out_buf))
+    return usb_handler.receiveByte_raw(0x40)
+
+# Sends the prepared packets one at a time, reading the reply to each one.
+# Once they are over, empty packets keep going out while the Pico's replies
+# are full, up to max_packets exchanges. Returns all the replies.
+def usb_burst_exchange(usb_handler, out_bufs, max_packets):
+    TRANSFER_LENGTH_MASK = 0x3F
+    read_datas = []
+    for out_buf in out_bufs:
+        read_datas += [usb_exchange(usb_handler, out_buf)]
+    while len(read_datas) < max_packets:
+        read_data = read_datas[-1]
+        if (len(read_data) == 0) or ((read_data[0] & TRANSFER_LENGTH_MASK) != TRANSFER_LENGTH_MASK):
+            break
+        read_datas += [usb_exchange(usb_handler, bytes([0]))]
+    return read_datas
+
+# asyncio version of transfer_func. Multiple bridges can share the same event loop.
+# The USB backends are blocking, so each bridge gets its own worker thread for them,
+# while packet parsing and the sockets are handled by the event loop itself.
+# Up to burst_packets exchanges are done by the worker thread in one go.
+# queue_alert_depth, out_queue, eeprom_cache, dns_cache, relay_pool, happy_eyeballs and max_connections work like in transfer_func.
+async def async_transfer_func(usb_handler, pc_commands, transfer_state, user_output, transfer_policy=None, burst_packets=8, queue_alert_depth=None, out_queue=None, eeprom_cache=None, dns_cache=None, relay_pool=None, happy_eyeballs=None, max_connections=None):
+    if transfer_policy is None:
+        transfer_policy = AdaptiveTransferPolicy()
+    loop = asyncio.get_running_loop()
+    usb_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    out_data_preparer = SocketThread(user_output, start_thread=False, max_connections=max_connections)
+    socket_events = AsyncSocketEvents(loop, out_data_preparer.bridge_sockets)
+    out_data_preparer.eeprom_cache = eeprom_cache
+    out_data_preparer.bridge_sockets.dns_cache = dns_cache
+    out_data_preparer.bridge_sockets.relay_pool = relay_pool
+    out_data_preparer.bridge_sockets.happy_eyeballs = happy_eyeballs
+    out_data_preparer.bridge_sockets.socket_events = socket_events
+    keyboard_task = None
+    if isinstance(pc_commands, AsyncKeyboardInput):
+        keyboard_task = asyncio.ensure_future(pc_commands.run())
+    user_output.set_out("Type HELP to get a list of the available commands", user_output.INFO_TAG)
+    if out_queue is None:
+        out_queue = OutboundQueue(user_output, alert_depth=queue_alert_depth)
+    save_requests = dict()
+    ack_requests = dict()
+    try:
+        while not transfer_state.end:
+            while transfer_state.wait:
+                await asyncio.sleep(0.01)
+            asked_quit = interpret_input_keyboard(pc_commands, out_queue, save_requests, ack_requests, user_output, debug_batches=out_data_preparer.debug_batches, eeprom_cache=out_data_preparer.eeprom_cache)
+            pump_debug_batches(out_data_preparer.debug_batches, out_queue)
+
+            if asked_quit:
+                transfer_state.end = True
+
+            out_buf, num_elems = out_queue.pop_packet()
+            out_bufs = [out_buf]
+            while (len(out_bufs) < burst_packets) and (len(out_queue) > 0):
+                out_buf, more_elems = out_queue.pop_packet()
+                out_bufs += [out_buf]
+                num_elems += more_elems
+            read_datas = await loop.run_in_executor(usb_executor, usb_burst_exchange, usb_handler, out_bufs, burst_packets)
+            for read_data in read_datas:
+                out_queue.add_data(out_data_preparer.process_data(read_data, save_requests, ack_requests))
+
+            wait_time = transfer_policy.get_wait_time(is_link_busy(num_elems, read_data, out_queue, out_data_preparer))
+            if wait_time > 0:
+                await socket_events.wait(wait_time)
+            else:
+                # Let the other bridges run
+                await asyncio.sleep(0)
+    finally:
+        socket_events.close()
+        if keyboard_task is not None:
+            keyboard_task.cancel()
+        usb_executor.shutdown(wait=False)
+
+# Splits what a stream backend (serial, CDC) reads back into the Pico's packets.
+# Each packet is a header with its length in the low 6 bits, followed by the data.
+# Replies are shorter than 0x40 bytes most of the time, so reading a fixed size
+# would wait for the timeout. Whatever is already queued is read in one call,
+# and the packets after the first one are kept for the next reads.
+class PacketReader:
+    TRANSFER_LENGTH_MASK = 0x3F
+
+    def __init__(self, read_function, available_function=None):
+        self.read_function = read_function
+        self.available_function = available_function
+        self.buffer = bytearray()
+
+    def reset(self):
+        self.buffer = bytearray()
+
+    # How many bytes are still missing for the first packet to be complete
+    def missing_bytes(self):
+        if len(self.buffer) == 0:
+            return 1
+        packet_size = 1 + (self.buffer[0] & PacketReader.TRANSFER_LENGTH_MASK)
+        return max(packet_size - len(self.buffer), 0)
+
+    def read_packet(self):
+        missing = self.missing_bytes()
+        while missing > 0:
+            size = missing
+            if self.available_function is not None:
+                size = max(size, self.available_function())
+            data = self.read_function(size)
+            if len(data) == 0:
+                # Timeout, drop the partial packet
+                self.buffer = bytearray()
+                return b""
+            self.buffer += data
+            missing = self.missing_bytes()
+        packet_size = 1 + (self.buffer[0] & PacketReader.TRANSFER_LENGTH_MASK)
+        packet = bytes(self.buffer[:packet_size])
+        del self.buffer[:packet_size]
+        return packet
+
 class LibUSBSendRecv:
     def __init__(self, epOut, epIn, dev, reattach, max_usb_timeout_r, max_usb_timeout_w):
         self.epOut = epOut
@@ -535,9 +1390,125 @@ class LibUSBSendRecv:
             if self.reattach:
                 self.dev.attach_kernel_driver(0)
 
+# libusb backend based on python-libusb1, with asynchronous IN transfers.
+# num_transfers bulk IN transfers are always queued, and an event thread completes them,
+# so a reply is handed over as soon as the Pico sends it, instead of waiting in a synchronous read.
+class LibUSB1AsyncSendRecv:
+    def __init__(self, context, handle, interface, epOut, epIn, reattach, max_usb_timeout_r, max_usb_timeout_w, num_transfers=4, packet_size=0x40):
+        import usb1
+        self.usb1 = usb1
+        self.context = context
+        self.handle = handle
+        self.interface = interface
+        self.epOut = epOut
+        self.epIn = epIn
+        self.reattach = reattach
+        self.max_usb_timeout_r = max_usb_timeout_r
+        self.max_usb_timeout_w = max_usb_timeout_w
+        self.received = queue.Queue()
+        self.running = True
+        # Set once an IN transfer fails, it's raised by receiveByte_raw
+        self.error = None
+        self.transfer_errors = {
+            usb1.TRANSFER_NO_DEVICE: usb1.USBErrorNoDevice,
+            usb1.TRANSFER_STALL: usb1.USBErrorPipe,
+            usb1.TRANSFER_OVERFLOW: usb1.USBErrorOverflow
+        }
+        self.transfers = []
+        for i in range(num_transfers):
+            transfer = self.handle.getTransfer()
+            transfer.setBulk(self.epIn, packet_size, callback=self.on_transfer_done)
+            transfer.submit()
+            self.transfers += [transfer]
+        self.event_thread = threading.Thread(target=self.handle_events)
+        self.event_thread.daemon = True
+        self.event_thread.start()
+
+    def handle_events(self):
+        while self.running or any(transfer.isSubmitted() for transfer in self.transfers):
+            try:
+                self.context.handleEventsTimeout(0.1)
+            except self.usb1.USBErrorInterrupted:
+                pass
+            except self.usb1.USBError:
+                self.running = False
+                return
+
+    # Transfers complete in the order they were submitted, and they go back
+    # to the end of the queue, so the replies stay in order.
+    # A transfer which failed is not submitted again, since it would most likely
+    # fail again right away: the error goes to the reader instead.
+    def on_transfer_done(self, transfer):
+        status = transfer.getStatus()
+        if status == self.usb1.TRANSFER_COMPLETED:
+            self.received.put(bytes(transfer.getBuffer()[:transfer.getActualLength()]))
+        elif status == self.usb1.TRANSFER_CANCELLED:
+            return
+        elif status != self.usb1.TRANSFER_TIMED_OUT:
+            self.set_error(self.transfer_errors.get(status, self.usb1.USBErrorIO)())
+            return
+        if self.running:
+            try:
+                transfer.submit()
+            except self.usb1.USBError as e:
+                self.set_error(e)
+
+    def set_error(self, error):
+        if self.error is None:
+            self.error = error
+        # Wakes the reader up
+        self.received.put(None)
+
+    # Code dependant on this connection method
+    def sendByte(self, byte_to_send, num_bytes):
+        self.handle.bulkWrite(self.epOut, byte_to_send.to_bytes(num_bytes, byteorder='big'), timeout=int(self.max_usb_timeout_w * 1000))
+
+    # Code dependant on this connection method
+    def sendList(self, data, chunk_size=8):
+        num_iters = int(len(data)/chunk_size)
+        for i in range(num_iters):
+            self.handle.bulkWrite(self.epOut, bytes(data[i*chunk_size:(i+1)*chunk_size]), timeout=int(self.max_usb_timeout_w * 1000))
+        if (num_iters*chunk_size) != len(data):
+            self.handle.bulkWrite(self.epOut, bytes(data[num_iters*chunk_size:]), timeout=int(self.max_usb_timeout_w * 1000))
+
+    def receiveByte(self, num_bytes):
+        return int.from_bytes(self.receiveByte_raw(num_bytes), byteorder='big')
+
+    # Returns as soon as a reply is in. The timeout only matters if the Pico stops answering.
+    # Raises the error of the IN transfers, once the replies which came before it are read.
+    def receiveByte_raw(self, num_bytes):
+        if (self.error is not None) and self.received.empty():
+            raise self.error
+        try:
+            data = self.received.get(timeout=self.max_usb_timeout_r)
+        except queue.Empty:
+            return b""
+        if data is None:
+            raise self.error
+        return data[:num_bytes]
+
+    def kill_function(self):
+        self.running = False
+        for transfer in self.transfers:
+            try:
+                transfer.cancel()
+            except self.usb1.USBError:
+                pass
+        self.event_thread.join(1)
+        try:
+            self.handle.releaseInterface(self.interface)
+            if(os.name != "nt"):
+                if self.reattach:
+                    self.handle.attachKernelDriver(0)
+        except self.usb1.USBError:
+            pass
+        self.handle.close()
+        self.context.close()
+
 class PySerialSendRecv:
     def __init__(self, serial_port):
         self.serial_port = serial_port
+        self.packet_reader = PacketReader(self.serial_port.read, lambda: self.serial_port.in_waiting)
 
     # Code dependant on this connection method
     def sendByte(self, byte_to_send, num_bytes):
@@ -556,10 +1527,12 @@ class PySerialSendRecv:
         recv = int.from_bytes(self.serial_port.read(num_bytes), byteorder='big')
         return recv
 
+    # Returns one whole packet. Everything already queued is read in one call.
     def receiveByte_raw(self, num_bytes):
-        return self.serial_port.read(num_bytes)
+        return self.packet_reader.read_packet()
     
     def kill_function(self):
+        self.packet_reader.reset()
         self.serial_port.reset_input_buffer()
         self.serial_port.reset_output_buffer()
         self.serial_port.close()
@@ -567,6 +1540,7 @@ class PySerialSendRecv:
 class WinUSBCDCSendRecv:
     def __init__(self, p):
         self.p = p
+        self.packet_reader = PacketReader(lambda size: self.p.read(size=size))
         
     # Code dependant on this connection method
     def sendByte(self, byte_to_send, num_bytes):
@@ -584,19 +1558,139 @@ class WinUSBCDCSendRecv:
         recv = int.from_bytes(self.p.read(size=num_bytes), byteorder='big')
         return recv
 
+    # Returns one whole packet
     def receiveByte_raw(self, num_bytes):
-        return self.p.read(size=num_bytes)
+        return self.packet_reader.read_packet()
     
     def kill_function(self):
         pass
 
+# Wraps a USB handler, and reconnects when it stops working, instead of letting the exception
+# end the bridge. The transfer loop keeps running on top of it, so the sockets, the queues
+# and the parser state all survive a short disconnection.
+# reopen_function takes no arguments and returns a new handler (or None). It's called again
+# with an exponential backoff (from min_backoff to max_backoff seconds) until it succeeds,
+# transfer_state.end is set, or max_attempts failed attempts were done (None for no limit).
+# Once it gives up, transfer_state.end is set, and it acts as a link which sends nothing and
+# reads nothing, so the transfer loop ends the usual way.
+# Only the errors which mean the device is gone start a reconnection. A read which
+# timed out is an empty read, and any other error is raised as usual.
+# A packet which failed to go out is sent again on the new link. A reply which got lost
+# can't be asked again: the GBridge checksums make the Game Boy retry those commands.
+class ReconnectingSendRecv:
+    DEVICE_LOST_ERRNOS = set([errno.ENODEV, errno.EIO, errno.ENXIO])
+
+    def __init__(self, usb_handler, reopen_function, transfer_state, user_output, min_backoff=0.1, max_backoff=5.0, max_attempts=None, on_reconnect=None):
+        self.usb_handler = usb_handler
+        self.on_reconnect = on_reconnect
+        self.reopen_function = reopen_function
+        self.transfer_state = transfer_state
+        self.user_output = user_output
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.reconnections = 0
+        self.given_up = False
+
+    # Whether exception means the device went away.
+    # Only the library of the backend in use was imported, so the others are not checked.
+    # PyUSB's errors carry the errno of the libusb error (ENODEV, EIO...).
+    def is_device_lost(exception):
+        usb1 = sys.modules.get("usb1")
+        if (usb1 is not None) and isinstance(exception, (usb1.USBErrorNoDevice, usb1.USBErrorIO)):
+            return True
+        serial = sys.modules.get("serial")
+        if (serial is not None) and isinstance(exception, serial.SerialException) and (not isinstance(exception, serial.SerialTimeoutException)):
+            return True
+        return isinstance(exception, OSError) and (exception.errno in ReconnectingSendRecv.DEVICE_LOST_ERRNOS)
+
+    def is_timeout(exception):
+        usb1 = sys.modules.get("usb1")
+        if (usb1 is not None) and isinstance(exception, usb1.USBErrorTimeout):
+            return True
+        return isinstance(exception, TimeoutError) or (isinstance(exception, OSError) and (exception.errno == errno.ETIMEDOUT))
+
+    def close_handler(self):
+        if self.usb_handler is not None:
+            try:
+                self.usb_handler.kill_function()
+            except Exception:
+                pass
+            self.usb_handler = None
+
+    # Returns whether the device is back
+    def reconnect(self):
+        self.close_handler()
+        self.user_output.set_out("USB connection lost, reconnecting...", self.user_output.USB_TAG)
+        backoff = self.min_backoff
+        attempts = 0
+        while not self.transfer_state.end:
+            try:
+                self.usb_handler = self.reopen_function()
+            except Exception:
+                self.usb_handler = None
+            if self.usb_handler is not None:
+                self.reconnections += 1
+                if self.on_reconnect is not None:
+                    self.on_reconnect()
+                self.user_output.set_out("USB connection established again!", self.user_output.USB_TAG)
+                return True
+            attempts += 1
+            if (self.max_attempts is not None) and (attempts >= self.max_attempts):
+                self.user_output.set_out("USB device not found again after " + str(attempts) + " attempts", self.user_output.EXCEPTION_TAG)
+                break
+            sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+        self.given_up = True
+        self.transfer_state.end = True
+        return False
+
+    # Code dependant on this connection method
+    def sendByte(self, byte_to_send, num_bytes):
+        self.sendList(byte_to_send.to_bytes(num_bytes, byteorder='big'), chunk_size=num_bytes)
+
+    # Code dependant on this connection method
+    def sendList(self, data, chunk_size=8):
+        while not self.given_up:
+            if (self.usb_handler is None) and (not self.reconnect()):
+                return
+            try:
+                self.usb_handler.sendList(data, chunk_size=chunk_size)
+                return
+            except Exception as e:
+                if not ReconnectingSendRecv.is_device_lost(e):
+                    raise
+                self.close_handler()
+
+    def receiveByte(self, num_bytes):
+        return int.from_bytes(self.receiveByte_raw(num_bytes), byteorder='big')
+
+    def receiveByte_raw(self, num_bytes):
+        if self.given_up:
+            return b""
+        if (self.usb_handler is None) and (not self.reconnect()):
+            return b""
+        try:
+            return self.usb_handler.receiveByte_raw(num_bytes)
+        except Exception as e:
+            if ReconnectingSendRecv.is_timeout(e):
+                return b""
+            if not ReconnectingSendRecv.is_device_lost(e):
+                raise
+            self.reconnect()
+            return b""
+
+    def kill_function(self):
+        self.close_handler()
+
 # Things for the USB connection part
 def exit_gracefully(usb_handler):
     if usb_handler is not None:
         usb_handler.kill_function()
     os._exit(1)
 
-def libusb_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output):
+# location is (bus, address), to pick a specific device when more are connected
+def libusb_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output, location=None):
     import usb.core
     import usb.util
     dev = None
@@ -604,7 +1698,8 @@ def libusb_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output):
         devices = list(usb.core.find(find_all=True,idVendor=VID, idProduct=PID))
         for d in devices:
             #user_output.set_out("Device: " + str(d.product), user_output.USB_TAG)
-            dev = d
+            if (location is None) or ((d.bus, d.address) == tuple(location)):
+                dev = d
         if dev is None:
             return None
         reattach = False
@@ -650,6 +1745,57 @@ def libusb_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output):
         return None
     return LibUSBSendRecv(epOut, epIn, dev, reattach, max_usb_timeout_r, max_usb_timeout_w)
 
+# Same setup as libusb_method, but with python-libusb1 and asynchronous reads
+def libusb1_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output, num_transfers=4, location=None):
+    import usb1
+    INTERFACE = 2
+    context = None
+    handle = None
+    try:
+        context = usb1.USBContext()
+        for device in context.getDeviceIterator(skip_on_error=True):
+            if (device.getVendorID() == VID) and (device.getProductID() == PID):
+                if (location is None) or ((device.getBusNumber(), device.getDeviceAddress()) == tuple(location)):
+                    handle = device.open()
+                    break
+        if handle is None:
+            context.close()
+            return None
+        reattach = False
+        if(os.name != "nt"):
+            if handle.kernelDriverActive(0):
+                try:
+                    reattach = True
+                    handle.detachKernelDriver(0)
+                except usb1.USBError as e:
+                    sys.exit("Could not detach kernel driver: %s" % str(e))
+
+        if handle.getConfiguration() != 1:
+            handle.setConfiguration(1)
+        handle.claimInterface(INTERFACE)
+
+        epIn = None
+        epOut = None
+        for setting in handle.getDevice().iterSettings():
+            if (setting.getNumber() == INTERFACE) and (setting.getAlternateSetting() == 0):
+                for endpoint in setting:
+                    if (endpoint.getAddress() & usb1.ENDPOINT_DIR_MASK) == usb1.ENDPOINT_IN:
+                        epIn = endpoint.getAddress()
+                    else:
+                        epOut = endpoint.getAddress()
+
+        assert epIn is not None
+        assert epOut is not None
+
+        handle.controlWrite(1, 0x22, 0x01, INTERFACE, b"", timeout=int(max_usb_timeout_w * 1000))
+        return LibUSB1AsyncSendRecv(context, handle, INTERFACE, epOut, epIn, reattach, max_usb_timeout_r, max_usb_timeout_w, num_transfers=num_transfers)
+    except:
+        if handle is not None:
+            handle.close()
+        if context is not None:
+            context.close()
+        return None
+
 def winusbcdc_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output):
     if(os.name == "nt"):
         from winusbcdc import ComPort
@@ -666,7 +1812,8 @@ def winusbcdc_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output
         return None
     return WinUSBCDCSendRecv(p)
 
-def serial_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output):
+# location is the port's name, to pick a specific device when more are connected
+def serial_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output, location=None):
     import serial
     import serial.tools.list_ports
     try:
@@ -675,7 +1822,7 @@ def serial_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output):
         port = None
         for device in ports:
             if(device.vid is not None) and (device.pid is not None):
-                if(device.vid == VID) and (device.pid == PID):
+                if(device.vid == VID) and (device.pid == PID) and ((location is None) or (device.device == location)):
                     port = device.device
                     break
         if port is None:
@@ -685,13 +1832,121 @@ def serial_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output):
         return None
     return PySerialSendRecv(serial_port)
 
-# Initial function which sets up the USB connection and then calls the Main function.
-# Gets the ending function once the connection ends, then the USB identifiers, and the USB Timeout.
-# Also receives the user input class, the transfer state's class and the user output class.
-def start_usb_transfer(end_function, VID, PID, max_usb_timeout_r, max_usb_timeout_w, pc_commands, transfer_state, user_output, do_ctrl_c_handling=False):
+# Methods which can open one specific device, given its location
+usb_device_methods = {
+    "LIBUSB1": libusb1_method,
+    "LIBUSB": libusb_method,
+    "SERIAL": serial_method
+}
+
+# Identifies one connected adapter, for list_usb_devices and open_usb_device
+class UsbDeviceId:
+    def __init__(self, method, location, serial_number):
+        self.method = method
+        self.location = location
+        self.serial_number = serial_number
+
+    def __str__(self):
+        location = self.location
+        if isinstance(location, tuple):
+            location = ":".join(str(elem) for elem in location)
+        return self.method + ":" + str(location)
+
+# Lists all the connected adapters, using the first available library
+# in the same order as find_usb_handler, so each device is listed only once.
+# If serial_numbers is set, only the devices with those serial numbers are listed.
+# If backend is set, only its library is used
+def list_usb_devices(VID, PID, serial_numbers=None, backend=None):
+    devices = []
+    found_library = False
+    try:
+        if backend not in [None, "LIBUSB"]:
+            raise ImportError
+        import usb.core
+        import usb.util
+        found_library = True
+        for device in usb.core.find(find_all=True, idVendor=VID, idProduct=PID):
+            serial_number = None
+            try:
+                serial_number = usb.util.get_string(device, device.iSerialNumber)
+            except:
+                pass
+            devices += [UsbDeviceId("LIBUSB", (device.bus, device.address), serial_number)]
+    except ImportError:
+        pass
+    if (not found_library) and (backend in [None, "LIBUSB1"]):
+        try:
+            import usb1
+            found_library = True
+            with usb1.USBContext() as context:
+                for device in context.getDeviceIterator(skip_on_error=True):
+                    if (device.getVendorID() == VID) and (device.getProductID() == PID):
+                        serial_number = None
+                        try:
+                            serial_number = device.getSerialNumber()
+                        except usb1.USBError:
+                            pass
+                        devices += [UsbDeviceId("LIBUSB1", (device.getBusNumber(), device.getDeviceAddress()), serial_number)]
+        except ImportError:
+            pass
+    if (not found_library) and (backend in [None, "SERIAL"]):
+        try:
+            import serial.tools.list_ports
+            for device in serial.tools.list_ports.comports():
+                if (device.vid == VID) and (device.pid == PID):
+                    devices += [UsbDeviceId("SERIAL", device.device, device.serial_number)]
+        except ImportError:
+            pass
+    if serial_numbers is not None:
+        devices = [device for device in devices if device.serial_number in serial_numbers]
+    return devices
+
+# num_transfers is the number of reads queued by python-libusb1
+def open_usb_device(device_id, VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output, num_transfers=4):
+    if device_id.method == "LIBUSB1":
+        return libusb1_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output, num_transfers=num_transfers, location=device_id.location)
+    return usb_device_methods[device_id.method](VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output, location=device_id.location)
+
+# Returns a usb_method which opens the adapter with the given serial number.
+# It opens nothing if more adapters report it (older firmwares use the same serial on all of them).
+def get_serial_usb_method(serial_number, backend=None, num_transfers=4):
+    def serial_usb_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output):
+        device_ids = list_usb_devices(VID, PID, [serial_number], backend=backend)
+        if len(device_ids) != 1:
+            if len(device_ids) > 1:
+                user_output.set_out("More adapters have the serial number " + serial_number + ": update their firmware", user_output.USB_TAG)
+            return None
+        return open_usb_device(device_ids[0], VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output, num_transfers=num_transfers)
+    return serial_usb_method
+
+# Returns a usb_method which only uses the given backend (any, if it's None)
+def get_usb_method(backend=None, num_transfers=4):
+    def usb_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output):
+        return find_usb_handler(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output, backend=backend, num_transfers=num_transfers)
+    return usb_method
+
+# Tries all the available USB methods, and returns the handler of the first one
+# which finds the device, or None (after telling the user what may be missing).
+# The backends which can be chosen, and the library each one needs
+usb_backends = {
+    "LIBUSB": "PyUSB",
+    "LIBUSB1": "python-libusb1",
+    "SERIAL": "PySerial",
+    "WINUSBCDC": "WinUsbCDC"
+}
+
+# If backend is set, only that one is tried.
+# num_transfers is the number of reads queued by python-libusb1.
+def find_usb_handler(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output, backend=None, num_transfers=4):
     try_serial = False
     try_libusb = False
+    try_libusb1 = False
     try_winusbcdc = False
+    try:
+        import usb1
+        try_libusb1 = True
+    except:
+        pass
     try:
         import usb.core
         import usb.util
@@ -713,6 +1968,59 @@ def start_usb_transfer(end_function, VID, PID, max_usb_timeout_r, max_usb_timeou
         pass
 
     usb_handler = None
+    missing = ""
+    if not try_serial:
+        missing += "PySerial, "
+    if (not try_libusb) and (not try_libusb1):
+        missing += "PyUSB (or python-libusb1), "
+    if(os.name == "nt") and (not try_winusbcdc):
+        missing += "WinUsbCDC, "
+
+    if backend is not None:
+        found = {"LIBUSB": try_libusb, "LIBUSB1": try_libusb1, "SERIAL": try_serial, "WINUSBCDC": try_winusbcdc}
+        missing = ""
+        if not found[backend]:
+            missing = usb_backends[backend] + ", "
+        try_libusb = try_libusb and (backend == "LIBUSB")
+        try_libusb1 = try_libusb1 and (backend == "LIBUSB1")
+        try_serial = try_serial and (backend == "SERIAL")
+        try_winusbcdc = try_winusbcdc and (backend == "WINUSBCDC")
+    # PyUSB is the one which was tested on hardware the most, python-libusb1 is only used without it
+    elif try_libusb:
+        try_libusb1 = False
+
+    if(usb_handler is None) and try_libusb:
+        usb_handler = libusb_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output)
+    if(usb_handler is None) and try_libusb1:
+        usb_handler = libusb1_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output, num_transfers=num_transfers)
+    if (usb_handler is None) and try_serial:
+        usb_handler = serial_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output)
+    if (usb_handler is None) and try_winusbcdc:
+        usb_handler = winusbcdc_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output)
+
+    if usb_handler is not None:
+        user_output.set_out("USB connection established!", user_output.USB_TAG)
+    else:
+        user_output.set_out("Couldn't find USB device!", user_output.USB_TAG)
+        if missing != "":
+            user_output.set_out("If the device is attached, try installing " + missing[:-2], user_output.USB_TAG)
+    return usb_handler
+
+# What to do once the USB connection is back. The adapter may have rebooted, so
+# its EEPROM must be confirmed again before trusting eeprom_cache.
+def get_reconnect_function(eeprom_cache):
+    if eeprom_cache is None:
+        return None
+    return eeprom_cache.forget_confirmed
+
+# Initial function which sets up the USB connection and then calls the Main function.
+# Gets the ending function once the connection ends, then the USB identifiers, and the USB Timeout.
+# Also receives the user input class, the transfer state's class and the user output class.
+# usb_method has the same arguments as find_usb_handler and returns the handler to use.
+# It can be used to run on something else than a real device (e.g. virtual_pico.virtual_method).
+# With reconnect, a USB error makes it look for the device again, instead of ending.
+def start_usb_transfer(end_function, VID, PID, max_usb_timeout_r, max_usb_timeout_w, pc_commands, transfer_state, user_output, do_ctrl_c_handling=False, transfer_policy=None, pipelined=False, usb_method=find_usb_handler, eeprom_cache=None, reconnect=True, dns_cache=None, relay_pool=None, happy_eyeballs=None):
+    usb_handler = None
 
     def signal_handler_ctrl_c(sig, frame):
         user_output.set_out("You pressed Ctrl+C!", user_output.END_TAG)
@@ -723,27 +2031,13 @@ def start_usb_transfer(end_function, VID, PID, max_usb_timeout_r, max_usb_timeou
 
     # The execution path
     try:
-        if(usb_handler is None) and try_libusb:
-            usb_handler = libusb_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output)
-        if (usb_handler is None) and try_serial:
-            usb_handler = serial_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output)
-        if (usb_handler is None) and try_winusbcdc:
-            usb_handler = winusbcdc_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output)
+        usb_handler = usb_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output)
+
+        if (usb_handler is not None) and reconnect:
+            usb_handler = ReconnectingSendRecv(usb_handler, lambda: usb_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output), transfer_state, user_output, on_reconnect=get_reconnect_function(eeprom_cache))
 
         if usb_handler is not None:
-            user_output.set_out("USB connection established!", user_output.USB_TAG)
-            transfer_func(usb_handler.sendByte, usb_handler.receiveByte, usb_handler.sendList, usb_handler.receiveByte_raw, pc_commands, transfer_state, user_output)
-        else:
-            user_output.set_out("Couldn't find USB device!", user_output.USB_TAG)
-            missing = ""
-            if not try_serial:
-                missing += "PySerial, "
-            if not try_libusb:
-                missing += "PyUSB, "
-            if(os.name == "nt") and (not try_winusbcdc):
-                missing += "WinUsbCDC, "
-            if missing != "":
-                user_output.set_out("If the device is attached, try installing " + missing[:-2], user_output.USB_TAG)
+            transfer_func(usb_handler.sendByte, usb_handler.receiveByte, usb_handler.sendList, usb_handler.receiveByte_raw, pc_commands, transfer_state, user_output, transfer_policy=transfer_policy, pipelined=pipelined, eeprom_cache=eeprom_cache, dns_cache=dns_cache, relay_pool=relay_pool, happy_eyeballs=happy_eyeballs)
         
         end_function(usb_handler)
     except:
@@ -751,9 +2045,71 @@ def start_usb_transfer(end_function, VID, PID, max_usb_timeout_r, max_usb_timeou
         user_output.set_out("Unexpected exception: " + str(sys.exc_info()[0]), user_output.EXCEPTION_TAG)
         end_function(usb_handler)
 
+# asyncio version of start_usb_transfer. Same arguments, but it must be awaited.
+# pc_commands can be an AsyncKeyboardInput, which is then run on the same event loop.
+async def start_usb_transfer_async(end_function, VID, PID, max_usb_timeout_r, max_usb_timeout_w, pc_commands, transfer_state, user_output, do_ctrl_c_handling=False, transfer_policy=None, usb_method=find_usb_handler, eeprom_cache=None, reconnect=True, dns_cache=None, relay_pool=None, happy_eyeballs=None):
+    usb_handler = None
+
+    def signal_handler_ctrl_c(sig, frame):
+        user_output.set_out("You pressed Ctrl+C!", user_output.END_TAG)
+        transfer_state.end = True
+
+    if do_ctrl_c_handling:
+        signal.signal(signal.SIGINT, signal_handler_ctrl_c)
+
+    # The execution path
+    try:
+        loop = asyncio.get_running_loop()
+        usb_handler = await loop.run_in_executor(None, usb_method, VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output)
+
+        if (usb_handler is not None) and reconnect:
+            usb_handler = ReconnectingSendRecv(usb_handler, lambda: usb_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output), transfer_state, user_output, on_reconnect=get_reconnect_function(eeprom_cache))
+
+        if usb_handler is not None:
+            await async_transfer_func(usb_handler, pc_commands, transfer_state, user_output, transfer_policy=transfer_policy, eeprom_cache=eeprom_cache, dns_cache=dns_cache, relay_pool=relay_pool, happy_eyeballs=happy_eyeballs)
+
+        end_function(usb_handler)
+    except:
+        #traceback.print_exc()
+        user_output.set_out("Unexpected exception: " + str(sys.exc_info()[0]), user_output.EXCEPTION_TAG)
+        end_function(usb_handler)
+
 if __name__ == "__main__":
     VID = 0xcafe
     PID = 0x4011
     max_usb_timeout_w = 5
     max_usb_timeout_r = 0.1
-    start_usb_transfer(exit_gracefully, VID, PID, max_usb_timeout_r, max_usb_timeout_w, KeyboardThread(), TransferStatus(), UserOutput(), do_ctrl_c_handling=True)
+    transfer_policy_name = "ADAPTIVE"
+    backend = None
+    num_transfers = 4
+    # Options: --backend <backend> and --transfers <reads queued by python-libusb1>
+    arguments = []
+    i = 1
+    while i < len(sys.argv):
+        if (sys.argv[i] in ["--backend", "--transfers"]) and ((i + 1) >= len(sys.argv)):
+            sys.exit("Missing value of " + sys.argv[i])
+        if sys.argv[i] == "--backend":
+            backend = sys.argv[i + 1].upper().strip()
+            i += 2
+        elif sys.argv[i] == "--transfers":
+            num_transfers = int(sys.argv[i + 1])
+            i += 2
+        else:
+            arguments += [sys.argv[i]]
+            i += 1
+    if len(arguments) > 0:
+        transfer_policy_name = arguments[0].upper().strip()
+    if transfer_policy_name not in transfer_policies.keys():
+        sys.exit("Unknown transfer policy: " + transfer_policy_name + " (available: " + ", ".join(transfer_policies.keys()) + ")")
+    if (backend is not None) and (backend not in usb_backends.keys()):
+        sys.exit("Unknown backend: " + backend + " (available: " + ", ".join(usb_backends.keys()) + ")")
+    if num_transfers < 1:
+        sys.exit("At least one transfer must be queued")
+    usb_method = get_usb_method(backend, num_transfers)
+    eeprom_cache = None
+    # With a serial number, only that adapter is used, and its EEPROM images are cached
+    if len(arguments) > 1:
+        serial_number = arguments[1].strip()
+        usb_method = get_serial_usb_method(serial_number, backend, num_transfers)
+        eeprom_cache = EepromImageCache(serial_number=serial_number)
+    start_usb_transfer(exit_gracefully, VID, PID, max_usb_timeout_r, max_usb_timeout_w, KeyboardThread(), TransferStatus(), UserOutput(), do_ctrl_c_handling=True, transfer_policy=transfer_policies[transfer_policy_name](), usb_method=usb_method, eeprom_cache=eeprom_cache)
@@ -0,0 +1,531 @@
+import sys
+import time
+import socket
+import asyncio
+import threading
+from collections import deque
+from gbridge import GBridge, GBridgeCommand, GBridgeDebugCommands, GBridgeSocket
+
+# Software stand-in for the Pico, to test and load test the bridge without hardware.
+# It has the same interface as the USB backends of usb_pico_interface
+# (sendByte, sendList, receiveByte, receiveByte_raw, kill_function).
+# Packets are answered the way the firmware does it (handle_input_data in src/specific/main.c),
+# debug commands follow src/generic/bridge_debug_commands.c, and the sockets
+# are driven by a scripted workload, using the framing of src/generic/gbridge.c.
+
+# Counters of a virtual device
+class VirtualDeviceStats:
+    def __init__(self):
+        self.packets = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.operations = 0
+        self.failed_operations = 0
+        self.payload_sent = 0
+        self.payload_received = 0
+        self.latencies = []
+
+    def add_latency(self, value):
+        self.latencies += [value]
+
+# A workload is a generator function which gets the device and uses
+# "yield from" on its sock_* methods, like libmobile uses the impl_sock_* callbacks.
+# Each yield means the device is waiting for more data from the bridge.
+# Like the firmware built with CAN_SAVE, the EEPROM has a RAM copy, which UPDATE_EEPROM
+# writes, and a flash copy, which SEND_EEPROM reads. The RAM copy is saved to flash
+# save_delay seconds after its last edit, if automatic saving is on or a save was forced.
+class VirtualGBridgeDevice:
+    MAX_TRANSFER_BYTES = 0x40
+    TRANSFER_LENGTH_MASK = 0x3F
+    DEBUG_CMD_TRANSFER_FLAG = 0xC0
+    DEBUG_TRANSFER_FLAG = 0x80
+    DEBUG_OUT_BUFFER_SIZE = 0x800
+    EEPROM_SIZE = 0x200
+    MAX_NUMBER_SIZE = 0x10
+    RELAY_TOKEN_SIZE = 0x10
+    DEFAULT_NAME = "PICO-USB-VIRTUAL"
+    DEFAULT_MOBILE_VERSION = [0, 0, 0, 0]
+    DEFAULT_VERSION = [0, 1, 0, 0]
+    # CONFIG_LAST_EDIT_TIMEOUT in src/specific/pico_mobile_adapter.c
+    CONFIG_LAST_EDIT_TIMEOUT = 1.0
+
+    def __init__(self, workload=None, name=DEFAULT_NAME, version=DEFAULT_VERSION, mobile_version=DEFAULT_MOBILE_VERSION, eeprom=None, link_latency=0, save_delay=CONFIG_LAST_EDIT_TIMEOUT):
+        self.name = name
+        self.version = bytes(version)
+        self.mobile_version = bytes(mobile_version)
+        self.eeprom = bytearray(VirtualGBridgeDevice.EEPROM_SIZE)
+        if eeprom is not None:
+            self.eeprom[:len(eeprom)] = eeprom
+        self.saved_eeprom = bytes(self.eeprom)
+        self.save_delay = save_delay
+        self.have_config_to_write = False
+        self.force_save = False
+        self.time_last_config_edit = 0
+        # How many times the done flag of UPDATE_EEPROM made the configuration load
+        self.config_loads = 0
+        self.started = True
+        self.automatic_save = False
+        self.number_user = b""
+        self.number_peer = b""
+        self.relay_token = None
+        self.link_latency = link_latency
+        self.data_in = bytearray()
+        self.data_out = bytearray()
+        self.debug_out = bytearray()
+        self.replies = deque()
+        self.lock = threading.Lock()
+        self.stats = VirtualDeviceStats()
+        self.done = False
+        self.workload = None
+        if workload is not None:
+            self.workload = workload(self)
+
+    # USB backend interface
+
+    def sendByte(self, byte_to_send, num_bytes):
+        self.sendList(byte_to_send.to_bytes(num_bytes, byteorder='big'))
+
+    # The whole packet must be in data, like transfer_func sends it
+    def sendList(self, data, chunk_size=8):
+        with self.lock:
+            self.handle_input_data(bytes(data))
+
+    def receiveByte(self, num_bytes):
+        return int.from_bytes(self.receiveByte_raw(num_bytes), byteorder='big')
+
+    # Returns an empty packet if nothing was sent, like a read timeout
+    def receiveByte_raw(self, num_bytes):
+        if self.link_latency > 0:
+            time.sleep(self.link_latency)
+        with self.lock:
+            if len(self.replies) == 0:
+                return b""
+            return self.replies.popleft()[:num_bytes]
+
+    def kill_function(self):
+        self.workload = None
+
+    # Firmware side
+
+    def handle_input_data(self, buf_in):
+        self.stats.packets += 1
+        self.stats.bytes_in += len(buf_in)
+        if len(buf_in) > 1:
+            reported_num = buf_in[0]
+            if (reported_num & VirtualGBridgeDevice.DEBUG_CMD_TRANSFER_FLAG) == VirtualGBridgeDevice.DEBUG_CMD_TRANSFER_FLAG:
+                self.interpret_debug_command(buf_in[1:], reported_num & VirtualGBridgeDevice.TRANSFER_LENGTH_MASK)
+            else:
+                if reported_num > (len(buf_in) - 1):
+                    reported_num = len(buf_in) - 1
+                self.data_in += buf_in[1:1 + reported_num]
+        self.run_workload()
+        self.save_config()
+
+        limit = VirtualGBridgeDevice.MAX_TRANSFER_BYTES - 1
+        buf_out = bytearray(1)
+        if len(self.data_out) > 0:
+            buf_out += self.data_out[:limit]
+            del self.data_out[:limit]
+            buf_out[0] = len(buf_out) - 1
+        elif len(self.debug_out) > 0:
+            buf_out += self.debug_out[:limit]
+            del self.debug_out[:limit]
+            buf_out[0] = (len(buf_out) - 1) | VirtualGBridgeDevice.DEBUG_TRANSFER_FLAG
+        self.stats.bytes_out += len(buf_out)
+        self.replies.append(bytes(buf_out))
+
+    # Same checks as pico_mobile_loop
+    def save_config(self):
+        if (self.have_config_to_write and self.automatic_save) or self.force_save:
+            if (time.monotonic() - self.time_last_config_edit) >= self.save_delay:
+                self.saved_eeprom = bytes(self.eeprom)
+                self.have_config_to_write = False
+                self.force_save = False
+
+    def run_workload(self):
+        if self.workload is None:
+            return
+        try:
+            next(self.workload)
+        except StopIteration:
+            self.workload = None
+            self.done = True
+
+    def debug_send(self, cmd, data):
+        frame = bytearray([cmd])
+        frame += len(data).to_bytes(2, byteorder='big')
+        frame += data
+        frame += GBridge.calc_checksum(data).to_bytes(2, byteorder='big')
+        if (len(self.debug_out) + len(frame)) <= VirtualGBridgeDevice.DEBUG_OUT_BUFFER_SIZE:
+            self.debug_out += frame
+
+    def debug_send_ack(self, command):
+        frame = bytearray([GBridge.GBRIDGE_CMD_DEBUG_ACK, command])
+        frame += command.to_bytes(2, byteorder='big')
+        if (len(self.debug_out) + len(frame)) <= VirtualGBridgeDevice.DEBUG_OUT_BUFFER_SIZE:
+            self.debug_out += frame
+
+    def interpret_debug_command(self, src, size):
+        if len(src) <= GBridge.CHECKSUM_SIZE:
+            return
+        if size > (len(src) - GBridge.CHECKSUM_SIZE):
+            size = len(src) - GBridge.CHECKSUM_SIZE
+        if size == 0:
+            return
+        if GBridge.calc_checksum(src[:size]) != int.from_bytes(src[size:size + GBridge.CHECKSUM_SIZE], byteorder='big'):
+            return
+        cmd = src[0]
+        data = src[1:size]
+        info = GBridge.GBRIDGE_CMD_DEBUG_INFO
+
+        if cmd == GBridgeDebugCommands.SEND_EEPROM_CMD:
+            self.debug_send(info, bytes([GBridgeDebugCommands.CMD_DEBUG_INFO_CFG]) + self.saved_eeprom)
+        elif cmd == GBridgeDebugCommands.STATUS_CMD:
+            flag = 2
+            if self.started:
+                flag |= 1
+            if self.automatic_save:
+                flag |= 4
+            self.debug_send(info, bytes([GBridgeDebugCommands.CMD_DEBUG_INFO_STATUS, flag, 8]))
+        elif cmd == GBridgeDebugCommands.SEND_IMPL_INFO_CMD:
+            self.debug_send(info, bytes([GBridgeDebugCommands.CMD_DEBUG_INFO_IMPL]) + self.mobile_version + self.version + self.name.encode('ascii'))
+        elif cmd == GBridgeDebugCommands.SEND_NUMBER_OWN_CMD:
+            self.debug_send(info, bytes([GBridgeDebugCommands.CMD_DEBUG_INFO_NUMBER]) + self.number_user.ljust(VirtualGBridgeDevice.MAX_NUMBER_SIZE + 1, b"\0"))
+        elif cmd == GBridgeDebugCommands.SEND_NUMBER_OTHER_CMD:
+            self.debug_send(info, bytes([GBridgeDebugCommands.CMD_DEBUG_INFO_NUMBER_PEER]) + self.number_peer.ljust(VirtualGBridgeDevice.MAX_NUMBER_SIZE + 1, b"\0"))
+        elif cmd == GBridgeDebugCommands.SEND_RELAY_TOKEN_CMD:
+            if self.relay_token is None:
+                self.debug_send(info, bytes([GBridgeDebugCommands.CMD_DEBUG_INFO_RELAY_TOKEN, 0]))
+            else:
+                self.debug_send(info, bytes([GBridgeDebugCommands.CMD_DEBUG_INFO_RELAY_TOKEN, 1]) + self.relay_token)
+        elif cmd == GBridgeDebugCommands.GET_NUMBER_STATUS_CMD:
+            self.debug_send(info, bytes([GBridgeDebugCommands.CMD_DEBUG_INFO_NUM_STATUS, 0]))
+        elif cmd == GBridgeDebugCommands.SEND_GBRIDGE_CFG_CMD:
+            self.debug_send(info, bytes([GBridgeDebugCommands.CMD_DEBUG_INFO_GBRIDGE_CFG, 0]) + bytes(8) + bytes(1))
+        elif cmd == GBridgeDebugCommands.UPDATE_EEPROM_CMD:
+            if (len(data) < 3) or self.started:
+                return
+            offset = min((data[0] << 8) | data[1], VirtualGBridgeDevice.EEPROM_SIZE)
+            chunk = data[3:3 + VirtualGBridgeDevice.EEPROM_SIZE - offset]
+            if self.eeprom[offset:offset + len(chunk)] != chunk:
+                self.have_config_to_write = True
+                self.time_last_config_edit = time.monotonic()
+            self.eeprom[offset:offset + len(chunk)] = chunk
+            if data[2] != 0:
+                self.config_loads += 1
+            self.debug_send_ack(cmd)
+        elif cmd == GBridgeDebugCommands.STOP_CMD:
+            self.started = False
+            self.debug_send_ack(cmd)
+        elif cmd == GBridgeDebugCommands.START_CMD:
+            self.started = True
+            self.debug_send_ack(cmd)
+        elif cmd == GBridgeDebugCommands.SET_SAVE_STYLE_CMD:
+            if len(data) < 1:
+                return
+            self.automatic_save = data[0] != 0
+            self.debug_send_ack(cmd)
+        elif cmd == GBridgeDebugCommands.FORCE_SAVE_CMD:
+            self.force_save = True
+            self.debug_send_ack(cmd)
+        elif cmd == GBridgeDebugCommands.UPDATE_RELAY_TOKEN_CMD:
+            if len(data) < 1:
+                return
+            if data[0] == 0:
+                self.relay_token = None
+            elif len(data) >= (1 + VirtualGBridgeDevice.RELAY_TOKEN_SIZE):
+                self.relay_token = bytes(data[1:1 + VirtualGBridgeDevice.RELAY_TOKEN_SIZE])
+            else:
+                return
+            self.debug_send_ack(cmd)
+        elif cmd in GBridgeDebugCommands.wants_ack:
+            if (len(data) < 1) and (cmd not in [GBridgeDebugCommands.FORCE_SAVE_CMD, GBridgeDebugCommands.ASK_NUMBER_CMD]):
+                return
+            self.debug_send_ack(cmd)
+
+    # GBridge framing, from the device's point of view
+
+    def read_bytes(self, size):
+        while len(self.data_in) < size:
+            yield
+        out_data = bytes(self.data_in[:size])
+        del self.data_in[:size]
+        return out_data
+
+    # Same as send_x_bytes: sends a frame and waits for the bridge to acknowledge it
+    def send_frame(self, payload, is_data):
+        cmd = GBridge.GBRIDGE_CMD_STREAM
+        size_length = 2
+        if is_data:
+            cmd = GBridge.GBRIDGE_CMD_DATA
+            size_length = 1
+        frame = bytearray([cmd])
+        frame += len(payload).to_bytes(size_length, byteorder='big')
+        frame += payload
+        frame += GBridge.calc_checksum(payload).to_bytes(2, byteorder='big')
+        while True:
+            self.data_out += frame
+            answer = None
+            while answer not in [GBridge.GBRIDGE_CMD_REPLY_F | cmd, GBridge.GBRIDGE_CMD_REPLY_F | (cmd + 1)]:
+                answer = (yield from self.read_bytes(1))[0]
+            if answer == (GBridge.GBRIDGE_CMD_REPLY_F | cmd):
+                return
+
+    # Same as get_x_bytes: waits for a frame from the bridge and acknowledges it
+    def get_frame(self, expected_data):
+        wanted_cmd = GBridge.GBRIDGE_CMD_STREAM_PC
+        if expected_data:
+            wanted_cmd = GBridge.GBRIDGE_CMD_DATA_PC
+        while True:
+            cmd = (yield from self.read_bytes(1))[0]
+            if (cmd != GBridge.GBRIDGE_CMD_STREAM_PC) and (cmd != GBridge.GBRIDGE_CMD_DATA_PC):
+                continue
+            size_length = 1
+            if cmd == GBridge.GBRIDGE_CMD_STREAM_PC:
+                size_length = 2
+            size = int.from_bytes((yield from self.read_bytes(size_length)), byteorder='big')
+            payload = yield from self.read_bytes(size)
+            checksum = int.from_bytes((yield from self.read_bytes(GBridge.CHECKSUM_SIZE)), byteorder='big')
+            if cmd != wanted_cmd:
+                continue
+            if GBridge.calc_checksum(payload) == checksum:
+                self.data_out.append(GBridge.GBRIDGE_CMD_REPLY_F | wanted_cmd)
+                return payload
+            self.data_out.append(GBridge.GBRIDGE_CMD_REPLY_F | (wanted_cmd + 1))
+
+    # Socket calls, same as src/generic/socket_impl.c
+
+    def sock_call(self, cmd, request, answer_len):
+        yield from self.send_frame(bytes([cmd]) + request, True)
+        answer = yield from self.get_frame(True)
+        self.stats.operations += 1
+        if (len(answer) < answer_len) or (answer[0] != cmd):
+            self.stats.failed_operations += 1
+            return None
+        return answer
+
+    def sock_open(self, conn, socktype, addrtype, bindport=0):
+        answer = yield from self.sock_call(GBridgeCommand.GBRIDGE_PROT_MA_CMD_OPEN, bytes([conn, socktype, addrtype, (bindport >> 8) & 0xFF, bindport & 0xFF]), 2)
+        return (answer is not None) and (answer[1] != 0)
+
+    def sock_close(self, conn):
+        yield from self.sock_call(GBridgeCommand.GBRIDGE_PROT_MA_CMD_CLOSE, bytes([conn]), 1)
+
+    # 1 if connected, 0 if still in progress, -1 on failure
+    def sock_connect(self, conn, addr):
+        answer = yield from self.sock_call(GBridgeCommand.GBRIDGE_PROT_MA_CMD_CONNECT, bytes([conn]) + addr, 2)
+        if answer is None:
+            return -1
+        return int.from_bytes(answer[1:2], byteorder='big', signed=True)
+
+    def sock_listen(self, conn):
+        answer = yield from self.sock_call(GBridgeCommand.GBRIDGE_PROT_MA_CMD_LISTEN, bytes([conn]), 2)
+        return (answer is not None) and (answer[1] != 0)
+
+    def sock_accept(self, conn):
+        answer = yield from self.sock_call(GBridgeCommand.GBRIDGE_PROT_MA_CMD_ACCEPT, bytes([conn]), 2)
+        return (answer is not None) and (answer[1] != 0)
+
+    def sock_send(self, conn, data, addr=None):
+        if addr is None:
+            addr = bytes([GBridgeSocket.MOBILE_ADDRTYPE_NONE])
+        yield from self.send_frame(bytes([GBridgeCommand.GBRIDGE_PROT_MA_CMD_SEND, conn]) + addr, True)
+        yield from self.send_frame(data, False)
+        answer = yield from self.get_frame(True)
+        self.stats.operations += 1
+        if (len(answer) < 3) or (answer[0] != GBridgeCommand.GBRIDGE_PROT_MA_CMD_SEND):
+            self.stats.failed_operations += 1
+            return -1
+        sent = int.from_bytes(answer[1:3], byteorder='big', signed=True)
+        if sent > 0:
+            self.stats.payload_sent += sent
+        return sent
+
+    # Returns the result (size, 0 if nothing, negative on errors), the data and the source address.
+    # If peek is set, it only checks how much data is available.
+    def sock_recv(self, conn, size, peek=False):
+        is_valid = 1
+        if peek:
+            is_valid = 0
+        answer = yield from self.sock_call(GBridgeCommand.GBRIDGE_PROT_MA_CMD_RECV, bytes([conn, (size >> 8) & 0xFF, size & 0xFF, is_valid]), 3)
+        if answer is None:
+            return -1, b"", None
+        result = int.from_bytes(answer[1:3], byteorder='big', signed=True)
+        source = GBridgeSocket.read_addr(answer[3:])
+        if (result <= 0) or peek:
+            return result, b"", source
+        data = yield from self.get_frame(False)
+        self.stats.payload_received += len(data)
+        return result, data, source
+
+# Returns a function which can be used as usb_method by start_usb_transfer,
+# so the bridge runs on a virtual device instead of a real one
+def virtual_method(workload=None, **device_args):
+    def usb_method(VID, PID, max_usb_timeout_r, max_usb_timeout_w, user_output):
+        user_output.set_out("Virtual USB device in use!", user_output.USB_TAG)
+        return VirtualGBridgeDevice(workload, **device_args)
+    return usb_method
+
+def make_addr(host, port):
+    family = socket.AF_INET
+    addrtype = GBridgeSocket.MOBILE_ADDRTYPE_IPV4
+    if ":" in host:
+        family = socket.AF_INET6
+        addrtype = GBridgeSocket.MOBILE_ADDRTYPE_IPV6
+    return bytes([addrtype, (port >> 8) & 0xFF, port & 0xFF]) + socket.inet_pton(family, host)
+
+# Workloads
+
+# Connects over TCP, then sends size bytes and waits for them to come back, count times
+# (forever if count is None). Needs an echo server at host:port.
+def tcp_echo_workload(host, port, size=0x80, count=None, conn=0):
+    def workload(device):
+        addr = make_addr(host, port)
+        addrtype = addr[0]
+        if not (yield from device.sock_open(conn, GBridgeSocket.MOBILE_SOCKTYPE_TCP, addrtype)):
+            return
+        result = 0
+        while result == 0:
+            result = yield from device.sock_connect(conn, addr)
+        if result < 0:
+            yield from device.sock_close(conn)
+            return
+        payload = bytes(i & 0xFF for i in range(size))
+        done = 0
+        while (count is None) or (done < count):
+            start_time = time.perf_counter()
+            sent = yield from device.sock_send(conn, payload)
+            if sent < 0:
+                break
+            received = 0
+            while received < sent:
+                result, data, source = yield from device.sock_recv(conn, sent - received)
+                if result < 0:
+                    break
+                received += len(data)
+            if received < sent:
+                break
+            device.stats.add_latency(time.perf_counter() - start_time)
+            done += 1
+        yield from device.sock_close(conn)
+    return workload
+
+# Sends size bytes datagrams to host:port and waits for each answer, count times.
+def udp_echo_workload(host, port, size=0x40, count=None, conn=1):
+    def workload(device):
+        addr = make_addr(host, port)
+        if not (yield from device.sock_open(conn, GBridgeSocket.MOBILE_SOCKTYPE_UDP, addr[0])):
+            return
+        payload = bytes(i & 0xFF for i in range(size))
+        done = 0
+        while (count is None) or (done < count):
+            start_time = time.perf_counter()
+            sent = yield from device.sock_send(conn, payload, addr)
+            if sent < 0:
+                break
+            result = 0
+            while result == 0:
+                result, data, source = yield from device.sock_recv(conn, size)
+            if result < 0:
+                break
+            device.stats.add_latency(time.perf_counter() - start_time)
+            done += 1
+        yield from device.sock_close(conn)
+    return workload
+
+# Simple threaded echo server, for the workloads above
+class EchoServer:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_server.bind((host, port))
+        self.tcp_server.listen(128)
+        self.port = self.tcp_server.getsockname()[1]
+        self.udp_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_server.bind((host, self.port))
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+        threading.Thread(target=self.udp_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                client, _ = self.tcp_server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.echo_loop, args=(client,), daemon=True).start()
+
+    def echo_loop(self, client):
+        with client:
+            while True:
+                try:
+                    data = client.recv(0x10000)
+                    if len(data) == 0:
+                        return
+                    client.sendall(data)
+                except OSError:
+                    return
+
+    def udp_loop(self):
+        while True:
+            try:
+                data, source = self.udp_server.recvfrom(0x10000)
+                self.udp_server.sendto(data, source)
+            except OSError:
+                return
+
+    def close(self):
+        self.tcp_server.close()
+        self.udp_server.close()
+
+# Runs num_devices virtual adapters against a local echo server, on one event loop,
+# and prints the throughput and latency they got.
+# Run as: python virtual_pico.py [num_devices] [seconds] [TCP/UDP]
+if __name__ == "__main__":
+    from usb_pico_interface import async_transfer_func, TransferStatus, UserOutput, AdaptiveTransferPolicy
+
+    class QuietOutput(UserOutput):
+        def set_out(self, string, tag, end='\n'):
+            if tag == self.EXCEPTION_TAG:
+                print(string)
+
+    class NoCommands:
+        def get_input(self):
+            return []
+
+    num_devices = 1
+    duration = 5.0
+    kind = "TCP"
+    if len(sys.argv) > 1:
+        num_devices = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        duration = float(sys.argv[2])
+    if len(sys.argv) > 3:
+        kind = sys.argv[3].upper()
+
+    server = EchoServer()
+    workload = tcp_echo_workload("127.0.0.1", server.port)
+    if kind == "UDP":
+        workload = udp_echo_workload("127.0.0.1", server.port)
+    devices = [VirtualGBridgeDevice(workload) for i in range(num_devices)]
+    states = [TransferStatus() for device in devices]
+
+    async def run_all():
+        tasks = [asyncio.ensure_future(async_transfer_func(devices[i], NoCommands(), states[i], QuietOutput(), transfer_policy=AdaptiveTransferPolicy())) for i in range(num_devices)]
+        await asyncio.sleep(duration)
+        for state in states:
+            state.end = True
+        await asyncio.gather(*tasks)
+
+    start_cpu = time.process_time()
+    asyncio.run(run_all())
+    cpu_time = time.process_time() - start_cpu
+    server.close()
+
+    latencies = sorted(latency for device in devices for latency in device.stats.latencies)
+    packets = sum(device.stats.packets for device in devices)
+    payload = sum(device.stats.payload_sent + device.stats.payload_received for device in devices)
+    print(str(num_devices) + " virtual adapters, " + kind + " echo, " + str(duration) + " s")
+    print("  " + ("%.0f" % (packets / duration)) + " USB packets/s, " + ("%.1f" % (payload / duration / 1024)) + " KiB/s of payload, " + str(len(latencies)) + " round trips")
+    if len(latencies) > 0:
+        print("  round trip: p50 " + ("%.2f" % (latencies[len(latencies) // 2] * 1000)) + " ms, p99 " + ("%.2f" % (latencies[int(0.99 * (len(latencies) - 1))] * 1000)) + " ms")
+    print("  CPU: " + ("%.2f" % cpu_time) + " s (" + ("%.0f" % (100 * cpu_time / duration)) + "% of a core)")